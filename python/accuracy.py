@@ -0,0 +1,210 @@
+"""
+Accuracy reports for sketches: evaluate every key in batches, normalize errors with NumPy, and summarize them
+either exactly or with a streaming quantile sketch whose memory does not grow with the number of keys.
+"""
+import math
+from abc import ABC, abstractmethod
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+QUANTILES = [0.5, 0.9, 0.95, 0.99]
+
+
+def exact_quantiles(values, quantiles: Sequence[float] = QUANTILES) -> np.ndarray:
+    """
+    The value of rank int(n * q) for every quantile q, without sorting all the values
+    :param values: values to summarize
+    :param quantiles: quantiles in [0, 1)
+    :return: one value per quantile, NaN if there are no values
+    """
+    values = np.asarray(values).reshape(-1)
+    if len(values) == 0:
+        return np.full(len(quantiles), np.nan)
+    ranks = np.minimum((len(values) * np.asarray(quantiles)).astype(np.int64), len(values) - 1)
+    return np.partition(values, ranks)[ranks]
+
+
+def l1_norm(values) -> float:
+    return float(np.sum(np.abs(np.asarray(values, dtype=np.float64))))
+
+
+def l2_norm(values) -> float:
+    values = np.asarray(values, dtype=np.float64)
+    return float(np.sqrt(np.dot(values, values)))
+
+
+class QuantileSummary(ABC):
+    """
+    A summary of a stream of values that answers quantile queries
+    """
+    @abstractmethod
+    def update_many(self, values) -> None:
+        """
+        Add a batch of values to the summary
+        """
+        return NotImplemented
+
+    @abstractmethod
+    def quantiles(self, quantiles: Sequence[float] = QUANTILES) -> np.ndarray:
+        """
+        :param quantiles: quantiles in [0, 1)
+        :return: the (estimated) value of every quantile
+        """
+        return NotImplemented
+
+    def update(self, value: float) -> None:
+        self.update_many([value])
+
+
+class ExactQuantiles(QuantileSummary):
+    """
+    Keeps every value. Memory grows with the number of values
+    """
+    batches: List[np.ndarray]
+
+    def __init__(self):
+        self.batches = []
+
+    def update_many(self, values) -> None:
+        self.batches.append(np.asarray(values, dtype=np.float64).reshape(-1))
+
+    def quantiles(self, quantiles: Sequence[float] = QUANTILES) -> np.ndarray:
+        return exact_quantiles(np.concatenate(self.batches), quantiles)
+
+
+class KllSketch(QuantileSummary):
+    """
+    KLL streaming quantile sketch (Karnin, Lang and Liberty, 2016). Level h holds items of weight 2^h. When a level
+    overflows, it is sorted and every other item, starting at a random offset, moves up a level. Level capacities
+    shrink geometrically below the top level, so the sketch holds O(k log(n / k)) items, and the rank error of a
+    quantile is about 1.7 / k of the number of values.
+    """
+    k: int
+    levels: List[np.ndarray]  # float64 items of every level, level 0 first
+    count: int
+
+    def __init__(self, k: int = 200, seed: Optional[int] = None):
+        """
+        :param k: accuracy parameter, the capacity of the top level
+        :param seed: seed for the compaction offsets
+        """
+        assert (k >= 2)
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.count = 0
+        self.rng = np.random.default_rng(seed)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def num_items(self) -> int:
+        """
+        :return: number of items currently stored, which bounds the sketch's memory
+        """
+        return sum(len(level) for level in self.levels)
+
+    def capacity(self, level: int) -> int:
+        return max(2, int(math.ceil(self.k * (2 / 3) ** (len(self.levels) - level - 1))))
+
+    def update_many(self, values) -> None:
+        values = np.sort(np.asarray(values, dtype=np.float64).reshape(-1))
+        self.count += len(values)
+        # Halving a large sorted batch before inserting it is the same as inserting it into level 0 and compacting
+        # it level by level, without ever holding the whole batch in the sketch. As in `_compress`, the odd item out
+        # of every halving stays behind at its level, so that no weight is lost
+        level = 0
+        while len(values) > self.k:
+            if len(self.levels) <= level + 1:
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], values[:len(values) % 2]])
+            values = values[len(values) % 2:][self.rng.integers(2)::2]
+            level += 1
+        self.levels[level] = np.concatenate([self.levels[level], values])
+        self._compress()
+
+    def merge(self, other: 'KllSketch') -> None:
+        """
+        Add the values summarized by another sketch to this one
+        :param other: the sketch to merge in. It is left unchanged
+        """
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.count += other.count
+        self._compress()
+
+    def _compress(self) -> None:
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(items)
+                # an odd item out stays behind, so that no weight is lost
+                leftover = items[:len(items) % 2]
+                items = items[len(items) % 2:]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], items[self.rng.integers(2)::2]])
+                self.levels[level] = leftover
+            level += 1
+
+    def quantiles(self, quantiles: Sequence[float] = QUANTILES) -> np.ndarray:
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 1 << level, dtype=np.int64)
+                                  for level, items in enumerate(self.levels)])
+        order = np.argsort(items, kind="stable")
+        cumulative_weights = np.cumsum(weights[order])
+        ranks = (np.asarray(quantiles) * cumulative_weights[-1]).astype(np.int64)
+        positions = np.minimum(np.searchsorted(cumulative_weights, ranks, side="right"), len(items) - 1)
+        return items[order][positions]
+
+
+def sketch_errors(struct, keys, true_vals, norm: float, batch_size: int = 1 << 20):
+    """
+    Absolute errors of a sketch's estimates, normalized, computed one batch of keys at a time
+    :param struct: any sketch with `get_many`
+    :param keys: every key to evaluate, as accepted by the sketch's `get_many`
+    :param true_vals: the true value of every key
+    :param norm: value to divide errors by, eg. `l2_norm(true_vals)`
+    :param batch_size: number of keys to evaluate at once
+    :return: generator of error arrays, one per batch
+    """
+    true_vals = np.asarray(true_vals)
+    for start in range(0, len(true_vals), batch_size):
+        approx_vals = np.asarray(struct.get_many(keys[start:start + batch_size]))
+        yield np.abs(approx_vals - true_vals[start:start + batch_size]) / norm
+
+
+def error_quantiles(struct, keys, true_vals, norm: Optional[float] = None, quantiles: Sequence[float] = QUANTILES,
+                    summary: Optional[QuantileSummary] = None, batch_size: int = 1 << 20) -> np.ndarray:
+    """
+    Quantiles of a sketch's normalized absolute errors over the given keys
+    :param norm: value to divide errors by. Defaults to the L2 norm of `true_vals`
+    :param summary: how errors are summarized. Defaults to exact quantiles; pass a `KllSketch` to bound memory
+    :return: one error per quantile
+    """
+    if norm is None:
+        norm = l2_norm(true_vals)
+    if summary is None:
+        summary = ExactQuantiles()
+    for errors in sketch_errors(struct, keys, true_vals, norm, batch_size):
+        summary.update_many(errors)
+    return summary.quantiles(quantiles)
+
+
+def print_error_quantiles(label: str, errors: Sequence[float], quantiles: Sequence[float] = QUANTILES,
+                          error_name: str = "error", label_width: int = 14) -> None:
+    """
+    Print error quantiles as percentages, on one line
+    :param label: name of the sketch
+    :param errors: the error of every quantile
+    :param quantiles: the quantiles
+    :param error_name: what the errors are, eg. "relative error"
+    :param label_width: minimum width of the label, for aligning several lines
+    """
+    print("%*s %s quantiles --" % (label_width, label, error_name), end=" ")
+    for quantile, error in zip(quantiles, errors):
+        print("\t%d%%: %.2f%%," % (int(quantile * 100), error * 100), end=" ")
+    print("")
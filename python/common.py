@@ -1,5 +1,7 @@
 from dataclasses import dataclass
-from typing import Tuple, Optional
+from typing import Tuple, Optional, List, Iterator, Union
+
+import numpy as np
 
 FlowId = Tuple[int, ...]
 
@@ -15,9 +17,101 @@ class Packet:
     flow_rate: Optional[int] = None
 
 
+@dataclass
+class PacketBatch:
+    """
+    Columnar trace: one array per packet field instead of one Packet object per packet.
+    A packet takes 8 bytes per key field plus 16, instead of a dataclass instance, a tuple and its integers.
+    """
+    keys: np.ndarray  # uint64 array of shape (n, fields), one row per flow key
+    timestamps: np.ndarray  # int64
+    sizes: np.ndarray  # int64
+
+    def __post_init__(self):
+        self.keys = np.asarray(self.keys, dtype=np.uint64)
+        if self.keys.ndim == 1:
+            self.keys = self.keys.reshape(-1, 1)
+        self.timestamps = np.asarray(self.timestamps, dtype=np.int64)
+        self.sizes = np.asarray(self.sizes, dtype=np.int64)
+        assert (len(self.keys) == len(self.timestamps) == len(self.sizes))
+
+    @classmethod
+    def from_packets(cls, packets: List[Packet]) -> 'PacketBatch':
+        return cls(keys=[packet.flow_id for packet in packets],
+                   timestamps=[packet.timestamp for packet in packets],
+                   sizes=[packet.size for packet in packets])
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def __getitem__(self, index) -> Union[Packet, 'PacketBatch']:
+        """
+        A single packet for an integer index, or a batch for a slice, index array or mask
+        """
+        if isinstance(index, (int, np.integer)):
+            return Packet(flow_id=tuple(self.keys[index].tolist()), timestamp=int(self.timestamps[index]),
+                          size=int(self.sizes[index]))
+        return PacketBatch(keys=self.keys[index], timestamps=self.timestamps[index], sizes=self.sizes[index])
+
+    def __iter__(self) -> Iterator[Packet]:
+        for key, timestamp, size in zip(self.keys.tolist(), self.timestamps.tolist(), self.sizes.tolist()):
+            yield Packet(flow_id=tuple(key), timestamp=timestamp, size=size)
+
+    def flow_ids(self) -> List[FlowId]:
+        """
+        :return: the flow key of every packet, as FlowId tuples
+        """
+        return [tuple(key) for key in self.keys.tolist()]
+
+    def nbytes(self) -> int:
+        return self.keys.nbytes + self.timestamps.nbytes + self.sizes.nbytes
+
+
+def as_packet_batch(packets: Union[List[Packet], PacketBatch]) -> PacketBatch:
+    return packets if isinstance(packets, PacketBatch) else PacketBatch.from_packets(packets)
+
+
 SEED = 0x12345678
 
 
+def zipf_packet_batch(num_pkts: int, zipf_exponent: float = 1.2, min_size: int = 20, max_size: int = 200,
+                      rng: Optional[np.random.Generator] = None) -> PacketBatch:
+    """
+    One packet per time unit from zipfian flows, with uniformly random sizes.
+    Flow keys are (id * 521, id, id * 91), with ids inflated to spread them out and wrapped to 32 bits so that
+    every key field fits in 64 bits. Wrapped ids are far out in the tail, so this is harmless
+    :param num_pkts: number of packets
+    :param zipf_exponent: exponent of the flow id distribution
+    :param min_size: smallest packet size
+    :param max_size: largest packet size
+    :param rng: random generator. Defaults to one seeded with SEED
+    """
+    if rng is None:
+        rng = np.random.default_rng(SEED)
+    pkt_ids = (rng.zipf(a=zipf_exponent, size=num_pkts) % (1 << 32)).astype(np.uint64)
+    return PacketBatch(keys=np.stack([pkt_ids * np.uint64(521), pkt_ids, pkt_ids * np.uint64(91)], axis=1),
+                       timestamps=np.arange(num_pkts),
+                       sizes=rng.integers(min_size, max_size, size=num_pkts, endpoint=True))
+
+
+def uniform_packet_batch(num_pkts: int, num_flows: int, min_size: int = 20, max_size: int = 200,
+                         rng: Optional[np.random.Generator] = None) -> PacketBatch:
+    """
+    One packet per time unit from uniformly random flows, with uniformly random sizes. Flow keys are (id * 91,)
+    :param num_pkts: number of packets
+    :param num_flows: flow ids are drawn from 0 to `num_flows`, inclusive
+    :param min_size: smallest packet size
+    :param max_size: largest packet size
+    :param rng: random generator. Defaults to one seeded with SEED
+    """
+    if rng is None:
+        rng = np.random.default_rng(SEED)
+    pkt_ids = rng.integers(0, num_flows, size=num_pkts, endpoint=True).astype(np.uint64)
+    return PacketBatch(keys=(pkt_ids * np.uint64(91)).reshape(-1, 1),
+                       timestamps=np.arange(num_pkts),
+                       sizes=rng.integers(min_size, max_size, size=num_pkts, endpoint=True))
+
+
 def proportional_drop_probability(flow_rate: int, enforced_limit: int) -> float:
     """ Return a drop probability proportional to how far the flow rate has exceeded the limit.
         If the limit is not exceeded, returns 0.
@@ -1,9 +1,19 @@
-from functools import partial
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import partial, lru_cache
+import struct
+import time
 import crcmod
-from typing import Callable
+import numpy as np
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Type, Union
 
 CRC16_DEFAULT_POLY = 0x18005
 
+# Largest number of bytes a single key field can occupy in the vectorized hash engines
+MAX_FIELD_BYTES = 8
+# Largest number of fields in a key hashed by the multiply-shift and tabulation families
+MAX_KEY_FIELDS = 8
+
 
 def run_crcmod_func(crc_func: Callable[[bytes], int], *nums: int) -> int:
     """
@@ -19,14 +29,626 @@ def run_crcmod_func(crc_func: Callable[[bytes], int], *nums: int) -> int:
     return crc_func(crc_input)
 
 
-def make_crc16_func(polynomial: int = CRC16_DEFAULT_POLY) -> Callable[..., int]:
+class Pad(NamedTuple):
+    """ A constant zero field inside a key layout, like the `3w0` in a P4 hash field list """
+    width: int
+
+
+class KeyLayout:
+    """
+    Fixed-width encoding of flow keys, eg. the {src_ip, dst_ip, proto, src_port, dst_port} tuples hashed by
+    rate_estimator.p4. Unlike `run_crcmod_func`, every field always occupies its declared width, so keys such as
+    (0, 5) and (5,) can no longer collide.
+    Keys are packed into a buffer that is allocated once and reused by every call.
+
+    Fields and pads may have any width in bits. The concatenated fields are treated as one big-endian integer
+    and hashed as its ceil(bits / 8) bytes. This framing is modelled on how the Tofino hash engine is documented to
+    frame a field list; it has not been checked against hashes computed by the P4 toolchain or the hardware.
+    """
+    # struct format codes for field widths that can be packed without bit manipulation
+    FIELD_FORMATS = {8: 'B', 16: 'H', 32: 'I', 64: 'Q'}
+
+    segments: List[Tuple[int, bool]]  # (width, is_pad) for every field and pad, in hashing order
+    field_widths: List[int]
+    num_bits: int
+    num_bytes: int
+    encoder: Optional[struct.Struct]  # None if the layout is not byte-aligned
+    buffer: bytearray
+    view: memoryview
+
+    def __init__(self, field_widths: Sequence[Union[int, Pad]]):
+        """
+        :param field_widths: width of each key field in bits, or a `Pad`, in hashing order
+        """
+        self.segments = []
+        for width in field_widths:
+            is_pad = isinstance(width, Pad)
+            width = int(width.width if is_pad else width)
+            if not 0 < width <= 64:
+                raise ValueError("Key field widths must be between 1 and 64 bits, not %d" % width)
+            self.segments.append((width, is_pad))
+        self.field_widths = [width for width, is_pad in self.segments if not is_pad]
+        self.num_bits = sum(width for width, _ in self.segments)
+        self.num_bytes = (self.num_bits + 7) // 8
+
+        self.encoder = None
+        if all(width in self.FIELD_FORMATS and not is_pad for width, is_pad in self.segments):
+            self.encoder = struct.Struct('>' + ''.join(self.FIELD_FORMATS[width] for width in self.field_widths))
+        self.buffer = bytearray(self.num_bytes)
+        self.view = memoryview(self.buffer)
+
+    @property
+    def num_fields(self) -> int:
+        return len(self.field_widths)
+
+    def pack(self, *nums: int) -> memoryview:
+        """
+        Encode a key into the layout's buffer. The returned view is overwritten by the next call.
+        :param nums: key fields
+        :return: view of the encoded key
+        """
+        if len(nums) != self.num_fields:
+            raise ValueError("Key has %d fields but the layout expects %d" % (len(nums), self.num_fields))
+        if self.encoder is not None:
+            self.encoder.pack_into(self.buffer, 0, *nums)
+            return self.view
+
+        packed = 0
+        field_iter = iter(nums)
+        for width, is_pad in self.segments:
+            packed <<= width
+            if not is_pad:
+                num = int(next(field_iter))
+                if num >> width:
+                    raise ValueError("Key field %d does not fit in %d bits" % (num, width))
+                packed |= num
+        for pos in range(self.num_bytes - 1, -1, -1):
+            self.buffer[pos] = packed & 0xff
+            packed >>= 8
+        return self.view
+
+    def byte_columns(self, keys: np.ndarray) -> List[Sequence[Optional[np.ndarray]]]:
+        """
+        Vectorized `pack`: the encoded bytes of every key in a batch, in CRC input order.
+        :param keys: uint64 array of shape (n, num_fields)
+        :return: list of (byte values, None), in the same format as `_variable_length_bytes`
+        """
+        if keys.shape[1] != self.num_fields:
+            raise ValueError("Keys have %d fields but the layout expects %d" % (keys.shape[1], self.num_fields))
+        # bit offset of each field's least significant bit within the packed integer
+        offsets = []
+        offset = self.num_bits
+        for width, is_pad in self.segments:
+            offset -= width
+            if not is_pad:
+                offsets.append(offset)
+
+        for field, width in zip(keys.T, self.field_widths):
+            if width < 64 and (field >> np.uint64(width)).any():
+                raise ValueError("Key field does not fit in %d bits" % width)
+
+        columns = []
+        for pos in range(self.num_bytes - 1, -1, -1):
+            byte_lo = 8 * pos
+            byte = np.zeros(len(keys), dtype=np.uint64)
+            for field, width, field_lo in zip(keys.T, self.field_widths, offsets):
+                if field_lo >= byte_lo + 8 or field_lo + width <= byte_lo:
+                    continue  # field does not overlap this byte
+                if field_lo >= byte_lo:
+                    byte |= field << np.uint64(field_lo - byte_lo)
+                else:
+                    byte |= field >> np.uint64(byte_lo - field_lo)
+            columns.append(((byte & np.uint64(0xff)).astype(np.uint16), None))
+        return columns
+
+
+# Modelled on the hash field lists of the three CMS rows in rate_estimator.p4. The zero pads make each row hash
+# differently, even though all rows use the same CRC16 algorithm.
+TOFINO_CMS_LAYOUTS = [
+    KeyLayout((32, 32, 8, 16, 16)),
+    KeyLayout((32, Pad(3), 32, Pad(3), 8, 16, 16)),
+    KeyLayout((32, 32, Pad(2), 8, Pad(2), 16, Pad(1), 16)),
+]
+
+# The 5-tuple flow key hashed by the first CMS row of rate_estimator.p4
+FIVE_TUPLE_LAYOUT = TOFINO_CMS_LAYOUTS[0]
+
+
+def run_crcmod_func_fixed(crc_func: Callable[[bytes], int], layout: KeyLayout, *nums: int) -> int:
+    """
+    Same as `run_crcmod_func`, but encodes the inputs with a fixed-width key layout
+    :param crc_func: CRC function created using crcmod.mkCrcFun
+    :param layout: the key layout
+    :param nums: CRC inputs, one per layout field
+    :return: CRC output
+    """
+    return crc_func(layout.pack(*nums))
+
+
+def make_crc16_func(polynomial: int = CRC16_DEFAULT_POLY, layout: Optional[KeyLayout] = None,
+                    salt: int = 0) -> Callable[..., int]:
     """
-    Given a CRC polynomial (and optionally a salt), return a function for computing CRC outputs
+    Given a CRC polynomial (and optionally a key layout and salt), return a function for computing CRC outputs
     :param polynomial: the CRC polynomial
-    :param salt: the CRC salt
+    :param layout: fixed-width encoding of the inputs. If None, each input uses as few bytes as possible
+    :param salt: the CRC salt, used as the initial CRC value
     :return: a CRC function
     """
-    return partial(run_crcmod_func, crcmod.mkCrcFun(poly=polynomial, initCrc=0))
+    crc_func = crcmod.mkCrcFun(poly=polynomial, initCrc=salt)
+    if layout is not None:
+        return partial(run_crcmod_func_fixed, crc_func, layout)
+    return partial(run_crcmod_func, crc_func)
+
+
+def crc16_polynomials(count: int, offset: int = 0) -> List[int]:
+    """
+    The CRC16 polynomials used by the sketch rows. Row `i` uses CRC16_DEFAULT_POLY + 0x100 * (i + offset)
+    :param count: number of polynomials
+    :param offset: index of the first polynomial
+    :return: list of polynomials
+    """
+    return [CRC16_DEFAULT_POLY + (0x100 * (i + offset)) for i in range(count)]
 
 
 CRC16 = make_crc16_func(polynomial=CRC16_DEFAULT_POLY)
+
+
+class HashCache:
+    """
+    Bounded LRU cache from flow keys to the outputs of a family of hash functions, eg. one function per sketch row.
+    Under skewed traffic most packets belong to a few heavy flows, which then only pay for hashing once.
+    Outputs are cached before any modulo, so one cache can be shared by every sketch using the same functions,
+    whatever their height: a CountMinSketch and an LpfMinSketch can use the first `width` functions for indices,
+    and a CountSketch can additionally use the next `width` functions for signs.
+    """
+    hash_funcs: List[Callable[..., int]]
+    max_size: int
+    entries: OrderedDict
+    hits: int
+    misses: int
+    evictions: int
+
+    def __init__(self, hash_funcs: List[Callable[..., int]], max_size: int = 65536):
+        """
+        :param hash_funcs: callables that take a variable number of integers and output a hash
+        :param max_size: maximum number of keys to remember
+        """
+        assert (max_size > 0)
+        self.hash_funcs = hash_funcs.copy()
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def num_funcs(self) -> int:
+        return len(self.hash_funcs)
+
+    def hashes(self, key: Tuple[int, ...]) -> Tuple[int, ...]:
+        """
+        Get the output of every hash function for the given key, computing them only on a cache miss.
+        :param key: the key to hash
+        :return: one hash output per hash function
+        """
+        entries = self.entries
+        outputs = entries.get(key)
+        if outputs is not None:
+            self.hits += 1
+            entries.move_to_end(key)
+            return outputs
+        self.misses += 1
+        outputs = tuple(hash_func(*key) for hash_func in self.hash_funcs)
+        entries[key] = outputs
+        if len(entries) > self.max_size:
+            entries.popitem(last=False)
+            self.evictions += 1
+        return outputs
+
+    def hit_rate(self) -> float:
+        """
+        :return: fraction of lookups that were cache hits
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def clear(self) -> None:
+        """
+        Forget every cached key and reset the counters
+        :return: None
+        """
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+@lru_cache(maxsize=None)
+def crc16_table(polynomial: int = CRC16_DEFAULT_POLY) -> np.ndarray:
+    """
+    The 256-entry lookup table used by crcmod for the given polynomial.
+    :param polynomial: the CRC polynomial
+    :return: read-only uint16 array
+    """
+    table = np.asarray(crcmod.Crc(poly=polynomial, initCrc=0).table, dtype=np.uint16)
+    table.setflags(write=False)
+    return table
+
+
+def as_key_array(keys) -> np.ndarray:
+    """
+    Convert a batch of flow keys into a 2D array with one row per key and one column per key field.
+    :param keys: an (n, fields) array, a 1D array of single-field keys, or a sequence of FlowId tuples
+    :return: uint64 array of shape (n, fields)
+    """
+    try:
+        keys = np.asarray(keys, dtype=np.uint64)
+    except OverflowError:
+        raise ValueError("Every key field must fit in 64 bits to be hashed in a batch")
+    if keys.ndim == 1:
+        keys = keys.reshape(-1, 1)
+    if keys.ndim != 2:
+        raise ValueError("Keys should be a 2D array of shape (n, fields)")
+    return keys
+
+
+def _variable_length_bytes(keys: np.ndarray) -> List[Sequence[Optional[np.ndarray]]]:
+    """
+    Decompose each key field into the bytes `run_crcmod_func` would feed to the CRC. Fields are encoded
+    big-endian using as few bytes as possible, so each byte position is only present for some keys.
+    :param keys: uint64 array of shape (n, fields)
+    :return: list of (byte values, mask of keys that include this byte), in CRC input order
+    """
+    columns = []
+    for field in keys.T:
+        num_bytes = np.zeros(len(field), dtype=np.uint8)
+        for pos in range(MAX_FIELD_BYTES):
+            num_bytes += field >= np.uint64(1 << (8 * pos))
+        for pos in range(int(num_bytes.max(initial=0)) - 1, -1, -1):
+            byte = ((field >> np.uint64(8 * pos)) & np.uint64(0xff)).astype(np.uint16)
+            columns.append((byte, num_bytes > pos))
+    return columns
+
+
+def _crc16_over_columns(columns: List[Sequence[Optional[np.ndarray]]], polynomial: int,
+                        num_keys: int, salt: int = 0) -> np.ndarray:
+    """
+    Table-driven, reflected CRC16 (as computed by crcmod) over byte columns, one key per array element.
+    A column whose mask is None is part of every key's input.
+    """
+    table = crc16_table(polynomial)
+    crc = np.full(num_keys, salt, dtype=np.uint16)
+    for byte, active in columns:
+        updated = table[(crc ^ byte) & 0xff] ^ (crc >> 8)
+        if active is None:
+            crc = updated
+        else:
+            crc = np.where(active, updated, crc)
+    return crc
+
+
+def _key_bytes(keys: np.ndarray, layout: Optional[KeyLayout]) -> List[Sequence[Optional[np.ndarray]]]:
+    if layout is None:
+        return _variable_length_bytes(keys)
+    return layout.byte_columns(keys)
+
+
+def crc16_many(keys, polynomial: int = CRC16_DEFAULT_POLY, layout: Optional[KeyLayout] = None,
+               salt: int = 0) -> np.ndarray:
+    """
+    Vectorized equivalent of `make_crc16_func(polynomial, layout, salt)(*key)` for every key in a batch.
+    Outputs are bit-for-bit identical to the scalar function.
+    :param keys: batch of keys, see `as_key_array`. Every field must fit in 64 bits.
+    :param polynomial: the CRC polynomial
+    :param layout: fixed-width encoding of the keys. If None, each field uses as few bytes as possible
+    :param salt: the CRC salt
+    :return: uint16 array with one CRC output per key
+    """
+    keys = as_key_array(keys)
+    return _crc16_over_columns(_key_bytes(keys, layout), polynomial, len(keys), salt)
+
+
+def crc16_rows(keys, polynomials: Sequence[int], layout: Optional[KeyLayout] = None,
+               salts: Optional[Sequence[int]] = None) -> np.ndarray:
+    """
+    CRC outputs of every key for several polynomials at once, eg. one polynomial per sketch row.
+    The per-key byte decomposition is shared across all polynomials.
+    :param keys: batch of keys, see `as_key_array`
+    :param polynomials: CRC polynomials, eg. from `crc16_polynomials`
+    :param layout: fixed-width encoding of the keys. If None, each field uses as few bytes as possible
+    :param salts: one CRC salt per polynomial. Defaults to all zeros
+    :return: uint16 array of shape (len(polynomials), n)
+    """
+    if salts is None:
+        salts = [0] * len(polynomials)
+    keys = as_key_array(keys)
+    columns = _key_bytes(keys, layout)
+    result = np.empty((len(polynomials), len(keys)), dtype=np.uint16)
+    for row, (polynomial, salt) in enumerate(zip(polynomials, salts)):
+        result[row] = _crc16_over_columns(columns, polynomial, len(keys), salt)
+    return result
+
+
+def make_tofino_cms_hash_funcs(layouts: Sequence[KeyLayout] = TOFINO_CMS_LAYOUTS,
+                               polynomial: int = CRC16_DEFAULT_POLY) -> List[Callable[..., int]]:
+    """
+    Scalar hash functions modelled on the `Hash<cms_index_t>(HashAlgorithm_t.CRC16)` units of
+    rate_estimator.p4, one per CMS row. See `KeyLayout` for how closely the input framing follows the switch.
+    Keys are (src_ip, dst_ip, proto, src_port, dst_port) tuples.
+    Outputs are full 16-bit CRCs; the data plane keeps the low bits, which is what `% height` does.
+    :param layouts: field list of each row
+    :param polynomial: the CRC polynomial. The Tofino CRC16 algorithm is CRC16_DEFAULT_POLY
+    :return: one hash function per row
+    """
+    return [make_crc16_func(polynomial=polynomial, layout=layout) for layout in layouts]
+
+
+def tofino_cms_hashes(keys, layouts: Sequence[KeyLayout] = TOFINO_CMS_LAYOUTS,
+                      polynomial: int = CRC16_DEFAULT_POLY) -> np.ndarray:
+    """
+    Vectorized `make_tofino_cms_hash_funcs`. Hash outputs do not depend upon the sketch's height,
+    so the hashes of an entire trace can be computed once and reused by every sketch-parameter run.
+    :param keys: batch of 5-tuple keys, see `as_key_array`
+    :param layouts: field list of each row
+    :param polynomial: the CRC polynomial
+    :return: uint16 array of shape (len(layouts), n)
+    """
+    keys = as_key_array(keys)
+    result = np.empty((len(layouts), len(keys)), dtype=np.uint16)
+    for row, layout in enumerate(layouts):
+        result[row] = _crc16_over_columns(layout.byte_columns(keys), polynomial, len(keys))
+    return result
+
+
+class HashFamily(ABC):
+    """
+    A family of hash functions with one function per sketch row. Every family offers scalar functions with the
+    same calling convention as `make_crc16_func`, and a vectorized `hash_many` that produces identical outputs.
+    Rows are distinguished by per-row salts derived from `seed`.
+    """
+    name: str = NotImplemented
+    num_rows: int
+    seed: int
+    funcs: List[Callable[..., int]]
+
+    def __init__(self, num_rows: int, seed: int = 0):
+        self.num_rows = num_rows
+        self.seed = seed
+        self.funcs = [partial(self.hash_row, row) for row in range(num_rows)]
+
+    @abstractmethod
+    def hash_row(self, row: int, *nums: int) -> int:
+        """
+        Hash a single key with one row's function
+        :param row: row index
+        :param nums: key fields
+        :return: hash output
+        """
+        return NotImplemented
+
+    @abstractmethod
+    def hash_many(self, keys) -> np.ndarray:
+        """
+        Hash a batch of keys with every row's function
+        :param keys: batch of keys, see `as_key_array`
+        :return: unsigned integer array of shape (num_rows, n)
+        """
+        return NotImplemented
+
+    def spec(self) -> Dict[str, Any]:
+        """
+        :return: the arguments of `make_hash_family` that recreate this family
+        """
+        return {"name": self.name, "num_rows": self.num_rows, "seed": self.seed}
+
+
+class Crc16Family(HashFamily):
+    """
+    CRC16 with a different polynomial per row. With seed 0 every salt is 0, which gives the same functions the
+    sketches use by default. Any other seed draws a random salt (initial CRC value) for each row.
+    """
+    name = "crc16"
+    polynomials: List[int]
+    salts: List[int]
+    layout: Optional[KeyLayout]
+
+    def __init__(self, num_rows: int, seed: int = 0, polynomials: Optional[Sequence[int]] = None,
+                 layout: Optional[Union[KeyLayout, Sequence[Union[int, Pad]]]] = None):
+        if polynomials is None:
+            polynomials = crc16_polynomials(num_rows)
+        assert (len(polynomials) == num_rows)
+        self.polynomials = list(polynomials)
+        if seed == 0:
+            self.salts = [0] * num_rows
+        else:
+            self.salts = [int(salt) for salt in np.random.default_rng(seed).integers(0, 1 << 16, num_rows)]
+        if layout is not None and not isinstance(layout, KeyLayout):
+            layout = KeyLayout(layout)
+        self.layout = layout
+        self.crc_funcs = [make_crc16_func(polynomial=poly, layout=layout, salt=salt)
+                          for poly, salt in zip(self.polynomials, self.salts)]
+        super().__init__(num_rows, seed)
+        self.funcs = self.crc_funcs.copy()
+
+    def hash_row(self, row: int, *nums: int) -> int:
+        return self.crc_funcs[row](*nums)
+
+    def hash_many(self, keys) -> np.ndarray:
+        return crc16_rows(keys, self.polynomials, layout=self.layout, salts=self.salts)
+
+    def spec(self) -> Dict[str, Any]:
+        spec = super().spec()
+        spec["polynomials"] = self.polynomials
+        if self.layout is not None:
+            spec["layout"] = [Pad(width) if is_pad else width for width, is_pad in self.layout.segments]
+        return spec
+
+
+class MultiplyShiftFamily(HashFamily):
+    """
+    Multiply-add-shift hashing: h(x) = ((b + sum_i a_i * x_i) mod 2^64) >> (64 - out_bits), with random odd
+    multipliers a_i per key field and a random increment b per row. Only a few integer operations per field.
+    """
+    name = "multiply_shift"
+    out_bits: int
+    multipliers: np.ndarray  # uint64 array of shape (num_rows, MAX_KEY_FIELDS)
+    increments: np.ndarray  # uint64 array of shape (num_rows,)
+
+    MASK64 = (1 << 64) - 1
+
+    def __init__(self, num_rows: int, seed: int = 0, out_bits: int = 32):
+        assert (0 < out_bits <= 32)
+        self.out_bits = out_bits
+        rng = np.random.default_rng(seed)
+        self.multipliers = rng.integers(0, 1 << 64, (num_rows, MAX_KEY_FIELDS), dtype=np.uint64) | np.uint64(1)
+        self.increments = rng.integers(0, 1 << 64, num_rows, dtype=np.uint64)
+        self._multipliers = self.multipliers.tolist()
+        self._increments = self.increments.tolist()
+        super().__init__(num_rows, seed)
+
+    def hash_row(self, row: int, *nums: int) -> int:
+        acc = self._increments[row]
+        for multiplier, num in zip(self._multipliers[row], nums):
+            acc += multiplier * int(num)
+        return (acc & self.MASK64) >> (64 - self.out_bits)
+
+    def hash_many(self, keys) -> np.ndarray:
+        keys = as_key_array(keys)
+        assert (keys.shape[1] <= MAX_KEY_FIELDS)
+        result = np.empty((self.num_rows, len(keys)), dtype=np.uint32)
+        for row in range(self.num_rows):
+            acc = np.full(len(keys), self.increments[row], dtype=np.uint64)
+            for field in range(keys.shape[1]):
+                acc += self.multipliers[row, field] * keys[:, field]  # wraps around modulo 2^64
+            result[row] = acc >> np.uint64(64 - self.out_bits)
+        return result
+
+    def spec(self) -> Dict[str, Any]:
+        spec = super().spec()
+        spec["out_bits"] = self.out_bits
+        return spec
+
+
+class TabulationFamily(HashFamily):
+    """
+    Simple tabulation hashing: every byte of every key field indexes its own table of random words,
+    and the looked-up words are XORed together. 3-independent, and only table lookups per byte.
+    """
+    name = "tabulation"
+    out_bits: int
+    tables: np.ndarray  # uint32 array of shape (num_rows, MAX_KEY_FIELDS * MAX_FIELD_BYTES, 256)
+
+    def __init__(self, num_rows: int, seed: int = 0, out_bits: int = 32):
+        assert (0 < out_bits <= 32)
+        self.out_bits = out_bits
+        rng = np.random.default_rng(seed)
+        self.tables = rng.integers(0, 1 << out_bits, (num_rows, MAX_KEY_FIELDS * MAX_FIELD_BYTES, 256),
+                                   dtype=np.uint32)
+        self._tables = self.tables.tolist()
+        super().__init__(num_rows, seed)
+
+    def hash_row(self, row: int, *nums: int) -> int:
+        tables = self._tables[row]
+        acc = 0
+        for field, num in enumerate(nums):
+            num = int(num)
+            for pos in range(MAX_FIELD_BYTES):
+                acc ^= tables[field * MAX_FIELD_BYTES + pos][(num >> (8 * pos)) & 0xff]
+        return acc
+
+    def hash_many(self, keys) -> np.ndarray:
+        keys = as_key_array(keys)
+        assert (keys.shape[1] <= MAX_KEY_FIELDS)
+        result = np.zeros((self.num_rows, len(keys)), dtype=np.uint32)
+        for field in range(keys.shape[1]):
+            for pos in range(MAX_FIELD_BYTES):
+                byte = (keys[:, field] >> np.uint64(8 * pos)) & np.uint64(0xff)
+                for row in range(self.num_rows):
+                    result[row] ^= self.tables[row, field * MAX_FIELD_BYTES + pos][byte]
+        return result
+
+    def spec(self) -> Dict[str, Any]:
+        spec = super().spec()
+        spec["out_bits"] = self.out_bits
+        return spec
+
+
+HASH_FAMILIES: Dict[str, Type[HashFamily]] = {family.name: family for family in
+                                              [Crc16Family, MultiplyShiftFamily, TabulationFamily]}
+
+
+def make_hash_family(name: str, num_rows: int, seed: int = 0, **kwargs) -> HashFamily:
+    """
+    Create a registered hash family
+    :param name: registered name, one of HASH_FAMILIES
+    :param num_rows: number of hash functions, eg. the sketch width
+    :param seed: seed for the per-row salts
+    :param kwargs: family-specific arguments
+    :return: the hash family
+    """
+    if name not in HASH_FAMILIES:
+        raise ValueError("Unknown hash family %s. Registered families: %s" % (name, ", ".join(HASH_FAMILIES)))
+    return HASH_FAMILIES[name](num_rows, seed=seed, **kwargs)
+
+
+def cross_row_collision_ratios(hashes: np.ndarray, height: int) -> np.ndarray:
+    """
+    For every pair of rows, the number of key pairs that collide in both rows, divided by the number expected if
+    the rows were independent. 1.0 means independent rows. Correlated rows (>1.0) make the sketch's min or median
+    less useful, since a key that collides with a heavy key in one row tends to do so in the other rows as well.
+    :param hashes: hash outputs of distinct keys, of shape (num_rows, n)
+    :param height: number of cells per row
+    :return: array of shape (num_rows, num_rows), with NaN on the diagonal
+    """
+    indices = (hashes % height).astype(np.int64)
+    num_rows, num_keys = indices.shape
+    total_pairs = num_keys * (num_keys - 1) / 2
+
+    def colliding_pairs(cells: np.ndarray) -> float:
+        counts = np.unique(cells, return_counts=True)[1].astype(np.float64)
+        return float(np.sum(counts * (counts - 1) / 2))
+
+    row_pairs = [colliding_pairs(row) for row in indices]
+    ratios = np.full((num_rows, num_rows), np.nan)
+    for row1 in range(num_rows):
+        for row2 in range(row1 + 1, num_rows):
+            both = colliding_pairs(indices[row1] * height + indices[row2])
+            expected = row_pairs[row1] * row_pairs[row2] / total_pairs
+            ratios[row1, row2] = ratios[row2, row1] = both / expected if expected > 0 else np.nan
+    return ratios
+
+
+def benchmark_hash_families(num_keys: int = 200000, num_rows: int = 3, height: int = 2048,
+                            num_scalar_keys: int = 20000):
+    """
+    Print the scalar and batch throughput of every registered hash family, and the worst cross-row collision ratio
+    over structured keys like the ones generated by the simulations.
+    """
+    ids = np.arange(1, num_keys + 1, dtype=np.uint64)
+    keys = np.stack([ids * np.uint64(521), ids, ids * np.uint64(91)], axis=1)
+    scalar_keys = keys[:num_scalar_keys].tolist()
+
+    families = [make_hash_family(name, num_rows) for name in HASH_FAMILIES]
+    families.append(make_hash_family("crc16", num_rows, seed=1))
+    print("%d keys, %d rows, height %d" % (num_keys, num_rows, height))
+    for family in families:
+        start = time.perf_counter()
+        for key in scalar_keys:
+            for func in family.funcs:
+                func(*key)
+        scalar_rate = len(scalar_keys) / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        hashes = family.hash_many(keys)
+        batch_rate = num_keys / (time.perf_counter() - start)
+
+        ratios = cross_row_collision_ratios(hashes, height)
+        print("%14s seed %d -- scalar: %9.0f keys/s, batch: %11.0f keys/s, worst cross-row collision ratio: %.3f"
+              % (family.name, family.seed, scalar_rate, batch_rate, np.nanmax(ratios)))
+
+
+if __name__ == "__main__":
+    benchmark_hash_families()
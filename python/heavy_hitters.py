@@ -3,9 +3,9 @@ from abc import ABC, abstractmethod
 from collections import defaultdict
 from typing import Tuple, Dict, List, Callable, Optional
 
-from numpy.lib import math
-
-from hashing import make_crc16_func, CRC16_DEFAULT_POLY
+from accuracy import KllSketch, error_quantiles, l2_norm, print_error_quantiles
+from common import PacketBatch
+from hashing import HashCache, HashFamily, Crc16Family, as_key_array
 import numpy as np
 
 from statistics import median
@@ -15,6 +15,69 @@ SEED = 0x12345678
 FlowId = Tuple[int, ...]
 
 
+def as_flow_ids(keys) -> List[FlowId]:
+    """
+    Convert a batch of keys into a list of FlowId tuples
+    :param keys: an (n, fields) array or a sequence of FlowId tuples
+    :return: list of FlowIds
+    """
+    if isinstance(keys, np.ndarray):
+        return [tuple(key) for key in as_key_array(keys).tolist()]
+    return [tuple(key) for key in keys]
+
+
+def grouped_cumsum(groups: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """
+    Running sum of `values` within each group, in array order. Equivalent to keeping one counter per group and
+    recording each counter right after adding each value to it.
+    :param groups: group (eg. register cell) of each value
+    :param values: values to sum
+    :return: inclusive running sums, in the same order as `values`
+    """
+    order = np.argsort(groups, kind='stable')
+    sorted_groups = groups[order]
+    sorted_sums = np.cumsum(values[order])
+    group_starts = np.empty(len(groups), dtype=bool)
+    group_starts[:1] = True
+    group_starts[1:] = sorted_groups[1:] != sorted_groups[:-1]
+    # running total of every earlier group, subtracted from each element of the group
+    earlier_totals = (sorted_sums - values[order])[group_starts]
+    sorted_sums -= earlier_totals[np.cumsum(group_starts) - 1]
+    result = np.empty_like(sorted_sums)
+    result[order] = sorted_sums
+    return result
+
+
+def check_counter_value(value, dtype: np.dtype):
+    """
+    Check that an increment can be added to counters of the given dtype without being truncated
+    :param value: the increment
+    :param dtype: dtype of the counters
+    :return: `value`
+    :raise TypeError: if the counters are integers and `value` is not integral
+    """
+    if (np.issubdtype(dtype, np.integer) and not isinstance(value, (int, np.integer)) and
+            not float(value).is_integer()):
+        raise TypeError("Cannot add %r to %s counters" % (value, np.dtype(dtype).name))
+    return value
+
+
+def as_counter_values(values, dtype: np.dtype) -> np.ndarray:
+    """
+    Batch version of `check_counter_value`
+    :param values: the increments
+    :param dtype: dtype of the counters
+    :return: `values`, converted to `dtype`
+    :raise TypeError: if the counters are integers and some value is not integral
+    """
+    values = np.asarray(values)
+    converted = values.astype(dtype, copy=False)
+    if np.issubdtype(dtype, np.integer) and not np.issubdtype(values.dtype, np.integer) and \
+            not np.array_equal(converted, values):
+        raise TypeError("Cannot add non-integral values to %s counters" % np.dtype(dtype).name)
+    return converted
+
+
 class HeavyHitterSketch(ABC):
     @abstractmethod
     def clear(self) -> None:
@@ -63,6 +126,45 @@ class HeavyHitterSketch(ABC):
         """
         return NotImplemented
 
+    def get_many(self, keys) -> np.ndarray:
+        """
+        Batch version of `get`.
+        :param keys: item keys, as an (n, fields) array or a sequence of FlowId tuples
+        :return: item counts
+        """
+        return np.asarray([self.get(key) for key in as_flow_ids(keys)])
+
+    def add_many(self, keys, add_vals=1) -> np.ndarray:
+        """
+        Batch version of `add`. Keys are processed in order, so each output is the count that `add` would have
+        returned for that key, including earlier additions of the same key in the batch.
+        :param keys: item keys, as an (n, fields) array or a sequence of FlowId tuples
+        :param add_vals: values to add, one per key, or a single value for every key. They are passed to `add`
+                         unchanged, so sketches with integer counters reject non-integral values
+        :return: item counts, after each addition
+        """
+        keys = as_flow_ids(keys)
+        return np.asarray([self.add(key, add_val)
+                           for key, add_val in zip(keys, np.broadcast_to(add_vals, len(keys)).tolist())])
+
+    def add_batch(self, batch: PacketBatch) -> np.ndarray:
+        """
+        Feed a columnar trace to the sketch, using packet sizes as values
+        :return: item counts, after each packet
+        """
+        return self.add_many(batch.keys, batch.sizes)
+
+    def add_after_return_many(self, keys, add_vals=1) -> np.ndarray:
+        """
+        Batch version of `add_after_return`, with the same ordering semantics as `add_many`.
+        :param keys: item keys, as an (n, fields) array or a sequence of FlowId tuples
+        :param add_vals: values to add, one per key, or a single value for every key
+        :return: item counts, before each addition
+        """
+        keys = as_flow_ids(keys)
+        return np.asarray([self.add_after_return(key, add_val)
+                           for key, add_val in zip(keys, np.broadcast_to(add_vals, len(keys)).tolist())])
+
 
 class ExactHeavyHitters(HeavyHitterSketch):
     ground_truth: Dict[FlowId, int]
@@ -90,28 +192,314 @@ class ExactHeavyHitters(HeavyHitterSketch):
         self.ground_truth[key] = val + add_val
         return val
 
+    def add_many(self, keys, add_vals=1) -> np.ndarray:
+        keys = as_flow_ids(keys)
+        ground_truth = self.ground_truth
+        vals = []
+        for key, add_val in zip(keys, np.broadcast_to(add_vals, len(keys)).tolist()):
+            val = ground_truth[key] + add_val
+            ground_truth[key] = val
+            vals.append(val)
+        return np.asarray(vals)
+
+    def merge(self, other: 'ExactHeavyHitters') -> None:
+        """
+        Add the counts of another exact table to this one
+        :param other: the table to merge in. It is left unchanged
+        """
+        self.merge_counts(other.ground_truth)
+
+    def merge_counts(self, counts: Dict[FlowId, int]) -> None:
+        """
+        Add per-key counts, eg. the table of an `ExactHeavyHitters` from a worker process, to this table
+        :param counts: per-key counts
+        """
+        ground_truth = self.ground_truth
+        for key, count in counts.items():
+            ground_truth[key] += count
+
+
+class TopK:
+    """
+    The k keys with the largest estimates seen so far, eg. the heaviest flows of a sketch. Keys are kept in an
+    indexed min-heap, so every offer takes O(log k) time and memory does not grow with the number of flows.
+    Each key's estimate is the one it was last offered with. When estimates only grow, as in a CMS without
+    subtractions, the result is exactly the top k of the latest estimates.
+    """
+    capacity: int
+    heap: List[Tuple[float, FlowId]]  # (estimate, key) pairs, smallest estimate first
+    positions: Dict[FlowId, int]  # heap position of every key
+
+    def __init__(self, capacity: int):
+        """
+        :param capacity: number of keys to keep
+        """
+        assert (capacity > 0)
+        self.capacity = capacity
+        self.clear()
+
+    def clear(self) -> None:
+        self.heap = []
+        self.positions = {}
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def __contains__(self, key: FlowId) -> bool:
+        return key in self.positions
+
+    def threshold(self):
+        """
+        :return: the smallest estimate that is kept once the structure is full, or None if it is not full
+        """
+        return self.heap[0][0] if len(self.heap) == self.capacity else None
+
+    def offer(self, key: FlowId, estimate) -> None:
+        """
+        Record the latest estimate of a key. The key is kept if it is among the k largest
+        :param key: item key
+        :param estimate: the key's current estimate
+        """
+        heap = self.heap
+        position = self.positions.get(key)
+        if position is not None:
+            old_estimate = heap[position][0]
+            heap[position] = (estimate, key)
+            if estimate < old_estimate:
+                self._sift_up(position)
+            else:
+                self._sift_down(position)
+        elif len(heap) < self.capacity:
+            heap.append((estimate, key))
+            self.positions[key] = len(heap) - 1
+            self._sift_up(len(heap) - 1)
+        elif estimate > heap[0][0]:
+            del self.positions[heap[0][1]]
+            heap[0] = (estimate, key)
+            self.positions[key] = 0
+            self._sift_down(0)
+
+    def offer_many(self, keys: List[FlowId], estimates) -> None:
+        """
+        Batch version of `offer`. Only the last estimate of each key in the batch is offered, in the order in which
+        the keys first reached it, so that a key that reached an estimate earlier wins a tie against one that
+        reached it later, like with sequential offers. When estimates only grow, the same estimates are kept as by
+        offering every estimate in order, but which of several keys tied at the threshold is kept may differ,
+        since sequential offers break some ties by the layout of the heap
+        :param keys: item keys
+        :param estimates: the estimate of every key after its update
+        """
+        # position at which each key first reached its last estimate
+        latest = {}
+        for position, (key, estimate) in enumerate(zip(keys, np.asarray(estimates).tolist())):
+            previous = latest.get(key)
+            if previous is None or previous[1] != estimate:
+                latest[key] = (position, estimate)
+        threshold = self.threshold()
+        positions = self.positions
+        for key, (_, estimate) in sorted(latest.items(), key=lambda item: item[1][0]):
+            if threshold is None or estimate > threshold or key in positions:
+                self.offer(key, estimate)
+                threshold = self.threshold()
+
+    def top_k(self) -> List[Tuple[FlowId, float]]:
+        """
+        :return: (key, estimate) pairs, largest estimate first
+        """
+        return [(key, estimate) for estimate, key in sorted(self.heap, key=lambda pair: pair[0], reverse=True)]
+
+    def _swap(self, i: int, j: int) -> None:
+        heap = self.heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self.positions[heap[i][1]] = i
+        self.positions[heap[j][1]] = j
+
+    def _sift_up(self, position: int) -> None:
+        heap = self.heap
+        while position > 0:
+            parent = (position - 1) // 2
+            if heap[parent][0] <= heap[position][0]:
+                break
+            self._swap(parent, position)
+            position = parent
+
+    def _sift_down(self, position: int) -> None:
+        heap = self.heap
+        size = len(heap)
+        while True:
+            smallest = position
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < size and heap[child][0] < heap[smallest][0]:
+                    smallest = child
+            if smallest == position:
+                break
+            self._swap(smallest, position)
+            position = smallest
+
+
+class TopKTracking:
+    """
+    Mixin for sketches that can maintain a `TopK` of their keys as packets pass through them
+    """
+    top_keys: Optional[TopK]
+
+    def attach_top_k(self, k: int) -> TopK:
+        """
+        Start tracking the k keys with the largest estimates. Only updates made after attaching are tracked.
+        :param k: number of keys to track
+        :return: the new `TopK`
+        """
+        self.top_keys = TopK(k)
+        return self.top_keys
+
+    def top_k(self) -> List[Tuple[FlowId, float]]:
+        """
+        :return: (key, estimate) pairs of the tracked keys, largest estimate first
+        """
+        if self.top_keys is None:
+            raise ValueError("Top-k tracking is disabled. See `attach_top_k`")
+        return self.top_keys.top_k()
+
+
+class GroundTruthTracking:
+    """
+    Mixin for approximate sketches that can mirror every update into an exact oracle, for measuring their error.
+    With tracking disabled and no oracle attached, a sketch's memory only depends upon its dimensions,
+    not upon the number of flows.
+    """
+    oracle: Optional[ExactHeavyHitters]
+
+    @property
+    def ground_truth(self) -> Optional[Dict[FlowId, int]]:
+        """
+        Exact per-key counts of every update made to the sketch, or None if ground truth is not being tracked
+        """
+        return None if self.oracle is None else self.oracle.ground_truth
+
+    def attach_ground_truth(self, oracle: Optional[ExactHeavyHitters] = None) -> ExactHeavyHitters:
+        """
+        Start mirroring updates into an exact oracle. Only updates made after attaching are mirrored.
+        :param oracle: the oracle. If None, a new, empty oracle is created
+        :return: the attached oracle
+        """
+        self.oracle = ExactHeavyHitters() if oracle is None else oracle
+        return self.oracle
+
+    def detach_ground_truth(self) -> Optional[ExactHeavyHitters]:
+        """
+        Stop mirroring updates into the oracle
+        :return: the previously attached oracle, if any
+        """
+        oracle = self.oracle
+        self.oracle = None
+        return oracle
+
+
+class MergeableCounters(GroundTruthTracking):
+    """
+    Mixin for sketches whose state is an array of counters that every update changes additively.
+    Two such sketches built with the same dimensions and hash functions, fed disjoint parts of a trace,
+    merge into exactly the sketch that the whole trace would have produced.
+    """
+    arrays: np.ndarray
+    hash_family: Optional[HashFamily]
+    hash_cache: Optional[HashCache]
+
+    @abstractmethod
+    def hash_funcs_in_use(self) -> List[Callable[..., int]]:
+        """
+        :return: every hash function that the sketch uses to place keys
+        """
+        return NotImplemented
+
+    def same_hashing(self, other: 'MergeableCounters') -> bool:
+        """
+        Check if another sketch places every key in the same cells as this one
+        :param other: the other sketch
+        :return: True if both sketches use equivalent hash functions
+        """
+        if self.hash_family is not None and other.hash_family is not None:
+            return self.hash_family.spec() == other.hash_family.spec()
+        if self.hash_cache is not None and self.hash_cache is other.hash_cache:
+            return True
+        return (self.hash_funcs_in_use() == other.hash_funcs_in_use() and
+                getattr(self, "salts", None) == getattr(other, "salts", None))
+
+    def counters(self) -> np.ndarray:
+        """
+        :return: the current value of every counter, of shape (width, height)
+        """
+        return self.arrays
+
+    def merge(self, other: 'MergeableCounters') -> None:
+        """
+        Add the counters (and the ground truth, if tracked) of another sketch to this one
+        :param other: the sketch to merge in. It is left unchanged
+        """
+        if type(self) is not type(other) or self.arrays.shape != other.arrays.shape:
+            raise ValueError("Only sketches of the same type and dimensions can be merged")
+        if not self.same_hashing(other):
+            raise ValueError("Only sketches with the same hash functions can be merged")
+        self.merge_counters(other.counters(), other.ground_truth)
+
+    def merge_counters(self, arrays: np.ndarray, ground_truth: Optional[Dict[FlowId, int]] = None) -> None:
+        """
+        Add raw counters to this sketch's counters, without checking how they were hashed. This merges
+        sketches that cannot be compared directly, such as those built by a worker process from the same factory.
+        :param arrays: counters of a sketch with the same dimensions and hash functions
+        :param ground_truth: exact per-key counts of the merged sketch. Required if this sketch tracks ground truth
+        """
+        if arrays.shape != self.arrays.shape:
+            raise ValueError("Only sketches of the same dimensions can be merged")
+        if self.oracle is not None:
+            if ground_truth is None:
+                raise ValueError("Cannot merge a sketch without ground truth into one that tracks it")
+            self.oracle.merge_counts(ground_truth)
+        self.counters()[:] += arrays
+
 
-class CountSketch(HeavyHitterSketch):
-    arrays: List[List[int]]
+class CountSketch(MergeableCounters, HeavyHitterSketch):
+    arrays: np.ndarray  # counters of shape (width, height), int64 unless another dtype is given
     height: int
     width: int
     index_hash_funcs: List[Callable[..., int]]
     sign_hash_funcs: List[Callable[..., int]]
-    ground_truth: Dict[FlowId, int]
+    hash_family: Optional[HashFamily]
+    hash_cache: Optional[HashCache]
 
-    def __init__(self, width: int = 3, height: int = 65536):
+    def __init__(self, width: int = 3, height: int = 65536, hash_cache: Optional[HashCache] = None,
+                 hash_family: Optional[HashFamily] = None, track_ground_truth: bool = True,
+                 dtype: np.dtype = np.int64):
+        """
+        :param width: Number of arrays to use
+        :param height: number of cells in each array
+        :param hash_cache: optional cache of hash outputs, shared with other sketches. Its first `width` functions
+                           are used for indices and the next `width` functions for signs
+        :param hash_family: hash family with at least 2 * `width` rows, split the same way as `hash_cache`.
+                            Defaults to CRC16, unless `hash_cache` is provided
+        :param track_ground_truth: keep exact per-key counts alongside the sketch. See `attach_ground_truth`
+        :param dtype: dtype of the counters. Adding non-integral values to integer counters raises a TypeError
+        """
         self.width = width
         self.height = height
-        self.arrays = [[0] * self.height for _ in range(self.width)]
-        self.index_hash_funcs = [make_crc16_func(polynomial=CRC16_DEFAULT_POLY
-                                                 + (0x100 * i)) for i in range(width)]
-        self.sign_hash_funcs = [make_crc16_func(polynomial=CRC16_DEFAULT_POLY
-                                                + (0x100 * (i + width))) for i in range(width)]
-        self.ground_truth = defaultdict(int)
+        self.arrays = np.zeros((self.width, self.height), dtype=dtype)
+        self.hash_cache = hash_cache
+        self.hash_family = None
+        if hash_cache is None:
+            self.hash_family = Crc16Family(2 * width) if hash_family is None else hash_family
+            assert (self.hash_family.num_rows >= 2 * width)
+            self.index_hash_funcs = self.hash_family.funcs[:width]
+            self.sign_hash_funcs = self.hash_family.funcs[width:2 * width]
+        else:
+            assert (hash_family is None and hash_cache.num_funcs >= 2 * width)
+            self.index_hash_funcs = hash_cache.hash_funcs[:width]
+            self.sign_hash_funcs = hash_cache.hash_funcs[width:2 * width]
+        self.oracle = ExactHeavyHitters() if track_ground_truth else None
 
     def clear(self):
-        self.arrays = [[0] * self.height for _ in range(self.width)]
-        self.ground_truth = defaultdict(int)
+        self.arrays.fill(0)
+        if self.oracle is not None:
+            self.oracle.clear()
 
     def set(self, key: FlowId, set_val: int = 1) -> int:
         # Doesn't make sense for count sketch
@@ -123,68 +511,169 @@ class CountSketch(HeavyHitterSketch):
         :param key: item key
         :return: all values that the item key hashed to
         """
-        return [array[index] * sign for array, index, sign in zip(self.arrays, self.indices(key), self.signs(key))]
+        return [array[index] * sign for array, (index, sign) in zip(self.arrays, self.indices_and_signs(key))]
 
     def get(self, key: FlowId) -> int:
         return median(self.get_all(key))
 
     def add(self, key: FlowId, add_val: int = 1) -> int:
-        self.ground_truth[key] += add_val
+        check_counter_value(add_val, self.arrays.dtype)
+        if self.oracle is not None:
+            self.oracle.add(key, add_val)
         vals = []
-        for index, sign, array in zip(self.indices(key), self.signs(key), self.arrays):
+        for (index, sign), array in zip(self.indices_and_signs(key), self.arrays):
             array[index] += add_val * sign
             val = sign * array[index]
             vals.append(val)
         return median(vals)
 
     def add_after_return(self, key: FlowId, add_val: int = 1) -> int:
-        self.ground_truth[key] += add_val
+        check_counter_value(add_val, self.arrays.dtype)
+        if self.oracle is not None:
+            self.oracle.add(key, add_val)
         vals = []
-        for index, sign, array in zip(self.indices(key), self.signs(key), self.arrays):
+        for (index, sign), array in zip(self.indices_and_signs(key), self.arrays):
             val = array[index] * sign
             array[index] += add_val * sign
             vals.append(val)
         return median(vals)
 
+    def hash_funcs_in_use(self) -> List[Callable[..., int]]:
+        return self.index_hash_funcs + self.sign_hash_funcs
+
     def indices(self, key: FlowId) -> List[int]:
+        if self.hash_cache is not None:
+            return [output % self.height for output in self.hash_cache.hashes(key)[:self.width]]
         return [hash_func(*key) % self.height for hash_func in self.index_hash_funcs]
 
     def signs(self, key: FlowId) -> List[int]:
+        if self.hash_cache is not None:
+            return [(output % 2) * 2 - 1 for output in self.hash_cache.hashes(key)[self.width:2 * self.width]]
         return [(hash_func(*key) % 2) * 2 - 1 for hash_func in self.sign_hash_funcs]
 
+    def indices_and_signs(self, key: FlowId) -> List[Tuple[int, int]]:
+        """
+        Return the (index, sign) pair of every array for the given key, with a single cache lookup if a
+        hash cache is in use.
+        :param key: the key to hash
+        :return: one (index, sign) pair per array
+        """
+        if self.hash_cache is not None:
+            outputs = self.hash_cache.hashes(key)
+            return [(outputs[i] % self.height, (outputs[i + self.width] % 2) * 2 - 1) for i in range(self.width)]
+        return list(zip(self.indices(key), self.signs(key)))
+
+    def indices_and_signs_many(self, keys) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Batch version of `indices_and_signs`. Index and sign hashes are computed in one pass over the keys,
+        vectorized unless a hash cache is in use.
+        :param keys: item keys, as an (n, fields) array or a sequence of FlowId tuples
+        :return: int64 arrays of indices and signs, each of shape (width, n)
+        """
+        if self.hash_family is not None:
+            hashes = self.hash_family.hash_many(keys)[:2 * self.width].astype(np.int64)
+            return hashes[:self.width] % self.height, (hashes[self.width:] % 2) * 2 - 1
+        pairs = np.asarray([self.indices_and_signs(key) for key in as_flow_ids(keys)], dtype=np.int64)
+        pairs = pairs.reshape(-1, self.width, 2)
+        return pairs[:, :, 0].T, pairs[:, :, 1].T
+
+    def get_many(self, keys) -> np.ndarray:
+        """
+        Batch version of `get`.
+        :param keys: item keys, as an (n, fields) array or a sequence of FlowId tuples
+        :return: median of each key's signed counters
+        """
+        indices, signs = self.indices_and_signs_many(keys)
+        return np.median(np.take_along_axis(self.arrays, indices, axis=1) * signs, axis=0)
+
+    def add_many(self, keys, add_vals=1) -> np.ndarray:
+        return self._add_many(keys, add_vals, after_return=False)
+
+    def add_after_return_many(self, keys, add_vals=1) -> np.ndarray:
+        return self._add_many(keys, add_vals, after_return=True)
 
-class CountMinSketch(HeavyHitterSketch):
-    arrays: List[List[int]]
+    def _add_many(self, keys, add_vals, after_return: bool) -> np.ndarray:
+        """
+        Vectorized `add_many` and `add_after_return_many`. Counters are updated with a scatter-add, and each
+        output is computed from running sums within each cell, so the outputs are exactly the medians that
+        sequential `add` or `add_after_return` calls would return.
+        """
+        indices, signs = self.indices_and_signs_many(keys)
+        add_vals = np.broadcast_to(as_counter_values(add_vals, self.arrays.dtype), indices.shape[1])
+        if self.oracle is not None:
+            self.oracle.add_many(keys, add_vals)
+
+        vals = np.empty(indices.shape, dtype=self.arrays.dtype)
+        for row, (array, row_indices, row_signs) in enumerate(zip(self.arrays, indices, signs)):
+            signed_vals = add_vals * row_signs
+            cell_vals = array[row_indices] + grouped_cumsum(row_indices, signed_vals)
+            if after_return:
+                cell_vals -= signed_vals
+            np.add.at(array, row_indices, signed_vals)
+            vals[row] = cell_vals * row_signs
+        return np.median(vals, axis=0)
+
+
+class CountMinSketch(TopKTracking, MergeableCounters, HeavyHitterSketch):
+    arrays: np.ndarray  # counters of shape (width, height), int64 unless another dtype is given
     height: int
     width: int
-    salts: List[int]
+    salts: Optional[List[int]]
     hash_funcs: List[Callable[..., int]]
-    ground_truth: Dict[FlowId, int]
+    hash_family: Optional[HashFamily]
+    hash_cache: Optional[HashCache]
+    conservative_update: bool
 
     def __init__(self, width: int = 3, hash_funcs: Optional[List[Callable[..., int]]] = None,
-                 salts: Optional[List[int]] = None, height: int = 65536):
+                 salts: Optional[List[int]] = None, height: int = 65536, hash_cache: Optional[HashCache] = None,
+                 hash_family: Optional[HashFamily] = None, track_ground_truth: bool = True,
+                 conservative_update: bool = False, track_top_k: int = 0, dtype: np.dtype = np.int64):
         """
         :param width: Number of arrays to use. If `hash_funcs` is provided, the number of funcs is used instead
         :param hash_funcs: callables that take a variable number of integers and output a hash
         :param salts: fixed, additional inputs to each hash function
         :param height: number of cells in each array in the CMS
+        :param hash_cache: optional cache of hash outputs, shared with other sketches. Its first `width` functions
+                           are used instead of `hash_funcs`, without salts
+        :param hash_family: optional hash family, whose first `width` rows are used instead of `hash_funcs`,
+                            without salts. Defaults to CRC16, unless `hash_funcs` or `hash_cache` is provided
+        :param track_ground_truth: keep exact per-key counts alongside the sketch. See `attach_ground_truth`
+        :param conservative_update: only raise the cells of a key that are below its new estimate, instead of
+                                    incrementing every cell. Estimates never exceed those of a regular CMS, but
+                                    additions must be non-negative. Merged sketches still never underestimate,
+                                    but are less accurate than one sketch fed the whole trace
+        :param track_top_k: if positive, track this many keys with the largest estimates. See `top_k`
+        :param dtype: dtype of the counters. Adding non-integral values to integer counters raises a TypeError
         """
         self.height = height
+        self.conservative_update = conservative_update
+        self.hash_cache = hash_cache
+        self.hash_family = None
+        self.salts = None
 
-        if hash_funcs is None:
+        if hash_cache is not None:
+            assert (hash_funcs is None and salts is None and hash_family is None and hash_cache.num_funcs >= width)
             self.width = width
-            self.hash_funcs = [make_crc16_func(polynomial=CRC16_DEFAULT_POLY + (0x100 * i)) for i in range(width)]
+            self.hash_funcs = hash_cache.hash_funcs[:width]
+        elif hash_funcs is None:
+            assert (salts is None)
+            self.hash_family = Crc16Family(width) if hash_family is None else hash_family
+            assert (self.hash_family.num_rows >= width)
+            self.width = width
+            self.hash_funcs = self.hash_family.funcs[:width]
         else:
+            assert (hash_family is None)
             self.width = len(hash_funcs)
             self.hash_funcs = hash_funcs.copy()
-        if salts is None:
-            self.salts = [0] * self.height
-        else:
-            assert (len(salts) == len(hash_funcs))
-            self.salts = salts
+            if salts is None:
+                self.salts = [0] * self.width
+            else:
+                assert (len(salts) == len(hash_funcs))
+                self.salts = salts
 
-        self.arrays = [[0] * self.height for _ in range(self.width)]
-        self.ground_truth = defaultdict(int)
+        self.arrays = np.zeros((self.width, self.height), dtype=dtype)
+        self.oracle = ExactHeavyHitters() if track_ground_truth else None
+        self.top_keys = TopK(track_top_k) if track_top_k > 0 else None
 
     def set(self, key: FlowId, insert_val: int = 1) -> None:
         """
@@ -194,9 +683,13 @@ class CountMinSketch(HeavyHitterSketch):
         :param insert_val: value to set for the given item key.
         :return: None
         """
-        self.ground_truth[key] = insert_val
-        for array, index in zip(self.arrays, self.indices(key)):
+        check_counter_value(insert_val, self.arrays.dtype)
+        if self.oracle is not None:
+            self.oracle.set(key, insert_val)
+        for array, index in zip(self.arrays, self._live_indices(key)):
             array[index] = insert_val
+        if self.top_keys is not None:
+            self.top_keys.offer(key, insert_val)
 
     def add(self, key: FlowId, add_val: int = 1) -> int:
         """
@@ -205,12 +698,19 @@ class CountMinSketch(HeavyHitterSketch):
         :param add_val: value to add to the item's value
         :return: The CMS value for the given item key, after the addition
         """
-        self.ground_truth[key] += add_val
-        smallest = None
-        for array, index in zip(self.arrays, self.indices(key)):
-            val = array[index] + add_val
-            array[index] = val
-            smallest = val if smallest is None or val < smallest else smallest
+        check_counter_value(add_val, self.arrays.dtype)
+        if self.oracle is not None:
+            self.oracle.add(key, add_val)
+        if self.conservative_update:
+            smallest = self._conservative_add(key, add_val) + add_val
+        else:
+            smallest = None
+            for array, index in zip(self.arrays, self._live_indices(key)):
+                val = array[index] + add_val
+                array[index] = val
+                smallest = val if smallest is None or val < smallest else smallest
+        if self.top_keys is not None:
+            self.top_keys.offer(key, smallest)
         return smallest
 
     def add_after_return(self, key: FlowId, add_val: int = 1) -> int:
@@ -222,12 +722,34 @@ class CountMinSketch(HeavyHitterSketch):
         :return: The CMS value for the given item key, before the addition occurred
         """
         # Same as add, but returns the old value before the addition occurred
-        self.ground_truth[key] += add_val
-        smallest = None
-        for array, index in zip(self.arrays, self.indices(key)):
-            val = array[index]
-            array[index] = val + add_val
-            smallest = val if smallest is None or val < smallest else smallest
+        check_counter_value(add_val, self.arrays.dtype)
+        if self.oracle is not None:
+            self.oracle.add(key, add_val)
+        if self.conservative_update:
+            smallest = self._conservative_add(key, add_val)
+        else:
+            smallest = None
+            for array, index in zip(self.arrays, self._live_indices(key)):
+                val = array[index]
+                array[index] = val + add_val
+                smallest = val if smallest is None or val < smallest else smallest
+        if self.top_keys is not None:
+            self.top_keys.offer(key, smallest + add_val)
+        return smallest
+
+    def _conservative_add(self, key: FlowId, add_val: int) -> int:
+        """
+        Conservative update: raise every cell of `key` to at least its new estimate
+        :return: the estimate before the addition
+        """
+        if add_val < 0:
+            raise ValueError("Conservative update only supports non-negative additions")
+        indices = self._live_indices(key)
+        smallest = min(array[index] for array, index in zip(self.arrays, indices))
+        estimate = smallest + add_val
+        for array, index in zip(self.arrays, indices):
+            if array[index] < estimate:
+                array[index] = estimate
         return smallest
 
     def get(self, key: FlowId) -> int:
@@ -236,11 +758,14 @@ class CountMinSketch(HeavyHitterSketch):
         :param key: item key
         :return: CMS value ie the min of all values the item key hashes to
         """
-        return min(array[index] for array, index in zip(self.arrays, self.indices(key)))
+        return min(array[index] for array, index in zip(self.arrays, self._live_indices(key)))
 
     def clear(self):
-        self.arrays = [[0] * self.height for _ in range(self.width)]
-        self.ground_truth.clear()
+        self.arrays.fill(0)
+        if self.oracle is not None:
+            self.oracle.clear()
+        if self.top_keys is not None:
+            self.top_keys.clear()
 
     def subtract(self, key: FlowId, sub_val: int) -> int:
         """
@@ -257,7 +782,10 @@ class CountMinSketch(HeavyHitterSketch):
         :param key: item key
         :return: all values that the item key hashed to
         """
-        return [array[index] for array, index in zip(self.arrays, self.indices(key))]
+        return [array[index] for array, index in zip(self.arrays, self._live_indices(key))]
+
+    def hash_funcs_in_use(self) -> List[Callable[..., int]]:
+        return self.hash_funcs
 
     def indices(self, key: FlowId) -> List[int]:
         """
@@ -265,9 +793,175 @@ class CountMinSketch(HeavyHitterSketch):
         :param key: the key to hash
         :return: a tuple of array indices
         """
+        if self.hash_cache is not None:
+            return [output % self.height for output in self.hash_cache.hashes(key)[:self.width]]
+        if self.salts is None:
+            return [hash_func(*key) % self.height for hash_func in self.hash_funcs]
         return [hash_func(*key, salt) % self.height
                      for hash_func, salt in zip(self.hash_funcs, self.salts)]
 
+    def indices_many(self, keys) -> np.ndarray:
+        """
+        Batch version of `indices`. Vectorized if the CMS uses a hash family.
+        :param keys: item keys, as an (n, fields) array or a sequence of FlowId tuples
+        :return: int64 array of shape (width, n)
+        """
+        if self.hash_family is not None:
+            return self.hash_family.hash_many(keys)[:self.width].astype(np.int64) % self.height
+        indices = np.asarray([self.indices(key) for key in as_flow_ids(keys)], dtype=np.int64)
+        return indices.reshape(-1, self.width).T
+
+    def _live_indices(self, key: FlowId) -> List[int]:
+        """
+        `indices`, for cells that are about to be accessed. Subclasses that reset cells lazily refresh them here.
+        """
+        return self.indices(key)
+
+    def _live_indices_many(self, keys) -> np.ndarray:
+        """
+        Batch version of `_live_indices`
+        """
+        return self.indices_many(keys)
+
+    def get_many(self, keys) -> np.ndarray:
+        """
+        Batch version of `get`.
+        :param keys: item keys, as an (n, fields) array or a sequence of FlowId tuples
+        :return: CMS values
+        """
+        indices = self._live_indices_many(keys)
+        return np.min(np.take_along_axis(self.arrays, indices, axis=1), axis=0)
+
+    def add_many(self, keys, add_vals=1) -> np.ndarray:
+        return self._add_many(keys, add_vals, after_return=False)
+
+    def add_after_return_many(self, keys, add_vals=1) -> np.ndarray:
+        return self._add_many(keys, add_vals, after_return=True)
+
+    def _add_many(self, keys, add_vals, after_return: bool) -> np.ndarray:
+        """
+        Vectorized `add_many` and `add_after_return_many`. Duplicate cells in the batch are handled by running
+        sums within each cell, so the outputs are exactly those of sequential `add` or `add_after_return` calls.
+        """
+        indices = self._live_indices_many(keys)
+        num_keys = indices.shape[1]
+        add_vals = np.broadcast_to(as_counter_values(add_vals, self.arrays.dtype), num_keys)
+        if self.oracle is not None:
+            self.oracle.add_many(keys, add_vals)
+        if self.conservative_update:
+            smallest = self._conservative_add_many(indices, add_vals) + add_vals
+        else:
+            smallest = None
+            for array, row_indices in zip(self.arrays, indices):
+                vals = array[row_indices] + grouped_cumsum(row_indices, add_vals)
+                np.add.at(array, row_indices, add_vals)
+                smallest = vals if smallest is None else np.minimum(smallest, vals)
+        if self.top_keys is not None:
+            self.top_keys.offer_many(as_flow_ids(keys), smallest)
+        return smallest - add_vals if after_return else smallest
+
+    def _conservative_add_many(self, indices: np.ndarray, add_vals: np.ndarray) -> np.ndarray:
+        """
+        Batch version of `_conservative_add`. Each addition depends upon the cells left by earlier additions, so
+        the batch is replayed in order, but only over plain lists of the cells that the batch touches.
+        The result is identical to sequential `add` calls.
+        :return: the estimate of every key before its addition
+        """
+        if np.any(add_vals < 0):
+            raise ValueError("Conservative update only supports non-negative additions")
+        touched = []
+        cells = []
+        positions = []
+        for array, row_indices in zip(self.arrays, indices):
+            row_touched, row_positions = np.unique(row_indices, return_inverse=True)
+            touched.append(row_touched)
+            cells.append(array[row_touched].tolist())
+            positions.append(row_positions.reshape(-1))
+
+        smallest = []
+        for key_positions, add_val in zip(np.stack(positions, axis=1).tolist(), add_vals.tolist()):
+            key_smallest = min(row_cells[position] for row_cells, position in zip(cells, key_positions))
+            estimate = key_smallest + add_val
+            for row_cells, position in zip(cells, key_positions):
+                if row_cells[position] < estimate:
+                    row_cells[position] = estimate
+            smallest.append(key_smallest)
+
+        for array, row_touched, row_cells in zip(self.arrays, touched, cells):
+            array[row_touched] = row_cells
+        return np.asarray(smallest, dtype=self.arrays.dtype)
+
+
+class EpochCountMinSketch(CountMinSketch):
+    """
+    CMS with a constant-time `clear`, for experiments that reset the sketch every (possibly very short) epoch.
+    Every cell is tagged with the epoch in which it was last accessed. Clearing starts a new epoch, and cells
+    tagged with an older epoch are reset to zero the next time they are accessed.
+    """
+    epochs: np.ndarray  # int64 array of shape (width, height)
+    epoch: int
+
+    def __init__(self, *args, **kwargs):
+        """
+        Takes the same arguments as `CountMinSketch`
+        """
+        super().__init__(*args, **kwargs)
+        self.epochs = np.zeros(self.arrays.shape, dtype=np.int64)
+        self.epoch = 0
+
+    def clear(self):
+        self.epoch += 1
+        if self.oracle is not None:
+            self.oracle.clear()
+        if self.top_keys is not None:
+            self.top_keys.clear()
+
+    def _live_indices(self, key: FlowId) -> List[int]:
+        indices = self.indices(key)
+        epoch = self.epoch
+        for array, tags, index in zip(self.arrays, self.epochs, indices):
+            if tags[index] != epoch:
+                array[index] = 0
+                tags[index] = epoch
+        return indices
+
+    def _live_indices_many(self, keys) -> np.ndarray:
+        indices = self.indices_many(keys)
+        rows = np.broadcast_to(np.arange(self.width)[:, np.newaxis], indices.shape)
+        stale = self.epochs[rows, indices] != self.epoch
+        if stale.any():
+            self.arrays[rows[stale], indices[stale]] = 0
+            self.epochs[rows[stale], indices[stale]] = self.epoch
+        return indices
+
+    # Queries read stale cells as zero instead of resetting them, so they never write to the counters,
+    # eg. those of a snapshot loaded read-only
+
+    def get(self, key: FlowId) -> int:
+        return min(self.get_all(key))
+
+    def get_all(self, key: FlowId) -> List[int]:
+        epoch = self.epoch
+        return [array[index] if tags[index] == epoch else 0
+                for array, tags, index in zip(self.arrays, self.epochs, self.indices(key))]
+
+    def get_many(self, keys) -> np.ndarray:
+        indices = self.indices_many(keys)
+        vals = np.take_along_axis(self.arrays, indices, axis=1)
+        vals[np.take_along_axis(self.epochs, indices, axis=1) != self.epoch] = 0
+        return np.min(vals, axis=0)
+
+    def compact(self) -> None:
+        """
+        Reset every stale cell now, so that `arrays` holds the current counters. Takes time linear in the sketch size.
+        """
+        self.arrays[self.epochs != self.epoch] = 0
+        self.epochs.fill(self.epoch)
+
+    def counters(self) -> np.ndarray:
+        self.compact()
+        return self.arrays
+
 
 def test_cms():
     print("Check 1")
@@ -290,54 +984,176 @@ def test_cms():
         if val1 != val2 or val2 + add_val != val3:
             print("CMS `return_then_add` messed up")
             exit(1)
+
+    print("Check 3")
+    batch_cms = CountMinSketch(height=1024)
+    sequential_cms = CountMinSketch(height=1024)
+    keys = [(0, random.randint(0, 1000)) for _ in range(10000)]
+    add_vals = [random.randint(0, 5) for _ in keys]
+    batch_vals = batch_cms.add_many(keys, add_vals)
+    sequential_vals = [sequential_cms.add(key, add_val) for key, add_val in zip(keys, add_vals)]
+    if list(batch_vals) != sequential_vals or not np.array_equal(batch_cms.arrays, sequential_cms.arrays):
+        print("CMS `add_many` messed up")
+        exit(1)
+
+    print("Check 4")
+    epoch_cms = EpochCountMinSketch(height=1024)
+    cms = CountMinSketch(height=1024)
+    probe_keys = [(0, key_id) for key_id in range(0, 1000, 7)]
+    for epoch in range(20):
+        if not np.array_equal(epoch_cms.get_many(probe_keys), cms.get_many(probe_keys)):
+            print("Epoch CMS `get_many` messed up")
+            exit(1)
+        keys = [(0, random.randint(0, 1000)) for _ in range(random.randint(0, 500))]
+        add_vals = [random.randint(0, 5) for _ in keys]
+        if epoch % 2 == 0:
+            epoch_vals = list(epoch_cms.add_many(keys, add_vals))
+        else:
+            epoch_vals = [epoch_cms.add(key, add_val) for key, add_val in zip(keys, add_vals)]
+        vals = [cms.add(key, add_val) for key, add_val in zip(keys, add_vals)]
+        if epoch_vals != vals or not np.array_equal(epoch_cms.counters(), cms.arrays):
+            print("Epoch CMS messed up")
+            exit(1)
+        epoch_cms.clear()
+        cms.clear()
+
+    print("Check 5")
+    batch_cms = CountMinSketch(height=256, conservative_update=True)
+    sequential_cms = CountMinSketch(height=256, conservative_update=True)
+    cms = CountMinSketch(height=256)
+    keys = [(0, random.randint(0, 1000)) for _ in range(10000)]
+    add_vals = [random.randint(0, 5) for _ in keys]
+    batch_vals = batch_cms.add_many(keys, add_vals)
+    sequential_vals = [sequential_cms.add(key, add_val) for key, add_val in zip(keys, add_vals)]
+    cms.add_many(keys, add_vals)
+    if list(batch_vals) != sequential_vals or not np.array_equal(batch_cms.arrays, sequential_cms.arrays):
+        print("Conservative-update CMS `add_many` messed up")
+        exit(1)
+    for key in set(keys):
+        if not batch_cms.ground_truth[key] <= batch_cms.get(key) <= cms.get(key):
+            print("Conservative-update CMS estimates messed up")
+            exit(1)
+
+    print("Check 6")
+    batch_cms = CountMinSketch(height=256, track_top_k=10)
+    sequential_cms = CountMinSketch(height=256, track_top_k=10)
+    keys = [(0, int(key_id)) for key_id in np.random.default_rng(SEED).zipf(1.3, 10000) % 5000]
+    batch_cms.add_many(keys, 1)
+    for key in keys:
+        sequential_cms.add(key)
+    if (batch_cms.top_k() != sequential_cms.top_k() or
+            any(estimate < batch_cms.ground_truth[key] for key, estimate in batch_cms.top_k())):
+        print("CMS top-k messed up")
+        exit(1)
+
+    # few distinct counts, so that many estimates tie at the threshold
+    tied_keys = [(0, int(key_id)) for key_id in np.random.default_rng(SEED).integers(0, 50, 2000)]
+    counts = defaultdict(int)
+    tied_estimates = []
+    for key in tied_keys:
+        counts[key] += 1
+        tied_estimates.append(counts[key] // 8)
+    batch_top_k = TopK(5)
+    sequential_top_k = TopK(5)
+    for start in range(0, len(tied_keys), 100):
+        batch_top_k.offer_many(tied_keys[start:start + 100], tied_estimates[start:start + 100])
+    for key, estimate in zip(tied_keys, tied_estimates):
+        sequential_top_k.offer(key, estimate)
+    # the same estimates must be kept, and the same keys above the threshold, where there are no ties
+    above_threshold = [{pair for pair in top_k.top_k() if pair[1] > top_k.threshold()}
+                       for top_k in (batch_top_k, sequential_top_k)]
+    if (sorted(pair[1] for pair in batch_top_k.top_k()) != sorted(pair[1] for pair in sequential_top_k.top_k())
+            or above_threshold[0] != above_threshold[1]):
+        print("TopK `offer_many` messed up")
+        exit(1)
+
+    print("Check 7")
+    float_cms = CountMinSketch(height=256, dtype=np.float64)
+    add_vals = [random.random() for _ in keys]
+    batch_vals = float_cms.add_many(keys, add_vals)
+    if not np.allclose(batch_vals[-1], float_cms.get(keys[-1])) or float_cms.get(keys[-1]) < sum(
+            add_val for key, add_val in zip(keys, add_vals) if key == keys[-1]) - 1e-9:
+        print("Floating-point CMS messed up")
+        exit(1)
+    for add in (lambda: cms.add(keys[0], 0.5), lambda: cms.add_many(keys[:2], [1, 0.5])):
+        try:
+            add()
+            print("CMS truncated a non-integral addition")
+            exit(1)
+        except TypeError:
+            pass
+    exact = ExactHeavyHitters()
+    if exact.add_after_return_many([(1,), (1,)], [1.5, 2]).tolist() != [0, 1.5] or exact.get((1,)) != 3.5:
+        print("Exact `add_after_return_many` truncated fractional additions")
+        exit(1)
     print("CMS didn't mess up")
 
 
-def compare_accuracy(zipfian=True, zipf_exponent=1.2):
-    cs = CountSketch()
-    cms = CountMinSketch()
-    ground_truth: Dict[FlowId, int] = defaultdict(int)
+def sketch_label(struct: HeavyHitterSketch) -> str:
+    """
+    :return: the type and dimensions of a sketch, for printing experiment results
+    """
+    label = type(struct).__name__
+    if getattr(struct, "conservative_update", False):
+        label += " (CU)"
+    if hasattr(struct, "arrays"):
+        label += " %dx%d" % struct.arrays.shape
+    return label
+
+
+def compare_accuracy(zipfian=True, zipf_exponent=1.2, num_packets=100000,
+                     structs: Optional[List[HeavyHitterSketch]] = None, streaming: bool = False):
+    """
+    Feed the same random trace to several sketches and print quantiles of their absolute errors,
+    normalized to the L2 norm of the true counts
+    :param structs: the sketches to compare, which should not track ground truth. Defaults to a CS and a CMS
+    :param streaming: summarize errors with a KLL sketch instead of exactly, to bound memory for huge key sets
+    """
+    if structs is None:
+        # ground truth is computed below, without per-flow dictionaries
+        structs = [CountSketch(track_ground_truth=False), CountMinSketch(track_ground_truth=False)]
 
     # random keys and random updates
 
-    random.seed(SEED)
     rng = np.random.default_rng(SEED)
-    num_packets = 100000
-    packet_ids: List[int]
+    packet_ids: np.ndarray
     if zipfian:
         print("%d zipfian packets" % num_packets)
-        packet_ids = [int(num) for num in rng.zipf(a=zipf_exponent, size=num_packets)]
+        packet_ids = rng.zipf(a=zipf_exponent, size=num_packets)
     else:
         print("%d uniform packets" % num_packets)
-        packet_ids = [random.randint(0, 100000) for _ in range(num_packets)]
-    for packet_id in packet_ids:
-        key = (0, packet_id * 23)  # scale the packetIDs to spread them out a little
-        add_val = random.randint(20, 100)
-        ground_truth[key] += add_val
-        cs.add(key=key, add_val=add_val)
-        cms.add(key=key, add_val=add_val)
-
-    for struct in [cs, cms]:
-        # compute the relative error for each key seen
-        l1_norm = sum(ground_truth.values())
-        l2_norm = math.sqrt(sum(math.pow(val, 2) for val in ground_truth.values()))
-        errors_l1 = []
-        errors_l2 = []
-        for key, true_val in ground_truth.items():
-            approx_val = struct.get(key)
-            errors_l1.append(abs(approx_val) / l1_norm)
-            errors_l2.append(abs(approx_val) / l2_norm)
-        errors_l1.sort()
-        errors_l2.sort()
+        packet_ids = rng.integers(0, 100000, size=num_packets, endpoint=True)
+    # scale the packetIDs to spread them out a little
+    keys = np.stack([np.zeros(num_packets, dtype=np.uint64), packet_ids.astype(np.uint64) * np.uint64(23)], axis=1)
+    add_vals = rng.integers(20, 100, size=num_packets, endpoint=True)
+
+    unique_keys, key_ids = np.unique(keys, axis=0, return_inverse=True)
+    ground_truth = np.bincount(key_ids.reshape(-1), weights=add_vals).astype(np.int64)
 
+    # compute the relative error for each key seen
+    norm = l2_norm(ground_truth)
+    for struct in structs:
+        struct.add_many(keys, add_vals)
+        summary = KllSketch(seed=SEED) if streaming else None
         # print quantiles for error normalized to the l2 norm
-        print("%14s error quantiles --" % type(struct).__name__, end=" ")
-        for quantile in [0.5, 0.9, 0.95, 0.99]:
-            quant_err = errors_l2[int(len(errors_l2) * quantile)]
-            print("\t%d%%: %.2f%%," % (int(quantile * 100), quant_err * 100), end=" ")
-        print("")
+        print_error_quantiles(sketch_label(struct),
+                              error_quantiles(struct, unique_keys, ground_truth, norm=norm, summary=summary))
+
+
+def compare_conservative_update(zipf_exponent=1.2, num_packets=100000, height: int = 2048):
+    """
+    Compare a CMS of the given height against conservative-update sketches of the same and of half the height,
+    eg. to decide if conservative update would let the data plane halve CMS_HEIGHT
+    """
+    compare_accuracy(zipf_exponent=zipf_exponent, num_packets=num_packets,
+                     structs=[CountMinSketch(height=height, track_ground_truth=False),
+                              CountMinSketch(height=height, track_ground_truth=False, conservative_update=True),
+                              CountMinSketch(height=height // 2, track_ground_truth=False),
+                              CountMinSketch(height=height // 2, track_ground_truth=False,
+                                             conservative_update=True)])
 
 
 if __name__ == "__main__":
     test_cms()
     compare_accuracy()
+    compare_conservative_update()
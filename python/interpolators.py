@@ -5,6 +5,8 @@ from matplotlib import pyplot as plt
 from numpy import uint16
 import math
 
+from accuracy import exact_quantiles
+
 
 class ThresholdInterpolator(ABC):
     @abstractmethod
@@ -99,12 +101,9 @@ class TofinoThresholdInterpolator(ThresholdInterpolator):
 
 def print_quantiles(vals: List[float]):
     quantiles = [0.5, 0.9, 0.95, 0.99, 0.995, 0.999]
-    vals_copy = vals.copy()
-    vals_copy.sort()
-    n = len(vals)
     print("Quantiles -- ", end="")
-    for q in quantiles:
-        print("%.3f: %.3f" % (q, vals_copy[int(n * q)]), end="")
+    for q, val in zip(quantiles, exact_quantiles(vals, quantiles)):
+        print("%.3f: %.3f" % (q, val), end="")
     print("")
 
 
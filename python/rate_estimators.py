@@ -1,36 +1,385 @@
-import random
 from abc import ABC, abstractmethod
-from collections import defaultdict
-from collections import deque as Queue
-from statistics import mean
-from typing import List, Callable, Tuple, Dict, Optional, Collection
+from bisect import bisect_right
+from functools import lru_cache
+from typing import List, Callable, Tuple, Dict, Optional, Collection, Sequence, Union
 
+import itertools
 import math
+import time
 import numpy as np
 from matplotlib import pyplot as plt
 from matplotlib.axes import Axes
 
-from common import FlowId, Packet, SEED, LPF_DECAY, LPF_SCALE
-from hashing import make_crc16_func, CRC16_DEFAULT_POLY
-from heavy_hitters import CountMinSketch
+from accuracy import exact_quantiles, print_error_quantiles
+from common import FlowId, Packet, PacketBatch, SEED, LPF_DECAY, LPF_SCALE, as_packet_batch, uniform_packet_batch, \
+    zipf_packet_batch
+from hashing import make_crc16_func, crc16_polynomials, crc16_many, crc16_rows, HashCache, as_key_array
+from heavy_hitters import CountMinSketch, TopK, TopKTracking, as_flow_ids, grouped_cumsum
+
+
+LPF_CELL_BYTES = 8  # a 32-bit value and a 32-bit timestamp
+
+
+class DecayTable:
+    """
+    LPF decay factors e^{-dt / time_constant}, looked up by time delta instead of computed on every update.
+    Tables are shared by every LPF with the same parameters, see `decay_table`.
+    Without quantization, entry i is the factor of a delta of exactly i, the same factor that `compute_rate_lpf`
+    would compute. Deltas that are not integers or are beyond the table fall back to computing the factor.
+    With quantization, deltas are rounded down to a multiple of 2^quantum_bits before decaying, like the hardware
+    LPF, which only sees the high bits of the time delta. Deltas beyond the table are quantized the same way.
+    """
+    TABLE_SIZE = 1 << 16
+
+    time_constant: np.uint64
+    quantum_bits: Optional[int]
+    size: int
+    table: np.ndarray  # float64 factor of every quantized delta
+    entries: List[float]  # the same factors, for fast scalar lookups
+
+    def __init__(self, time_constant: np.uint64, quantum_bits: Optional[int] = None, size: int = TABLE_SIZE):
+        """
+        :param time_constant: LPF decay time constant
+        :param quantum_bits: log2 of the delta quantization step, or None to not quantize deltas
+        :param size: number of table entries
+        """
+        self.time_constant = time_constant
+        self.quantum_bits = quantum_bits
+        self.size = size
+        deltas = np.arange(size, dtype=np.float64) * self.step()
+        self.table = np.power(np.e, -deltas / time_constant)
+        self.entries = self.table.tolist()
+
+    def step(self) -> int:
+        """
+        :return: the delta quantization step
+        """
+        return 1 if self.quantum_bits is None else 1 << self.quantum_bits
+
+    def factor(self, elapsed) -> np.float64:
+        """
+        :param elapsed: non-negative time delta
+        :return: the decay factor for the delta
+        """
+        index = int(elapsed) >> (self.quantum_bits or 0)
+        if self.quantum_bits is None:
+            if index == elapsed and index < self.size:
+                return self.entries[index]
+            return np.power(np.e, -np.float64(elapsed) / self.time_constant)
+        if index < self.size:
+            return self.entries[index]
+        return np.power(np.e, -np.float64(index << self.quantum_bits) / self.time_constant)
+
+    def factors(self, elapsed: np.ndarray) -> np.ndarray:
+        """
+        Vectorized `factor`, with identical results
+        :param elapsed: non-negative time deltas
+        :return: the decay factor of every delta
+        """
+        elapsed = np.asarray(elapsed, dtype=np.float64)
+        if self.quantum_bits is None:
+            indices = elapsed.astype(np.int64)
+            in_table = (indices == elapsed) & (indices < self.size)
+        else:
+            indices = np.floor(elapsed / self.step()).astype(np.int64)
+            elapsed = indices * np.float64(self.step())
+            in_table = indices < self.size
+        factors = np.empty(len(elapsed))
+        factors[in_table] = self.table[indices[in_table]]
+        factors[~in_table] = np.power(np.e, -elapsed[~in_table] / self.time_constant)
+        return factors
+
+
+@lru_cache(maxsize=None)
+def decay_table(time_constant: np.uint64, quantum_bits: Optional[int] = None) -> DecayTable:
+    """
+    The decay table shared by every LPF with the given parameters. See `DecayTable`
+    """
+    return DecayTable(time_constant, quantum_bits)
 
 
 def compute_rate_lpf(prev_lpf_val: np.uint64, curr_sample: np.uint64,
-                     prev_timestamp: np.uint64, curr_timestamp: np.uint64, time_constant: np.uint64) -> np.uint64:
-    """ Based upon tofino LPF rate mode documentation """
-    exponent = -(curr_timestamp - prev_timestamp) / time_constant
+                     prev_timestamp: np.uint64, curr_timestamp: np.uint64, time_constant: np.uint64,
+                     decay: Optional[DecayTable] = None) -> np.uint64:
+    """ Based upon tofino LPF rate mode documentation. Decay factors come from `decay`, if given """
     if curr_timestamp < prev_timestamp:
         raise Exception("LPF inputs cannot age backwards")
+    if decay is not None:
+        return curr_sample + prev_lpf_val * decay.factor(curr_timestamp - prev_timestamp)
+    # convert before negating, unsigned timestamps would wrap around
+    exponent = -np.float64(curr_timestamp - prev_timestamp) / time_constant
     return curr_sample + prev_lpf_val * np.power(np.e, exponent)
 
 
-"""
-class FlowHistory(defaultdict):
-    def __missing__(self, key) -> Tuple[int, Queue[Tuple[int, int]]]:
-        new_val: Tuple[int, Queue[Tuple[int, int]]] = (key, Queue())
-        self[key] = new_val
-        return new_val
-"""
+def merge_lpf_values(timestamps_a, values_a, timestamps_b, values_b, time_constant: np.uint64):
+    """
+    Combine the states of two LPFs that were fed disjoint samples into the state of one LPF fed all the samples.
+    An LPF's value at its last sample time is the sum of every sample decayed by its age, so both values are
+    decayed to the later timestamp and summed. Accepts scalars or arrays of cells.
+    :return: merged (timestamps, values)
+    """
+    timestamps = np.maximum(timestamps_a, timestamps_b)
+    values = (values_a * np.power(np.e, -np.float64(timestamps - timestamps_a) / time_constant) +
+              values_b * np.power(np.e, -np.float64(timestamps - timestamps_b) / time_constant))
+    return timestamps, values
+
+
+class FlowInterner:
+    """
+    Numbers flow keys 0, 1, 2, ... in order of first appearance, so that per-flow state can be kept in arrays
+    indexed by flow number instead of in dictionaries. The numbers of released flows are handed out again.
+    """
+    ids: Dict[FlowId, int]
+    keys: List[Optional[FlowId]]  # key of every flow number, None if the number is free
+    free_ids: List[int]
+
+    def __init__(self):
+        self.ids = {}
+        self.keys = []
+        self.free_ids = []
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, key: FlowId) -> bool:
+        return key in self.ids
+
+    def capacity(self) -> int:
+        """
+        :return: one more than the largest flow number handed out so far
+        """
+        return len(self.keys)
+
+    def intern(self, key: FlowId) -> int:
+        """
+        :return: the number of a flow, numbering it if it is new
+        """
+        flow = self.ids.get(key)
+        if flow is None:
+            if self.free_ids:
+                flow = self.free_ids.pop()
+                self.keys[flow] = key
+            else:
+                flow = len(self.keys)
+                self.keys.append(key)
+            self.ids[key] = flow
+        return flow
+
+    def intern_many(self, keys) -> np.ndarray:
+        """
+        Batch version of `intern`
+        :param keys: flow keys, as an (n, fields) array or a sequence of FlowId tuples
+        :return: int32 array with the number of every flow
+        """
+        ids = self.ids
+        return np.fromiter((ids[key] if key in ids else self.intern(key) for key in as_flow_ids(keys)),
+                           dtype=np.int32)
+
+    def find(self, key: FlowId) -> int:
+        """
+        :return: the number of a flow, or -1 if it has none
+        """
+        return self.ids.get(key, -1)
+
+    def find_many(self, keys) -> np.ndarray:
+        """
+        Batch version of `find`
+        :return: int32 array with the number of every flow, -1 for unknown flows
+        """
+        ids = self.ids
+        return np.fromiter((ids.get(key, -1) for key in as_flow_ids(keys)), dtype=np.int32)
+
+    def release_many(self, flows: np.ndarray) -> None:
+        """
+        Forget flows, so that their numbers can be handed out to new flows
+        :param flows: numbers of the flows to forget
+        """
+        for flow in flows.tolist():
+            del self.ids[self.keys[flow]]
+            self.keys[flow] = None
+            self.free_ids.append(flow)
+
+    def live_flows(self) -> Tuple[List[FlowId], np.ndarray]:
+        """
+        :return: the key and the int32 number of every flow that has not been released
+        """
+        return list(self.ids.keys()), np.fromiter(self.ids.values(), dtype=np.int32, count=len(self.ids))
+
+
+def dense_flow_ids(flow_keys: Sequence[FlowId]) -> np.ndarray:
+    """
+    Number flows 0, 1, 2, ... in order of first appearance
+    :param flow_keys: flow key of every packet
+    :return: int64 array with the flow number of every packet
+    """
+    return FlowInterner().intern_many(flow_keys).astype(np.int64)
+
+
+def _segmented_cumsum(values: np.ndarray, starts: np.ndarray, sizes: np.ndarray,
+                      max_vectorized_size: int = 64) -> np.ndarray:
+    """
+    Running sums that restart at every segment. Unlike subtracting a global running sum, this never cancels large
+    floating point totals, so small segments keep their precision.
+    :param values: values, with every segment contiguous
+    :param starts: start position of every segment
+    :param sizes: length of every segment
+    :param max_vectorized_size: segments up to this long are summed one rank at a time across all segments,
+                                longer ones one segment at a time
+    :return: inclusive running sums
+    """
+    result = np.empty_like(values)
+    small = sizes <= max_vectorized_size
+    small_starts = starts[small]
+    small_sizes = sizes[small]
+    running = np.zeros(len(small_starts))
+    for rank in range(int(small_sizes.max(initial=0))):
+        active = small_sizes > rank
+        positions = small_starts[active] + rank
+        running[active] += values[positions]
+        result[positions] = running[active]
+    for start, size in zip(starts[~small].tolist(), sizes[~small].tolist()):
+        np.cumsum(values[start:start + size], out=result[start:start + size])
+    return result
+
+
+def exact_lpf_rates(flow_ids: np.ndarray, timestamps, values, time_constant: np.uint64, scale: int = 0,
+                    block_size: int = 64) -> np.ndarray:
+    """
+    Vectorized equivalent of feeding a whole trace to an empty `LpfExactRegister`, one packet at a time.
+    A flow's LPF value after its i-th packet is sum_{j <= i} s_j * e^{-(t_i - t_j) / tau}
+    = e^{-(t_i - T) / tau} * sum_{j <= i} s_j * e^{(t_j - T) / tau} for any reference time T, ie. a rescaled
+    cumulative sum. To keep the exponentials in range, time is split into blocks of `block_size` time constants,
+    and each (flow, block) group uses its block start as T. The value a flow carries into a block is its previous
+    group's total, decayed to the block start.
+    Results match the sequential register to within floating point rounding, not bit for bit.
+    :param flow_ids: integer flow ID of every packet, eg. from `dense_flow_ids`
+    :param timestamps: packet timestamps, non-decreasing within every flow
+    :param values: packet values, eg. sizes
+    :param time_constant: LPF decay time constant
+    :param scale: LPF output scale-down factor
+    :param block_size: length of the renormalization blocks, in time constants. e^block_size must fit in a float64
+    :return: LPF output after every packet, in trace order
+    """
+    flow_ids = np.asarray(flow_ids)
+    num_packets = len(flow_ids)
+    if num_packets == 0:
+        return np.empty(0)
+    order = np.argsort(flow_ids, kind="stable")
+    flows = flow_ids[order]
+    times = np.asarray(timestamps, dtype=np.float64)[order]
+    samples = np.asarray(values, dtype=np.float64)[order]
+
+    flow_starts = np.empty(num_packets, dtype=bool)
+    flow_starts[0] = True
+    flow_starts[1:] = flows[1:] != flows[:-1]
+    # the registers start at timestamp 0
+    if np.any(times[flow_starts] < 0) or np.any(np.diff(times)[~flow_starts[1:]] < 0):
+        raise Exception("LPF inputs cannot age backwards")
+
+    block_span = block_size * np.float64(time_constant)
+    blocks = np.floor(times / block_span)
+    group_starts = flow_starts.copy()
+    group_starts[1:] |= blocks[1:] != blocks[:-1]
+    group_ids = np.cumsum(group_starts) - 1
+    group_positions = np.flatnonzero(group_starts)
+    group_sizes = np.diff(np.append(group_positions, num_packets))
+    references = blocks[group_positions] * block_span
+
+    relative_times = (times - references[group_ids]) / np.float64(time_constant)
+    sums = _segmented_cumsum(samples * np.exp(relative_times), group_positions, group_sizes)
+
+    # value carried into every group, at its reference time: carry_g = e^{-(T_g - T_{g-1}) / tau} * (carry_{g-1} +
+    # total_{g-1}) within a flow. Evaluated one group rank at a time across all flows
+    num_groups = len(group_positions)
+    totals = sums[group_positions + group_sizes - 1]
+    carries = np.zeros(num_groups)
+    first_groups = flow_starts[group_positions]
+    group_ranks = np.arange(num_groups) - np.maximum.accumulate(np.where(first_groups, np.arange(num_groups), 0))
+    by_rank = np.argsort(group_ranks, kind="stable")
+    rank_bounds = np.searchsorted(group_ranks[by_rank], np.arange(group_ranks.max() + 2))
+    for rank in range(1, group_ranks.max() + 1):
+        groups = by_rank[rank_bounds[rank]:rank_bounds[rank + 1]]
+        decays = np.exp(-(references[groups] - references[groups - 1]) / np.float64(time_constant))
+        carries[groups] = decays * (carries[groups - 1] + totals[groups - 1])
+
+    sorted_rates = np.exp(-relative_times) * (carries[group_ids] + sums)
+    rates = np.empty(num_packets)
+    rates[order] = sorted_rates
+    return rates / (2 ** np.uint64(scale))
+
+
+def lpf_update_cells(cell_timestamps: np.ndarray, cell_values: np.ndarray, indices: np.ndarray, timestamps, values,
+                     decay: DecayTable, min_wavefront_cells: int = 64) -> np.ndarray:
+    """
+    Apply a batch of samples to an array of LPF cells, in place. The batch is stably sorted by cell, so that every
+    cell's samples are contiguous and in arrival order. The LPF recurrence v = sample + v * decay is then evaluated
+    for all cells at once: step r updates the r-th sample of every cell that has one. Once few cells have samples
+    left, the heaviest cells are finished one sample at a time. Every output goes through the same floating point
+    operations as sequential `compute_rate_lpf` calls, so the results are identical.
+    :param cell_timestamps: float64 timestamp of the last sample of every cell
+    :param cell_values: float64 LPF value of every cell
+    :param indices: cell index of every sample
+    :param timestamps: sample timestamps, non-decreasing within every cell
+    :param values: sample values
+    :param decay: decay factors of the LPFs
+    :param min_wavefront_cells: below this many cells with samples left, finish the batch one sample at a time
+    :return: unscaled LPF output after every update, in arrival order
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    num_samples = len(indices)
+    if num_samples == 0:
+        return np.empty(0)
+    # stable sorts of 16-bit integers are radix sorts
+    order = np.argsort(indices.astype(np.uint16) if len(cell_values) <= 1 << 16 else indices, kind="stable")
+    cells = indices[order]
+    sorted_timestamps = np.asarray(timestamps, dtype=np.float64)[order]
+    samples = np.asarray(values, dtype=np.float64)[order]
+
+    starts = np.flatnonzero(np.concatenate(([True], cells[1:] != cells[:-1])))
+    sizes = np.diff(np.append(starts, num_samples))
+    prev_timestamps = np.empty(num_samples)
+    prev_timestamps[1:] = sorted_timestamps[:-1]
+    prev_timestamps[starts] = cell_timestamps[cells[starts]]
+    elapsed = sorted_timestamps - prev_timestamps
+    if np.any(elapsed < 0):
+        raise Exception("LPF inputs cannot age backwards")
+    decays = decay.factors(elapsed)
+
+    # cells with the most samples first, so the cells still active at step r are a prefix
+    by_size = np.argsort(-sizes, kind="stable")
+    sizes = sizes[by_size]
+    starts = starts[by_size]
+    running = cell_values[cells[starts]]
+    outputs = np.empty(num_samples)
+    step = 0
+    num_active = len(sizes)
+    while num_active >= min_wavefront_cells:
+        positions = starts[:num_active] + step
+        running[:num_active] = samples[positions] + running[:num_active] * decays[positions]
+        outputs[positions] = running[:num_active]
+        step += 1
+        num_active = int(np.searchsorted(-sizes, -step, side="left"))
+
+    if num_active > 0:
+        # the remaining samples of every active cell, cell by cell
+        tail_sizes = sizes[:num_active] - step
+        tail_positions = (np.repeat(starts[:num_active] + step - np.cumsum(tail_sizes) + tail_sizes, tail_sizes) +
+                          np.arange(np.sum(tail_sizes)))
+        tail_outputs = []
+        tail_samples = iter(zip(samples[tail_positions].tolist(), decays[tail_positions].tolist()))
+        for tail_size, val in zip(tail_sizes.tolist(), running[:num_active].tolist()):
+            for _ in range(tail_size):
+                sample, factor = next(tail_samples)
+                val = sample + val * factor
+                tail_outputs.append(val)
+        outputs[tail_positions] = tail_outputs
+
+    last_positions = starts + sizes - 1
+    cell_values[cells[last_positions]] = outputs[last_positions]
+    cell_timestamps[cells[last_positions]] = sorted_timestamps[last_positions]
+    result = np.empty(num_samples)
+    result[order] = outputs
+    return result
 
 
 class RateEstimator(ABC):
@@ -42,36 +391,212 @@ class RateEstimator(ABC):
     def get(self, key: FlowId) -> np.uint64:
         return NotImplemented
 
+    def update_many(self, keys, timestamps, values) -> np.ndarray:
+        """
+        Batch version of `update`, one sample at a time. Estimators override this with vectorized versions
+        :param keys: item keys, as an (n, fields) array or a sequence of FlowId tuples
+        :param timestamps: sample timestamps
+        :param values: sample values
+        :return: estimate after every update, in arrival order
+        """
+        return np.asarray([self.update(key, timestamp, value) for key, timestamp, value in
+                           zip(as_flow_ids(keys), np.asarray(timestamps).tolist(), np.asarray(values).tolist())])
+
+    def update_batch(self, batch: PacketBatch) -> np.ndarray:
+        """
+        Feed a columnar trace to the estimator, using packet sizes as values
+        :return: estimate after every packet
+        """
+        return self.update_many(batch.keys, batch.timestamps, batch.sizes)
+
+
+class RingBufferWindows:
+    """
+    Sliding windows of recent samples, one per row. Every row keeps its samples in a preallocated ring buffer of
+    `capacity` samples along with their running sum, so updates take O(1) amortized time and rows take bounded
+    memory. A sample leaves the window once it is more than `window_duration` older than the row's newest sample.
+    When a row's buffer is full, its oldest sample is folded into the next oldest one: no value is lost, but it
+    leaves the window up to one inter-arrival time late, so sums can only overestimate.
+    """
+    window_duration: int
+    capacity: int
+    timestamps: np.ndarray  # (rows, capacity) timestamp of every buffered sample
+    values: np.ndarray  # (rows, capacity) value of every buffered sample
+    heads: np.ndarray  # buffer position of the oldest sample of every row
+    counts: np.ndarray  # number of buffered samples of every row
+    sums: np.ndarray  # sum of the buffered samples of every row
+
+    def __init__(self, rows: int, window_duration: int, capacity: int):
+        """
+        :param rows: number of windows
+        :param window_duration: window length, in timestamp units
+        :param capacity: maximum number of samples buffered per row, at least 2
+        """
+        assert (capacity >= 2)
+        self.window_duration = window_duration
+        self.capacity = capacity
+        self.timestamps = np.zeros((rows, capacity), dtype=np.int64)
+        self.values = np.zeros((rows, capacity))
+        self.heads = np.zeros(rows, dtype=np.int64)
+        self.counts = np.zeros(rows, dtype=np.int64)
+        self.sums = np.zeros(rows)
+
+    def __len__(self) -> int:
+        return len(self.sums)
+
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in (self.timestamps, self.values, self.heads, self.counts, self.sums))
+
+    def reserve(self, rows: int) -> None:
+        """
+        Grow the arrays geometrically until they hold at least `rows` rows
+        """
+        if rows <= len(self.sums):
+            return
+        new_rows = max(rows, 2 * len(self.sums))
+        for name in ("timestamps", "values", "heads", "counts", "sums"):
+            array = getattr(self, name)
+            grown = np.zeros((new_rows,) + array.shape[1:], dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+    def update(self, row: int, timestamp: int, value) -> float:
+        """
+        Add a sample to a row's window
+        :return: the sum of the row's window, including the sample
+        """
+        timestamps = self.timestamps[row]
+        values = self.values[row]
+        head = int(self.heads[row])
+        count = int(self.counts[row])
+        if count > 0 and timestamp < timestamps[(head + count - 1) % self.capacity]:
+            raise Exception("Sliding window inputs cannot age backwards")
+        total = self.sums[row]
+        cutoff = timestamp - self.window_duration
+        while count > 0 and timestamps[head] < cutoff:
+            total -= values[head]
+            head = (head + 1) % self.capacity
+            count -= 1
+        if count == self.capacity:
+            next_head = (head + 1) % self.capacity
+            values[next_head] += values[head]
+            head = next_head
+            count -= 1
+        tail = (head + count) % self.capacity
+        timestamps[tail] = timestamp
+        values[tail] = value
+        total += value
+        self.heads[row] = head
+        self.counts[row] = count + 1
+        self.sums[row] = total
+        return total
+
+    def get(self, row: int) -> float:
+        """
+        :return: the sum of the row's window, as of its newest sample
+        """
+        return self.sums[row]
+
+    def newest_timestamps(self) -> np.ndarray:
+        """
+        :return: the timestamp of the newest sample of every row, 0 for empty rows
+        """
+        tails = (self.heads + np.maximum(self.counts - 1, 0)) % self.capacity
+        return np.where(self.counts > 0, self.timestamps[np.arange(len(self.sums)), tails], 0)
+
+    def clear_rows(self, rows: np.ndarray) -> None:
+        self.heads[rows] = 0
+        self.counts[rows] = 0
+        self.sums[rows] = 0
+
 
-"""
 class SlidingWindowRateEstimator(RateEstimator):
-    per_flow_history = Dict[FlowId, Tuple[int, Queue[Tuple[int, int]]]]
-    window_duration: int
+    """
+    Exact per-flow sliding window: the estimate of a flow is the sum of its samples over the last
+    `window_duration`, as of its latest sample. Flows are numbered by a `FlowInterner` and every flow has a row of
+    `RingBufferWindows`, so memory per flow is bounded by the ring buffer capacity. Flows whose window has
+    emptied can be evicted with `evict_idle`.
+    """
+    interner: FlowInterner
+    windows: RingBufferWindows
+
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self, window_duration: int = LPF_DECAY, capacity: int = 64):
+        """
+        :param window_duration: window length, in timestamp units. The default matches the default LPF time constant
+        :param capacity: maximum number of samples buffered per flow, see `RingBufferWindows`
+        """
+        self.interner = FlowInterner()
+        self.windows = RingBufferWindows(self.INITIAL_CAPACITY, window_duration, capacity)
+
+    def __len__(self) -> int:
+        return len(self.interner)
+
+    def update(self, key: FlowId, timestamp: int, value: int) -> float:
+        flow = self.interner.intern(key)
+        if flow >= len(self.windows):
+            self.windows.reserve(flow + 1)
+        return self.windows.update(flow, timestamp, value)
+
+    def get(self, key: FlowId) -> float:
+        flow = self.interner.find(key)
+        return self.windows.get(flow) if flow >= 0 else 0.0
+
+    def evict_idle(self, timestamp: int) -> int:
+        """
+        Forget the flows whose newest sample has left the window as of `timestamp`, so that their rows are reused
+        :return: number of evicted flows
+        """
+        capacity = self.interner.capacity()
+        newest = self.windows.newest_timestamps()[:capacity]
+        idle = np.flatnonzero(newest < timestamp - self.windows.window_duration)
+        keys = self.interner.keys
+        idle = np.asarray([flow for flow in idle.tolist() if keys[flow] is not None], dtype=np.int64)
+        self.interner.release_many(idle)
+        self.windows.clear_rows(idle)
+        return len(idle)
+
+
+class HashedSlidingWindowRateEstimator(RateEstimator):
+    """
+    Count-min sketch of sliding windows: every key is hashed to one `RingBufferWindows` row in each of `width`
+    registers, and its estimate is the smallest of its rows' window sums. Memory is fixed, whatever the number of
+    flows. Colliding flows share rows, so rows need a larger capacity than in `SlidingWindowRateEstimator`.
+    """
+    width: int
+    height: int
+    registers: List[RingBufferWindows]
+    hash_funcs: List[Callable[..., int]]
+
+    def __init__(self, window_duration: int = LPF_DECAY, capacity: int = 64, width: int = 3, height: int = 2048,
+                 hash_funcs: Optional[List[Callable[..., int]]] = None):
+        """
+        :param window_duration: window length, in timestamp units
+        :param capacity: maximum number of samples buffered per row, see `RingBufferWindows`
+        :param width: number of registers. If `hash_funcs` is provided, the number of funcs is used instead
+        :param height: number of rows in each register
+        :param hash_funcs: one hash function per register
+        """
+        if hash_funcs is None:
+            hash_funcs = [make_crc16_func(polynomial=poly) for poly in crc16_polynomials(width)]
+        self.hash_funcs = hash_funcs
+        self.width = len(hash_funcs)
+        self.height = height
+        self.registers = [RingBufferWindows(height, window_duration, capacity) for _ in hash_funcs]
 
-    def __init__(self, window_duration: int):
-        self.window_duration = window_duration
-        self.per_flow_history = FlowHistory()
+    def nbytes(self) -> int:
+        return sum(register.nbytes() for register in self.registers)
 
-    def update(self, key: FlowId, timestamp: int, value: int) -> int:
-        # grab the stored sum and window
-        flow_size, recent_packets = self.per_flow_history[key]
-        # add the new packet to the flow's window
-        flow_size += value
-        recent_packets.append((timestamp, value))
-        # strip old packets that have fallen outside the window
-        earliest_packet_timestamp, earliest_packet_size = recent_packets[0]
-        while timestamp - earliest_packet_timestamp > self.window_duration:
-            flow_size -= earliest_packet_size
-            earliest_packet_timestamp, earliest_packet_size = recent_packets.dequeue()
-        # updated the stored sum and window
-        self.per_flow_history = (flow_size, recent_packets)
-
-        return flow_size
+    def indices(self, key: FlowId) -> List[int]:
+        return [hash_func(*key) % self.height for hash_func in self.hash_funcs]
 
-    def get(self, key: FlowId) -> int:
-        flow_size, _ = self.per_flow_history[key]
-        return flow_size
-"""
+    def update(self, key: FlowId, timestamp: int, value: int) -> float:
+        return min(register.update(index, timestamp, value)
+                   for register, index in zip(self.registers, self.indices(key)))
+
+    def get(self, key: FlowId) -> float:
+        return min(register.get(index) for register, index in zip(self.registers, self.indices(key)))
 
 
 class LpfSingleton:
@@ -80,15 +605,23 @@ class LpfSingleton:
     last_value: np.uint64
     time_constant: np.uint64
     scale_down_factor: int
-
-    def __init__(self, time_constant: np.uint64, scale_down_factor: int = 0):
+    decay: DecayTable
+
+    def __init__(self, time_constant: np.uint64, scale_down_factor: int = 0,
+                 decay_quantum_bits: Optional[int] = None):
+        """
+        :param decay_quantum_bits: log2 of the time delta quantization step of the decay, see `DecayTable`.
+                                   None keeps the exact decay
+        """
         self.last_timestamp = np.uint64(0)
         self.last_value = np.uint64(0)
         self.time_constant = time_constant
         self.scale_down_factor = scale_down_factor
+        self.decay = decay_table(time_constant, decay_quantum_bits)
 
     def update(self, timestamp: np.uint64, value: np.uint64) -> np.uint64:
-        new_val = compute_rate_lpf(self.last_value, value, self.last_timestamp, timestamp, self.time_constant)
+        new_val = compute_rate_lpf(self.last_value, value, self.last_timestamp, timestamp, self.time_constant,
+                                   self.decay)
         self.last_timestamp = timestamp
         self.last_value = new_val
         return new_val / (2 ** self.scale_down_factor)
@@ -100,28 +633,135 @@ class LpfSingleton:
         self.last_value = np.uint64(0)
         self.last_timestamp = np.uint64(0)
 
+    def merge(self, other: 'LpfSingleton') -> None:
+        """
+        Merge in an LPF with the same time constant that was fed a disjoint set of samples
+        :param other: the LPF to merge in. It is left unchanged
+        """
+        if other.time_constant != self.time_constant or other.decay.quantum_bits != self.decay.quantum_bits:
+            raise ValueError("Only LPFs with the same time constant can be merged")
+        self.last_timestamp, self.last_value = merge_lpf_values(self.last_timestamp, self.last_value,
+                                                                other.last_timestamp, other.last_value,
+                                                                self.time_constant)
+
 
 class LpfExactRegister(RateEstimator):
+    """
+    One LPF per flow. Flows are numbered by a `FlowInterner`, and the LPF state of flow i is in cell i of
+    growable arrays, which takes far less memory than per-flow dictionary entries. Flows that stop sending can be
+    evicted with `evict_idle`, so that their cells are reused.
+    """
+    interner: FlowInterner
     # Each LPF cell consists of two values: the timestamp of the last sample, and the current LPF value
-    timestamps: Dict[FlowId, np.uint64]
-    values: Dict[FlowId, np.uint64]
+    timestamps: np.ndarray
+    values: np.ndarray
     time_constant: np.uint64
     scale_down_factor: np.uint64
-
-    def __init__(self, time_constant: np.uint64, scale: int = 0):
-        self.timestamps = defaultdict(np.uint64)
-        self.values = defaultdict(np.uint64)
+    decay: DecayTable
+
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self, time_constant: np.uint64, scale: int = 0, decay_quantum_bits: Optional[int] = None):
+        """
+        :param decay_quantum_bits: log2 of the time delta quantization step of the decay, see `DecayTable`.
+                                   None keeps the exact decay
+        """
+        self.interner = FlowInterner()
+        self.timestamps = np.zeros(self.INITIAL_CAPACITY)
+        self.values = np.zeros(self.INITIAL_CAPACITY)
         self.time_constant = time_constant
         self.scale_down_factor = np.uint64(scale)
+        self.decay = decay_table(time_constant, decay_quantum_bits)
+
+    def __len__(self) -> int:
+        return len(self.interner)
+
+    def _reserve(self, capacity: int) -> None:
+        """
+        Grow the cell arrays geometrically until they hold at least `capacity` flows
+        """
+        if capacity <= len(self.values):
+            return
+        new_capacity = max(capacity, 2 * len(self.values))
+        for name in ("timestamps", "values"):
+            cells = np.zeros(new_capacity)
+            cells[:len(self.values)] = getattr(self, name)
+            setattr(self, name, cells)
 
     def update(self, key: FlowId, timestamp: np.uint64, value: np.uint64) -> np.uint64:
-        new_val = compute_rate_lpf(self.values[key], value, self.timestamps[key], timestamp, self.time_constant)
-        self.timestamps[key] = timestamp
-        self.values[key] = new_val
-        return new_val >> self.scale_down_factor
+        flow = self.interner.intern(key)
+        if flow >= len(self.values):
+            self._reserve(flow + 1)
+        new_val = compute_rate_lpf(self.values[flow], value, self.timestamps[flow], timestamp, self.time_constant,
+                                   self.decay)
+        self.timestamps[flow] = timestamp
+        self.values[flow] = new_val
+        return new_val / (2 ** self.scale_down_factor)
 
     def get(self, key: FlowId) -> np.uint64:
-        return self.values[key] >> self.scale_down_factor
+        flow = self.interner.find(key)
+        value = self.values[flow] if flow >= 0 else np.float64(0)
+        return value / (2 ** self.scale_down_factor)
+
+    def update_many(self, keys, timestamps, values) -> np.ndarray:
+        """
+        Batch version of `update`, with identical results. See `lpf_update_cells`
+        :param keys: flow keys, as an (n, fields) array or a sequence of FlowId tuples
+        :param timestamps: sample timestamps, non-decreasing within every flow
+        :param values: sample values
+        :return: LPF output after every update, in arrival order
+        """
+        flows = self.interner.intern_many(keys)
+        self._reserve(self.interner.capacity())
+        outputs = lpf_update_cells(self.timestamps, self.values, flows, timestamps, values, self.decay)
+        return outputs / (2 ** self.scale_down_factor)
+
+    def get_many(self, keys) -> np.ndarray:
+        """
+        Batch version of `get`
+        :param keys: flow keys, as an (n, fields) array or a sequence of FlowId tuples
+        :return: LPF value of every flow, 0 for unknown flows
+        """
+        flows = self.interner.find_many(keys)
+        values = np.where(flows >= 0, self.values[np.maximum(flows, 0)], 0)
+        return values / (2 ** self.scale_down_factor)
+
+    def evict_idle(self, timestamp: np.uint64, idle_time: np.uint64) -> int:
+        """
+        Forget the flows whose last sample is more than `idle_time` before `timestamp`. Their LPFs have decayed by
+        at least e^{-idle_time / time_constant}, and restart from 0 if the flows come back.
+        :return: number of evicted flows
+        """
+        capacity = self.interner.capacity()
+        idle = np.flatnonzero(self.timestamps[:capacity] < np.float64(timestamp) - np.float64(idle_time))
+        keys = self.interner.keys
+        idle = np.asarray([flow for flow in idle.tolist() if keys[flow] is not None], dtype=np.int64)
+        self.interner.release_many(idle)
+        self.timestamps[idle] = 0
+        self.values[idle] = 0
+        return len(idle)
+
+    def clear(self) -> None:
+        self.interner = FlowInterner()
+        self.timestamps.fill(0)
+        self.values.fill(0)
+
+    def merge(self, other: 'LpfExactRegister') -> None:
+        """
+        Merge in a register with the same parameters, eg. one that was fed a different shard of the trace.
+        When the trace was partitioned by flow key, the flows are disjoint and are simply copied over.
+        :param other: the register to merge in. It is left unchanged
+        """
+        if (other.time_constant != self.time_constant or other.scale_down_factor != self.scale_down_factor or
+                other.decay.quantum_bits != self.decay.quantum_bits):
+            raise ValueError("Only LPF registers with the same parameters can be merged")
+        other_keys, other_flows = other.interner.live_flows()
+        flows = self.interner.intern_many(other_keys)
+        self._reserve(self.interner.capacity())
+        # new flows start from an empty LPF at time 0, so merging copies them over exactly
+        self.timestamps[flows], self.values[flows] = merge_lpf_values(self.timestamps[flows], self.values[flows],
+                                                                      other.timestamps[other_flows],
+                                                                      other.values[other_flows], self.time_constant)
 
 
 class LpfHashedRegister(RateEstimator):
@@ -132,55 +772,732 @@ class LpfHashedRegister(RateEstimator):
     height: int
     time_constant: np.uint64
     scale_down_factor: np.uint64
+    decay: DecayTable
+
+    # below this many cells with samples left, `update_many_at` finishes the batch one sample at a time
+    WAVEFRONT_MIN_CELLS = 64
 
     def __init__(self, time_constant: np.uint64, height: int,
-                 hash_func: Callable[..., int], scale: int = 0):
+                 hash_func: Callable[..., int], scale: int = 0, decay_quantum_bits: Optional[int] = None):
+        """
+        :param decay_quantum_bits: log2 of the time delta quantization step of the decay, see `DecayTable`.
+                                   None keeps the exact decay
+        """
         self.timestamps = np.zeros(height)
         self.values = np.zeros(height)
         self.hash_func = hash_func
         self.height = height
         self.time_constant = time_constant
         self.scale_down_factor = np.uint64(scale)
+        self.decay = decay_table(time_constant, decay_quantum_bits)
 
     def __index_of(self, key: FlowId) -> int:
         return self.hash_func(*key) % self.height
 
     def update(self, key: FlowId, timestamp: np.uint64, value: np.uint64) -> np.uint64:
-        index = self.__index_of(key)
-        new_val = compute_rate_lpf(self.values[index], value, self.timestamps[index], timestamp, self.time_constant)
+        return self.update_at(self.__index_of(key), timestamp, value)
+
+    def get(self, key: FlowId) -> int:
+        return self.get_at(self.__index_of(key))
+
+    def update_at(self, index: int, timestamp: np.uint64, value: np.uint64) -> np.uint64:
+        """
+        Same as `update`, but for a register cell index that has already been computed
+        :param index: register cell index
+        :param timestamp: sample timestamp
+        :param value: sample value
+        :return: LPF output after the update
+        """
+        new_val = compute_rate_lpf(self.values[index], value, self.timestamps[index], timestamp, self.time_constant,
+                                   self.decay)
         self.timestamps[index] = timestamp
         self.values[index] = new_val
-        return new_val >> self.scale_down_factor
+        return new_val / (2 ** self.scale_down_factor)
+
+    def get_at(self, index: int) -> np.uint64:
+        return self.values[index] / (2 ** self.scale_down_factor)
+
+    def update_many(self, keys, timestamps, values) -> np.ndarray:
+        """
+        Batch version of `update`
+        :param keys: item keys, as an (n, fields) array or a sequence of FlowId tuples
+        :param timestamps: sample timestamps, non-decreasing within every cell
+        :param values: sample values
+        :return: LPF output after every update, in arrival order
+        """
+        indices = np.asarray([self.__index_of(key) for key in as_flow_ids(keys)], dtype=np.int64)
+        return self.update_many_at(indices, timestamps, values)
+
+    def update_many_at(self, indices: np.ndarray, timestamps, values) -> np.ndarray:
+        """
+        Same as `update_many`, but for register cell indices that have already been computed.
+        See `lpf_update_cells`; the results are identical to sequential `update` calls.
+        :param indices: register cell index of every sample
+        :param timestamps: sample timestamps, non-decreasing within every cell
+        :param values: sample values
+        :return: LPF output after every update, in arrival order
+        """
+        outputs = lpf_update_cells(self.timestamps, self.values, indices, timestamps, values, self.decay,
+                                   self.WAVEFRONT_MIN_CELLS)
+        return outputs / (2 ** self.scale_down_factor)
+
+    def decayed_at(self, index: int, timestamp: np.uint64) -> np.uint64:
+        """
+        The unscaled value of a register cell, decayed to the given time without adding a sample
+        """
+        return compute_rate_lpf(self.values[index], 0, self.timestamps[index], timestamp, self.time_constant,
+                                self.decay)
+
+    def set_at(self, index: int, timestamp: np.uint64, value: np.uint64) -> None:
+        """
+        Overwrite a register cell with an unscaled value, as of the given time
+        """
+        self.timestamps[index] = timestamp
+        self.values[index] = value
+
+    def merge(self, other: 'LpfHashedRegister') -> None:
+        """
+        Merge in a register with the same parameters and hash function that was fed a disjoint set of samples,
+        eg. a different shard of a trace partitioned by flow key
+        :param other: the register to merge in. It is left unchanged
+        """
+        if (other.height != self.height or other.time_constant != self.time_constant or
+                other.scale_down_factor != self.scale_down_factor or
+                other.decay.quantum_bits != self.decay.quantum_bits):
+            raise ValueError("Only LPF registers with the same parameters can be merged")
+        self.merge_cells(other.timestamps, other.values)
+
+    def merge_cells(self, timestamps: np.ndarray, values: np.ndarray) -> None:
+        """
+        Merge in the raw cells of a register with the same parameters and hash function, eg. from a worker process.
+        Every cell ends up in the state it would have reached had it seen the samples of both registers.
+        :param timestamps: per-cell timestamps of the other register
+        :param values: per-cell LPF values of the other register
+        """
+        self.timestamps, self.values = merge_lpf_values(self.timestamps, self.values, timestamps, values,
+                                                        self.time_constant)
+
+
+class LpfGlobalDecayRegister(RateEstimator):
+    """
+    Hashed LPF register without per-cell timestamps. An LPF with value v at time t has value v * e^{-(t' - t) / tau}
+    at any later time t', so cells store their values scaled by e^{(t - base) / tau}, relative to one global base
+    time. Every cell then decays at the same rate: an update adds the sample scaled to its arrival time, and a read
+    multiplies by the current scale-down factor, without any per-cell exponential. Once the scale would grow beyond
+    e^RENORMALIZE_EXPONENT, every cell is rescaled to a new base time.
+    Timestamps must be non-decreasing across the whole register, not just within every cell. `get` returns values
+    decayed to the latest sample time, whereas `LpfHashedRegister` returns them as of each cell's last sample.
+    """
+    scaled_values: np.ndarray
+    hash_func: Callable[..., int]
+    height: int
+    time_constant: np.uint64
+    scale_down_factor: np.uint64
+    base_timestamp: float
+    last_timestamp: float
+    read_factor: float  # e^{-(last_timestamp - base_timestamp) / tau}
+
+    # e^256 leaves ample float64 headroom above the scaled cell values
+    RENORMALIZE_EXPONENT = 256.0
+
+    def __init__(self, time_constant: np.uint64, height: int, hash_func: Callable[..., int], scale: int = 0):
+        self.scaled_values = np.zeros(height)
+        self.hash_func = hash_func
+        self.height = height
+        self.time_constant = time_constant
+        self.scale_down_factor = np.uint64(scale)
+        self.base_timestamp = 0.0
+        self.last_timestamp = 0.0
+        self.read_factor = 1.0
+
+    def __index_of(self, key: FlowId) -> int:
+        return self.hash_func(*key) % self.height
+
+    def update(self, key: FlowId, timestamp: np.uint64, value: np.uint64) -> np.uint64:
+        return self.update_at(self.__index_of(key), timestamp, value)
+
+    def get(self, key: FlowId) -> np.uint64:
+        return self.get_at(self.__index_of(key))
+
+    def renormalize(self, timestamp: float) -> None:
+        """
+        Rescale every cell relative to a new base time, and decay the register to that time
+        :param timestamp: the new base time, no earlier than the latest sample
+        """
+        self.scaled_values *= math.exp(-(timestamp - self.base_timestamp) / self.time_constant)
+        self.base_timestamp = timestamp
+        # the register now reads as of the base time. Reading as of the previous sample would need a factor of
+        # e^{(timestamp - last_timestamp) / tau}, which overflows after a long enough idle period
+        self.last_timestamp = timestamp
+        self.read_factor = 1.0
+
+    def update_at(self, index: int, timestamp: np.uint64, value: np.uint64) -> np.uint64:
+        """
+        Same as `update`, but for a register cell index that has already been computed
+        :return: LPF output after the update
+        """
+        timestamp = float(timestamp)
+        if timestamp < self.last_timestamp:
+            raise Exception("LPF inputs cannot age backwards")
+        if timestamp - self.base_timestamp > self.RENORMALIZE_EXPONENT * self.time_constant:
+            self.renormalize(timestamp)
+        if timestamp != self.last_timestamp:
+            self.last_timestamp = timestamp
+            self.read_factor = math.exp(-(timestamp - self.base_timestamp) / self.time_constant)
+        self.scaled_values[index] += value / self.read_factor
+        return self.scaled_values[index] * self.read_factor / (2 ** self.scale_down_factor)
+
+    def get_at(self, index: int) -> np.uint64:
+        return self.scaled_values[index] * self.read_factor / (2 ** self.scale_down_factor)
+
+    def get_many(self, keys) -> np.ndarray:
+        indices = np.asarray([self.__index_of(key) for key in as_flow_ids(keys)], dtype=np.int64)
+        return self.scaled_values[indices] * self.read_factor / (2 ** self.scale_down_factor)
+
+    def update_many(self, keys, timestamps, values) -> np.ndarray:
+        indices = np.asarray([self.__index_of(key) for key in as_flow_ids(keys)], dtype=np.int64)
+        return self.update_many_at(indices, timestamps, values)
+
+    def update_many_at(self, indices: np.ndarray, timestamps, values) -> np.ndarray:
+        """
+        Batch version of `update_at`. Samples are scaled to their arrival times in one pass, and every cell's
+        outputs are running sums of its scaled samples. The base time moves at the same samples as in sequential
+        updates, so results match sequential updates to within floating point rounding.
+        :param indices: register cell index of every sample
+        :param timestamps: sample timestamps, non-decreasing
+        :param values: sample values
+        :return: LPF output after every update, in arrival order
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+        num_samples = len(indices)
+        outputs = np.empty(num_samples)
+        if num_samples == 0:
+            return outputs
+        if timestamps[0] < self.last_timestamp or np.any(timestamps[1:] < timestamps[:-1]):
+            raise Exception("LPF inputs cannot age backwards")
+
+        start = 0
+        while start < num_samples:
+            if timestamps[start] - self.base_timestamp > self.RENORMALIZE_EXPONENT * self.time_constant:
+                self.renormalize(timestamps[start])
+            # the samples up to the next renormalization
+            end = int(np.searchsorted(timestamps, self.base_timestamp + self.RENORMALIZE_EXPONENT *
+                                      self.time_constant, side="right"))
+            read_factors = np.exp(-(timestamps[start:end] - self.base_timestamp) / self.time_constant)
+            chunk_indices = indices[start:end]
+            order = np.argsort(chunk_indices, kind="stable")
+            cells = chunk_indices[order]
+            starts = np.flatnonzero(np.concatenate(([True], cells[1:] != cells[:-1])))
+            sizes = np.diff(np.append(starts, len(cells)))
+            sums = _segmented_cumsum(values[start:end][order] / read_factors[order], starts, sizes)
+            sums += self.scaled_values[cells[starts]].repeat(sizes)
+            self.scaled_values[cells[starts + sizes - 1]] = sums[starts + sizes - 1]
+            outputs[start + order] = sums * read_factors[order]
+            self.last_timestamp = float(timestamps[end - 1])
+            self.read_factor = float(read_factors[-1])
+            start = end
+        return outputs / (2 ** self.scale_down_factor)
+
+    def clear(self) -> None:
+        self.scaled_values.fill(0)
+        self.base_timestamp = self.last_timestamp
+        self.read_factor = 1.0
+
+
+class TofinoLpfRegister(RateEstimator):
+    """
+    Fixed-point model of a Tofino `Lpf` extern, configured with the same fields that add_lpf_rules.py writes:
+    $LPF_SPEC_TYPE, $LPF_SPEC_GAIN_TIME_CONSTANT_NS, $LPF_SPEC_DECAY_TIME_CONSTANT_NS and
+    $LPF_SPEC_OUT_SCALE_DOWN_FACTOR. Cells hold unsigned `value_bits`-bit integers, which saturate, and decay
+    factors are fractions with `factor_bits` fraction bits, looked up by time delta in a `DecayTable`.
+    RATE mode accumulates samples: v = x + v * d, where d is the decay factor of the time since the cell's last
+    sample, like `LpfHashedRegister`. SAMPLE mode smooths the sample values: v = v * a + x * (1 - a), where a is the
+    gain factor if the sample is above the cell value and the decay factor otherwise.
+    Outputs are cell values shifted right by the scale-down factor.
+    The internal precision of the hardware filter is not documented, so `factor_bits`, `value_bits` and
+    `decay_quantum_bits` are model parameters, to be fitted against testbed measurements.
+    """
+    MODES = ("RATE", "SAMPLE")
+
+    timestamps: np.ndarray  # int64 timestamp of the last sample of every cell
+    values: np.ndarray  # int64 fixed-point value of every cell
+    hash_func: Callable[..., int]
+    height: int
+    mode: str
+    scale_down_factor: int
+    factor_bits: int
+    max_value: int
+    gain: DecayTable
+    decay: DecayTable
+
+    # below this many cells with samples left, `update_many_at` finishes the batch one sample at a time
+    WAVEFRONT_MIN_CELLS = 64
+
+    def __init__(self, height: int, mode: str = "RATE", gain_time_constant_ns: float = 1e6,
+                 decay_time_constant_ns: Optional[float] = None, out_scale_down_factor: int = 1,
+                 hash_func: Optional[Callable[..., int]] = None, factor_bits: int = 16, value_bits: int = 32,
+                 decay_quantum_bits: Optional[int] = None):
+        """
+        :param height: number of cells, the size of the `Lpf` extern
+        :param mode: $LPF_SPEC_TYPE, "RATE" or "SAMPLE"
+        :param gain_time_constant_ns: $LPF_SPEC_GAIN_TIME_CONSTANT_NS
+        :param decay_time_constant_ns: $LPF_SPEC_DECAY_TIME_CONSTANT_NS. Defaults to the gain time constant, like
+                                       add_lpf_rules.py
+        :param out_scale_down_factor: $LPF_SPEC_OUT_SCALE_DOWN_FACTOR, right shift applied to outputs
+        :param hash_func: hash function that maps keys to cells, for `update` and `get`
+        :param factor_bits: number of fraction bits of the decay and gain factors
+        :param value_bits: width of the cells
+        :param decay_quantum_bits: log2 of the time delta quantization step, see `DecayTable`
+        """
+        if mode not in self.MODES:
+            raise ValueError("LPF mode must be one of %s" % ", ".join(self.MODES))
+        assert (factor_bits + value_bits < 63)
+        if decay_time_constant_ns is None:
+            decay_time_constant_ns = gain_time_constant_ns
+        self.timestamps = np.zeros(height, dtype=np.int64)
+        self.values = np.zeros(height, dtype=np.int64)
+        self.hash_func = make_crc16_func() if hash_func is None else hash_func
+        self.height = height
+        self.mode = mode
+        self.scale_down_factor = out_scale_down_factor
+        self.factor_bits = factor_bits
+        self.max_value = (1 << value_bits) - 1
+        self.gain = decay_table(gain_time_constant_ns, decay_quantum_bits)
+        self.decay = decay_table(decay_time_constant_ns, decay_quantum_bits)
+
+    def __index_of(self, key: FlowId) -> int:
+        return self.hash_func(*key) % self.height
+
+    def _fixed_factor(self, table: DecayTable, elapsed: int) -> int:
+        return int(round(table.factor(elapsed) * (1 << self.factor_bits)))
+
+    def _fixed_factors(self, table: DecayTable, elapsed: np.ndarray) -> np.ndarray:
+        return np.round(table.factors(elapsed) * (1 << self.factor_bits)).astype(np.int64)
+
+    def _filter(self, value: int, sample: int, decay_factor: int, gain_factor: int) -> int:
+        """
+        One step of the filter, on fixed-point integers
+        """
+        if self.mode == "RATE":
+            return min(sample + ((value * decay_factor) >> self.factor_bits), self.max_value)
+        factor = gain_factor if sample > value else decay_factor
+        return (value * factor + sample * ((1 << self.factor_bits) - factor)) >> self.factor_bits
+
+    def _filter_many(self, values: np.ndarray, samples: np.ndarray, decay_factors: np.ndarray,
+                     gain_factors: np.ndarray) -> np.ndarray:
+        """
+        Vectorized `_filter`
+        """
+        if self.mode == "RATE":
+            return np.minimum(samples + ((values * decay_factors) >> self.factor_bits), self.max_value)
+        factors = np.where(samples > values, gain_factors, decay_factors)
+        return (values * factors + samples * ((1 << self.factor_bits) - factors)) >> self.factor_bits
+
+    def update(self, key: FlowId, timestamp: int, value: int) -> int:
+        return self.update_at(self.__index_of(key), timestamp, value)
 
     def get(self, key: FlowId) -> int:
-        return self.values[self.__index_of(key)] >> self.scale_down_factor
+        return self.get_at(self.__index_of(key))
+
+    def update_at(self, index: int, timestamp: int, value: int) -> int:
+        """
+        Same as `update`, but for a cell index that has already been computed
+        :param index: cell index
+        :param timestamp: sample timestamp, in nanoseconds
+        :param value: sample value
+        :return: filter output after the update
+        """
+        timestamp = int(timestamp)
+        elapsed = timestamp - int(self.timestamps[index])
+        if elapsed < 0:
+            raise Exception("LPF inputs cannot age backwards")
+        gain_factor = self._fixed_factor(self.gain, elapsed) if self.mode == "SAMPLE" else 0
+        new_val = self._filter(int(self.values[index]), min(int(value), self.max_value),
+                               self._fixed_factor(self.decay, elapsed), gain_factor)
+        self.timestamps[index] = timestamp
+        self.values[index] = new_val
+        return new_val >> self.scale_down_factor
 
+    def get_at(self, index: int) -> int:
+        return int(self.values[index]) >> self.scale_down_factor
+
+    def update_many(self, keys, timestamps, values) -> np.ndarray:
+        """
+        Batch version of `update`
+        :param keys: item keys, as an (n, fields) array or a sequence of FlowId tuples
+        :param timestamps: sample timestamps, in nanoseconds, non-decreasing within every cell
+        :param values: sample values
+        :return: int64 filter output after every update, in arrival order
+        """
+        indices = np.asarray([self.__index_of(key) for key in as_flow_ids(keys)], dtype=np.int64)
+        return self.update_many_at(indices, timestamps, values)
+
+    def update_many_at(self, indices: np.ndarray, timestamps, values) -> np.ndarray:
+        """
+        Same as `update_many`, but for cell indices that have already been computed. Evaluated like
+        `lpf_update_cells`: the r-th sample of every cell is applied at once, then the heaviest cells are finished
+        one sample at a time. The results are identical to sequential `update_at` calls.
+        :return: int64 filter output after every update, in arrival order
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        num_samples = len(indices)
+        if num_samples == 0:
+            return np.empty(0, dtype=np.int64)
+        order = np.argsort(indices, kind="stable")
+        cells = indices[order]
+        sorted_timestamps = np.asarray(timestamps, dtype=np.int64)[order]
+        samples = np.minimum(np.asarray(values, dtype=np.int64)[order], self.max_value)
+
+        starts = np.flatnonzero(np.concatenate(([True], cells[1:] != cells[:-1])))
+        sizes = np.diff(np.append(starts, num_samples))
+        prev_timestamps = np.empty(num_samples, dtype=np.int64)
+        prev_timestamps[1:] = sorted_timestamps[:-1]
+        prev_timestamps[starts] = self.timestamps[cells[starts]]
+        elapsed = sorted_timestamps - prev_timestamps
+        if np.any(elapsed < 0):
+            raise Exception("LPF inputs cannot age backwards")
+        decay_factors = self._fixed_factors(self.decay, elapsed)
+        gain_factors = self._fixed_factors(self.gain, elapsed) if self.mode == "SAMPLE" else decay_factors
+
+        # cells with the most samples first, so the cells still active at step r are a prefix
+        by_size = np.argsort(-sizes, kind="stable")
+        sizes = sizes[by_size]
+        starts = starts[by_size]
+        running = self.values[cells[starts]]
+        outputs = np.empty(num_samples, dtype=np.int64)
+        step = 0
+        num_active = len(sizes)
+        while num_active >= self.WAVEFRONT_MIN_CELLS:
+            positions = starts[:num_active] + step
+            running[:num_active] = self._filter_many(running[:num_active], samples[positions],
+                                                     decay_factors[positions], gain_factors[positions])
+            outputs[positions] = running[:num_active]
+            step += 1
+            num_active = int(np.searchsorted(-sizes, -step, side="left"))
+
+        for start, size, val in zip(starts[:num_active].tolist(), sizes[:num_active].tolist(),
+                                    running[:num_active].tolist()):
+            positions = slice(start + step, start + size)
+            for position, sample, decay_factor, gain_factor in zip(
+                    range(start + step, start + size), samples[positions].tolist(),
+                    decay_factors[positions].tolist(), gain_factors[positions].tolist()):
+                val = self._filter(val, sample, decay_factor, gain_factor)
+                outputs[position] = val
+
+        last_positions = starts + sizes - 1
+        self.values[cells[last_positions]] = outputs[last_positions]
+        self.timestamps[cells[last_positions]] = sorted_timestamps[last_positions]
+        result = np.empty(num_samples, dtype=np.int64)
+        result[order] = outputs
+        return result >> self.scale_down_factor
 
-class LpfMinSketch(RateEstimator):
+    def clear(self) -> None:
+        self.timestamps.fill(0)
+        self.values.fill(0)
+
+
+class LpfMinSketch(TopKTracking, RateEstimator):
     """
     Count-min sketch with LPFs instead of counters
     """
     width: int
     height: int
-    registers: List[RateEstimator]
+    registers: List[LpfHashedRegister]
+    hash_cache: Optional[HashCache]
+    polynomials: Optional[List[int]]  # CRC16 polynomials of the default hash functions, for vectorized hashing
+    conservative_update: bool
 
     def __init__(self, time_constant: np.uint64 = LPF_DECAY, scale: int = LPF_SCALE,
-                 width: int = 3, height: int = 2048):
-        self.width = width
+                 width: int = 3, height: int = 2048, hash_funcs: Optional[List[Callable[..., int]]] = None,
+                 hash_cache: Optional[HashCache] = None, conservative_update: bool = False, track_top_k: int = 0,
+                 decay_quantum_bits: Optional[int] = None):
+        """
+        :param time_constant: LPF decay time constant
+        :param scale: LPF output scale-down factor
+        :param width: Number of registers to use. If `hash_funcs` is provided, the number of funcs is used instead
+        :param height: number of cells in each register
+        :param hash_funcs: one hash function per register, eg. `make_tofino_cms_hash_funcs()` to index the
+                           registers the way rate_estimator.p4 does
+        :param hash_cache: optional cache of hash outputs, shared with other sketches. Its first `width` functions
+                           are used instead of `hash_funcs`
+        :param conservative_update: decay the cells of a key to the sample time, then only raise those that are below
+                                    the smallest decayed cell plus the sample, instead of adding the sample to
+                                    every cell. Sample values must be non-negative
+        :param track_top_k: if positive, track this many keys with the largest rates, as of each key's latest
+                            packet. See `top_k`
+        :param decay_quantum_bits: log2 of the time delta quantization step of the LPF decay, see `DecayTable`.
+                                   None keeps the exact decay
+        """
+        self.hash_cache = hash_cache
+        self.conservative_update = conservative_update
+        self.polynomials = None
+        if hash_cache is not None:
+            assert (hash_funcs is None and hash_cache.num_funcs >= width)
+            hash_funcs = hash_cache.hash_funcs[:width]
+        elif hash_funcs is None:
+            self.polynomials = crc16_polynomials(width)
+            hash_funcs = [make_crc16_func(polynomial=poly) for poly in self.polynomials]
+        self.width = len(hash_funcs)
         self.height = height
 
-        hash_funcs = [make_crc16_func(polynomial=CRC16_DEFAULT_POLY + (0x100 * i)) for i in range(width)]
         self.registers = [LpfHashedRegister(time_constant=time_constant,
                                             height=height,
                                             hash_func=hash_func,
-                                            scale=scale) for hash_func in hash_funcs]
+                                            scale=scale,
+                                            decay_quantum_bits=decay_quantum_bits) for hash_func in hash_funcs]
+        self.top_keys = TopK(track_top_k) if track_top_k > 0 else None
 
     def update(self, key: FlowId, timestamp: np.uint64, value: np.uint64) -> np.uint64:
-        return min(reg.update(key, timestamp, value) for reg in self.registers)
+        if self.conservative_update:
+            rate = self._conservative_update(key, timestamp, value)
+        elif self.hash_cache is not None:
+            rate = min(reg.update_at(index, timestamp, value)
+                       for reg, index in zip(self.registers, self.indices(key)))
+        else:
+            rate = min(reg.update(key, timestamp, value) for reg in self.registers)
+        if self.top_keys is not None:
+            self.top_keys.offer(key, rate)
+        return rate
+
+    def _conservative_update(self, key: FlowId, timestamp: np.uint64, value: np.uint64) -> np.uint64:
+        return self._conservative_update_at(self.indices(key), timestamp, value)
+
+    def _conservative_update_at(self, indices: List[int], timestamp: np.uint64, value: np.uint64) -> np.uint64:
+        if value < 0:
+            raise ValueError("Conservative update only supports non-negative samples")
+        decayed = [reg.decayed_at(index, timestamp) for reg, index in zip(self.registers, indices)]
+        estimate = min(decayed) + value
+        for reg, index, cell in zip(self.registers, indices, decayed):
+            reg.set_at(index, timestamp, max(cell, estimate))
+        return estimate / (2 ** self.registers[0].scale_down_factor)
 
     def get(self, key: FlowId) -> np.uint64:
+        if self.hash_cache is not None:
+            return min(reg.get_at(index) for reg, index in zip(self.registers, self.indices(key)))
         return min(reg.get(key) for reg in self.registers)
 
+    def merge(self, other: 'LpfMinSketch') -> None:
+        """
+        Merge in a sketch with the same dimensions, LPF parameters and hash functions that was fed a disjoint set of
+        samples. Hash functions are arbitrary callables and cannot be compared, so the caller must ensure they match.
+        :param other: the sketch to merge in. It is left unchanged
+        """
+        if other.width != self.width:
+            raise ValueError("Only LPF sketches of the same dimensions can be merged")
+        for register, other_register in zip(self.registers, other.registers):
+            register.merge(other_register)
+
+    def update_many(self, keys, timestamps, values, hashes: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Batch version of `update`, with identical results. Keys are hashed in one pass, then every register is
+        updated with `LpfHashedRegister.update_many_at`. Conservative updates depend upon every register,
+        so they are applied one sample at a time.
+        :param keys: item keys, as an (n, fields) array or a sequence of FlowId tuples
+        :param timestamps: sample timestamps, non-decreasing within every cell
+        :param values: sample values
+        :param hashes: optional precomputed hash outputs of shape (width, n), eg. from `tofino_cms_hashes`.
+                       Reduced modulo the sketch height
+        :return: rate estimate after every update, in arrival order
+        """
+        if hashes is None:
+            indices = self.indices_many(keys)
+        else:
+            indices = np.asarray(hashes)[:self.width].astype(np.int64) % self.height
+        if self.conservative_update:
+            samples = zip(indices.T.tolist(), np.asarray(timestamps).tolist(), np.asarray(values).tolist())
+            rates = np.asarray([self._conservative_update_at(key_indices, timestamp, value)
+                                for key_indices, timestamp, value in samples])
+        else:
+            rates = np.min([register.update_many_at(row_indices, timestamps, values)
+                            for register, row_indices in zip(self.registers, indices)], axis=0)
+        if self.top_keys is not None:
+            for key, rate in zip(as_flow_ids(keys), rates.tolist()):
+                self.top_keys.offer(key, rate)
+        return rates
+
+    def indices_many(self, keys) -> np.ndarray:
+        """
+        Batch version of `indices`. Vectorized if the sketch uses its default hash functions.
+        :param keys: item keys, as an (n, fields) array or a sequence of FlowId tuples
+        :return: int64 array of shape (width, n)
+        """
+        if self.polynomials is not None:
+            return crc16_rows(keys, self.polynomials).astype(np.int64) % self.height
+        indices = np.asarray([self.indices(key) for key in as_flow_ids(keys)], dtype=np.int64)
+        return indices.reshape(-1, self.width).T
+
+    def indices(self, key: FlowId) -> List[int]:
+        """
+        Return the register cell index of the given key in every register
+        :param key: the key to hash
+        :return: one index per register
+        """
+        if self.hash_cache is not None:
+            return [output % self.height for output in self.hash_cache.hashes(key)[:self.width]]
+        return [reg.hash_func(*key) % self.height for reg in self.registers]
+
+    def sram_bytes(self) -> int:
+        """
+        :return: switch memory taken by the sketch, with 32-bit LPF values and timestamps
+        """
+        return self.width * self.height * LPF_CELL_BYTES
+
+
+class ElasticLpfSketch(RateEstimator):
+    """
+    Heavy/light split rate sketch, after Elastic sketch (Yang et al., SIGCOMM 2018). A small heavy part holds one
+    flow per bucket with its own exact LPF, and every other flow goes to a smaller `LpfMinSketch`, the light part.
+    Each bucket also keeps an LPF of the traffic of the other flows that hashed to it, the negative vote. When the
+    negative vote reaches `eviction_ratio` times the resident's rate, the resident is evicted: its LPF value is
+    added to the light part at the current time, which for a linear filter is the same as having sent all of its
+    traffic there, and the newcomer takes the bucket. A flag records that the new resident may also have traffic
+    in the light part, which is then added to its estimate.
+    The largest flows end up in the heavy part, where their estimates are exact, and no longer collide with the
+    light flows, so the light part can be much smaller than a plain LPF min-sketch of the same accuracy.
+    `get` returns rates decayed to the latest sample time, the same way `update` reads both parts.
+    """
+    heavy_buckets: int
+    heavy_keys: List[Optional[FlowId]]
+    heavy_values: np.ndarray  # LPF value of every bucket's resident flow
+    negative_votes: np.ndarray  # LPF value of the other traffic that hashed to every bucket
+    heavy_timestamps: np.ndarray
+    flags: np.ndarray  # whether every bucket's resident may also have traffic in the light part
+    heavy_polynomial: int
+    heavy_hash: Callable[..., int]
+    eviction_ratio: float
+    light: LpfMinSketch
+    time_constant: np.uint64
+    scale_down_factor: np.uint64
+    decay: DecayTable
+    last_timestamp: float  # latest sample time, to which `get` decays rates
+
+    # the heavy part uses polynomials after those of the light part's rows
+    HEAVY_POLYNOMIAL_OFFSET = 16
+
+    def __init__(self, time_constant: np.uint64 = LPF_DECAY, scale: int = LPF_SCALE, heavy_buckets: int = 256,
+                 light_width: int = 3, light_height: int = 512, eviction_ratio: float = 8,
+                 conservative_update: bool = True):
+        """
+        :param time_constant: LPF decay time constant
+        :param scale: LPF output scale-down factor
+        :param heavy_buckets: number of heavy part buckets
+        :param light_width: number of light part registers
+        :param light_height: number of cells in each light part register
+        :param eviction_ratio: negative to positive vote ratio at which the resident of a bucket is evicted
+        :param conservative_update: use conservative update in the light part, which keeps evicted residents from
+                                    inflating every cell they hash to
+        """
+        self.heavy_buckets = heavy_buckets
+        self.heavy_keys = [None] * heavy_buckets
+        self.heavy_values = np.zeros(heavy_buckets)
+        self.negative_votes = np.zeros(heavy_buckets)
+        self.heavy_timestamps = np.zeros(heavy_buckets)
+        self.flags = np.zeros(heavy_buckets, dtype=bool)
+        self.heavy_polynomial = crc16_polynomials(1, offset=self.HEAVY_POLYNOMIAL_OFFSET)[0]
+        self.heavy_hash = make_crc16_func(polynomial=self.heavy_polynomial)
+        self.eviction_ratio = eviction_ratio
+        self.light = LpfMinSketch(time_constant=time_constant, scale=0, width=light_width, height=light_height,
+                                  conservative_update=conservative_update)
+        self.time_constant = time_constant
+        self.scale_down_factor = np.uint64(scale)
+        self.decay = decay_table(time_constant)
+        self.last_timestamp = 0.0
+
+    def _light_estimate(self, light_indices: List[int], timestamp: np.uint64) -> np.uint64:
+        """
+        The unscaled light part estimate of a key, decayed to the given time
+        :param light_indices: the key's cell index in every light part register
+        """
+        return min(register.decayed_at(index, timestamp)
+                   for register, index in zip(self.light.registers, light_indices))
+
+    def _light_update(self, light_indices: List[int], timestamp: np.uint64, value: np.uint64) -> np.uint64:
+        """
+        Same as `LpfMinSketch.update` on the light part, for a key whose cell indices have already been computed
+        """
+        if self.light.conservative_update:
+            return self.light._conservative_update_at(light_indices, timestamp, value)
+        return min(register.update_at(index, timestamp, value)
+                   for register, index in zip(self.light.registers, light_indices))
+
+    def update(self, key: FlowId, timestamp: np.uint64, value: np.uint64) -> np.uint64:
+        return self._update_at(key, self.heavy_hash(*key) % self.heavy_buckets, self.light.indices(key),
+                               timestamp, value)
+
+    def update_many(self, keys, timestamps, values) -> np.ndarray:
+        """
+        Batch version of `update`, with identical results. Heavy buckets and light part indices are hashed in one
+        vectorized pass. Whether a sample goes to the heavy or the light part depends upon every earlier sample of
+        its bucket, so the samples themselves are then applied one at a time.
+        :param keys: item keys, as an (n, fields) array or a sequence of FlowId tuples
+        :param timestamps: sample timestamps, non-decreasing within every bucket and cell
+        :param values: sample values
+        :return: rate estimate after every update, in arrival order
+        """
+        keys = as_key_array(keys)
+        buckets = crc16_many(keys, self.heavy_polynomial).astype(np.int64) % self.heavy_buckets
+        light_indices = self.light.indices_many(keys).T.tolist()
+        return np.asarray([self._update_at(key, bucket, key_light_indices, timestamp, value)
+                           for key, bucket, key_light_indices, timestamp, value in
+                           zip(as_flow_ids(keys), buckets.tolist(), light_indices,
+                               np.asarray(timestamps).tolist(), np.asarray(values).tolist())])
+
+    def _update_at(self, key: FlowId, bucket: int, light_indices: List[int], timestamp: np.uint64,
+                   value: np.uint64) -> np.uint64:
+        """
+        Same as `update`, for a key whose heavy bucket and light part indices have already been computed
+        """
+        if timestamp < self.heavy_timestamps[bucket]:
+            raise Exception("LPF inputs cannot age backwards")
+        decay = self.decay.factor(timestamp - self.heavy_timestamps[bucket])
+        heavy_value = self.heavy_values[bucket] * decay
+        negative_vote = self.negative_votes[bucket] * decay
+        self.heavy_timestamps[bucket] = timestamp
+        self.last_timestamp = max(self.last_timestamp, timestamp)
+
+        resident = self.heavy_keys[bucket]
+        if resident is None or resident == key:
+            if resident is None:
+                self.heavy_keys[bucket] = key
+            heavy_value += value
+            rate = heavy_value
+            if self.flags[bucket]:
+                rate += self._light_estimate(light_indices, timestamp)
+        else:
+            negative_vote += value
+            if negative_vote >= self.eviction_ratio * heavy_value:
+                self._light_update(self.light.indices(resident), timestamp, heavy_value)
+                self.heavy_keys[bucket] = key
+                self.flags[bucket] = True
+                heavy_value = value
+                negative_vote = 0
+                rate = heavy_value + self._light_estimate(light_indices, timestamp)
+            else:
+                rate = self._light_update(light_indices, timestamp, value)
+        self.heavy_values[bucket] = heavy_value
+        self.negative_votes[bucket] = negative_vote
+        return rate / (2 ** self.scale_down_factor)
+
+    def get(self, key: FlowId) -> np.uint64:
+        bucket = self.heavy_hash(*key) % self.heavy_buckets
+        timestamp = self.last_timestamp
+        if self.heavy_keys[bucket] == key:
+            rate = self.heavy_values[bucket] * self.decay.factor(timestamp - self.heavy_timestamps[bucket])
+            if self.flags[bucket]:
+                rate += self._light_estimate(self.light.indices(key), timestamp)
+        else:
+            rate = self._light_estimate(self.light.indices(key), timestamp)
+        return rate / (2 ** self.scale_down_factor)
+
+    def sram_bytes(self, key_bytes: int = 13) -> int:
+        """
+        :param key_bytes: size of a flow key, 13 bytes for a 5-tuple
+        :return: switch memory taken by the sketch, with 32-bit LPF values, votes and timestamps
+        """
+        return self.heavy_buckets * (key_bytes + LPF_CELL_BYTES + 4 + 1) + self.light.sram_bytes()
+
 
 def plot_lpf_rate_convergence():
     # over how many nanoseconds do we want an average
@@ -222,59 +1539,296 @@ def plot_lms_rate_convergence():
     plt.show()
 
 
-def get_epoched_cms_approx_pairs(packets: List[Packet],
+def epoch_boundaries(timestamps: np.ndarray, epoch_duration: int) -> List[int]:
+    """
+    Split a trace into epochs. A new epoch begins at the first packet arriving more than `epoch_duration` after
+    the first packet of the current epoch.
+    :param timestamps: packet timestamps, in arrival order
+    :param epoch_duration: epoch duration
+    :return: index of the first packet of every epoch, followed by the number of packets
+    """
+    boundaries = [0]
+    if len(timestamps) == 0:
+        return boundaries
+    timestamp_list = timestamps.tolist()
+    if np.all(timestamps[1:] >= timestamps[:-1]):
+        while True:
+            end = bisect_right(timestamp_list, timestamp_list[boundaries[-1]] + epoch_duration)
+            if end >= len(timestamp_list):
+                break
+            boundaries.append(end)
+    else:
+        last_reset_timestamp = timestamp_list[0]
+        for i, timestamp in enumerate(timestamp_list):
+            if timestamp - last_reset_timestamp > epoch_duration:
+                boundaries.append(i)
+                last_reset_timestamp = timestamp
+    boundaries.append(len(timestamps))
+    return boundaries
+
+
+def epoched_cms_values(keys, timestamps, sizes, cms_width: int, cms_height: int,
+                       epoch_duration: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Exact and CMS estimates of every packet's flow size within its epoch, for a trace given as arrays
+    :param keys: flow key of every packet, see `as_key_array`
+    :return: (exact values, CMS values), one per packet
+    """
+    cms = CountMinSketch(width=cms_width, height=cms_height, track_ground_truth=False)
+    keys = as_key_array(keys)
+    timestamps = np.asarray(timestamps)
+    sizes = np.asarray(sizes, dtype=np.int64)
+    # dense per-flow IDs, for computing the exact counts
+    flow_ids = dense_flow_ids(keys)
+    num_flows = int(flow_ids.max(initial=-1)) + 1
+
+    # The CMS and exact counters are cleared at the start of every epoch, so each packet's output is the running
+    # sum of its cell (or flow) within its epoch. Compute them for the whole trace at once instead of
+    # replaying the trace epoch by epoch.
+    boundaries = epoch_boundaries(timestamps, epoch_duration)
+    epoch_ids = np.repeat(np.arange(len(boundaries) - 1, dtype=np.int64), np.diff(boundaries))
+    exact_vals = grouped_cumsum(epoch_ids * num_flows + flow_ids, sizes)
+    cms_vals = np.min([grouped_cumsum(epoch_ids * cms.height + row_indices, sizes)
+                       for row_indices in cms.indices_many(keys)], axis=0)
+    return exact_vals, cms_vals
+
+
+def get_epoched_cms_approx_pairs(packets: Union[List[Packet], PacketBatch],
                                  cms_width: int, cms_height: int, epoch_duration: int) -> List[Tuple[int, int]]:
-    cms = CountMinSketch(width=cms_width, height=cms_height)
-    exact_count = defaultdict(int)
+    batch = as_packet_batch(packets)
+    exact_vals, cms_vals = epoched_cms_values(batch.keys, batch.timestamps, batch.sizes,
+                                              cms_width, cms_height, epoch_duration)
+    return list(zip(exact_vals.tolist(), cms_vals.tolist()))
 
-    result_pairs: List[Tuple[int, int]] = []
-    last_reset_timestamp = packets[0].timestamp
-    for packet in packets:
-        if packet.timestamp - last_reset_timestamp > epoch_duration:
-            cms.clear()
-            exact_count.clear()
-            last_reset_timestamp = packet.timestamp
-        cms_val = cms.add(packet.flow_id, packet.size)
-        exact_count[packet.flow_id] += packet.size
-        exact_val = exact_count[packet.flow_id]
-        result_pairs.append((exact_val, cms_val))
 
-    return result_pairs
+def lpf_min_sketch_values(keys, timestamps, sizes, lms_width: int, lms_height: int,
+                          time_constant: np.uint64) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Exact per-flow LPF and LPF min-sketch estimates of every packet's flow rate, for a trace given as arrays
+    :param keys: flow key of every packet, see `as_key_array`
+    :return: (exact values, sketch values), one per packet
+    """
+    lms = LpfMinSketch(time_constant=time_constant, width=lms_width, height=lms_height)
+    keys = as_key_array(keys)
+    timestamps = np.asarray(timestamps)
+    sizes = np.asarray(sizes)
+    lpf_vals = exact_lpf_rates(dense_flow_ids(keys), timestamps, sizes, time_constant)
+    lms_vals = lms.update_many(keys, timestamps, sizes)
+    return lpf_vals, lms_vals
 
 
-def get_approx_pairs(packets: List[Packet],
+def get_approx_pairs(packets: Union[List[Packet], PacketBatch],
                      lms_width: int, lms_height: int, time_constant: np.uint64) -> List[Tuple[np.uint64, np.uint64]]:
-    lms = LpfMinSketch(time_constant=time_constant, width=lms_width, height=lms_height)
-    lpf = LpfExactRegister(time_constant=time_constant)
+    batch = as_packet_batch(packets)
+    lpf_vals, lms_vals = lpf_min_sketch_values(batch.keys, batch.timestamps, batch.sizes,
+                                               lms_width, lms_height, time_constant)
+    return list(zip(lpf_vals.tolist(), lms_vals.tolist()))
 
-    result_pairs: List[Tuple[np.uint64, np.uint64]] = []
-    for packet in packets:
-        lpf_val = lpf.update(packet.flow_id, packet.timestamp, packet.size)
-        lms_val = lms.update(packet.flow_id, packet.timestamp, packet.size)
-        result_pairs.append((lpf_val, lms_val))
 
-    return result_pairs
+def get_approx_pairs_averaged(packets: Union[List[Packet], PacketBatch],
+                              lms_width: int, lms_height: int, time_constant: np.uint64) -> List[Tuple[np.uint64, np.uint64]]:
+    batch = as_packet_batch(packets)
+    flow_ids = dense_flow_ids(batch.keys)
+    lpf_vals, lms_vals = lpf_min_sketch_values(batch.keys, batch.timestamps, batch.sizes,
+                                               lms_width, lms_height, time_constant)
 
+    # per-flow averages, in order of each flow's first packet
+    packet_counts = np.bincount(flow_ids)
+    lpf_avgs = np.bincount(flow_ids, weights=lpf_vals) / packet_counts
+    lms_avgs = np.bincount(flow_ids, weights=lms_vals) / packet_counts
+    return list(zip(lpf_avgs.tolist(), lms_avgs.tolist()))
 
-def get_approx_pairs_averaged(packets: List[Packet],
-                              lms_width: int, lms_height: int, time_constant: np.uint64) -> List[Tuple[np.uint64, np.uint64]]:
-    lms = LpfMinSketch(time_constant=time_constant, width=lms_width, height=lms_height)
-    lpf = LpfExactRegister(time_constant=time_constant)
 
-    results: Dict[FlowId, List[Tuple[np.uint64, np.uint64]]] = defaultdict(list)
+def compare_lpf_conservative_update(num_pkts: int = 200000, zipf_exponent: float = 1.2,
+                                    time_constant: np.uint64 = 1000, height: int = 2048):
+    """
+    Compare an LPF min-sketch of the given height against conservative-update sketches of the same and of half
+    the height, by the error of every packet's rate estimate relative to an exact per-flow LPF
+    """
+    packets = zipf_packet_batch(num_pkts, zipf_exponent)
+    exact_vals = exact_lpf_rates(dense_flow_ids(packets.keys), packets.timestamps, packets.sizes, time_constant)
 
-    for packet in packets:
-        lpf_val = lpf.update(packet.flow_id, packet.timestamp, packet.size)
-        lms_val = lms.update(packet.flow_id, packet.timestamp, packet.size)
-        results[packet.flow_id].append((lpf_val, lms_val))
+    print("%d zipfian packets, time constant %d" % (num_pkts, time_constant))
+    for sketch_height, conservative_update in [(height, False), (height, True),
+                                               (height // 2, False), (height // 2, True)]:
+        lms = LpfMinSketch(time_constant=time_constant, height=sketch_height, conservative_update=conservative_update)
+        approx_vals = lms.update_batch(packets)
+        errors = np.abs(approx_vals - exact_vals) / exact_vals
+        print_error_quantiles("LpfMinSketch%s 3x%d" % (" (CU)" if conservative_update else "", sketch_height),
+                              exact_quantiles(errors), error_name="relative error", label_width=30)
 
-    result_pairs: List[Tuple[np.uint64, np.uint64]] = []
-    for flow_id, pair_list in results.items():
-        lpf_avg = mean([x for x, y in pair_list])
-        lms_avg = mean([y for x, y in pair_list])
-        result_pairs.append((lpf_avg, lms_avg))
 
-    return result_pairs
+def compare_tofino_lpf(num_pkts: int = 200000, zipf_exponent: float = 1.2, decay_time_constant_ns: float = 4e6,
+                       out_scale_down_factor: int = 3, height: int = 2048, mean_gap_ns: int = 100):
+    """
+    Compare the fixed-point Tofino LPF model, configured like `add_lpf_rules.py -d 4e6 -s 3`, against the
+    floating point LPF register it approximates, for several model precisions
+    """
+    rng = np.random.default_rng(SEED)
+    keys = np.stack([rng.zipf(a=zipf_exponent, size=num_pkts) % (1 << 32),
+                     np.zeros(num_pkts, dtype=np.int64)], axis=1)
+    timestamps = np.cumsum(rng.integers(0, 2 * mean_gap_ns, size=num_pkts, endpoint=True))
+    sizes = rng.integers(64, 1500, size=num_pkts, endpoint=True)
+    hash_func = make_crc16_func()
+    indices = np.asarray([hash_func(*key) % height for key in as_flow_ids(keys)], dtype=np.int64)
+
+    reference = LpfHashedRegister(time_constant=decay_time_constant_ns, height=height, hash_func=hash_func,
+                                  scale=out_scale_down_factor)
+    exact_vals = reference.update_many_at(indices, timestamps, sizes)
+    print("%d zipfian packets, decay time constant %dns, scale down factor %d" %
+          (num_pkts, decay_time_constant_ns, out_scale_down_factor))
+    for factor_bits, decay_quantum_bits in [(16, None), (12, None), (16, 10), (8, 10)]:
+        model = TofinoLpfRegister(height=height, mode="RATE", gain_time_constant_ns=decay_time_constant_ns,
+                                  out_scale_down_factor=out_scale_down_factor, hash_func=hash_func,
+                                  factor_bits=factor_bits, decay_quantum_bits=decay_quantum_bits)
+        approx_vals = model.update_many_at(indices, timestamps, sizes)
+        errors = np.abs(approx_vals - exact_vals) / np.maximum(exact_vals, 1)
+        print_error_quantiles("%d-bit factors, %dns quanta" % (factor_bits, model.decay.step()),
+                              exact_quantiles(errors))
+
+
+def exact_window_sums(flow_ids: np.ndarray, timestamps, values, window_duration: int) -> np.ndarray:
+    """
+    Vectorized equivalent of feeding a whole trace to a `SlidingWindowRateEstimator` whose buffers never fill up
+    :param flow_ids: integer flow ID of every packet, eg. from `dense_flow_ids`
+    :param timestamps: integer packet timestamps, non-decreasing within every flow
+    :param values: packet values, eg. sizes
+    :param window_duration: window length, in timestamp units
+    :return: sum of the flow's window after every packet, in trace order
+    """
+    flow_ids = np.asarray(flow_ids, dtype=np.int64)
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    order = np.argsort(flow_ids, kind="stable")
+    # (flow, timestamp) pairs as one sorted integer, so every window start is found with one binary search
+    span = int(timestamps.max(initial=0)) + window_duration + 1
+    positions = flow_ids[order] * span + timestamps[order]
+    totals = np.concatenate(([0], np.cumsum(np.asarray(values, dtype=np.float64)[order])))
+    window_starts = np.searchsorted(positions, positions - window_duration, side="left")
+    sums = np.empty(len(order))
+    sums[order] = totals[1:] - totals[window_starts]
+    return sums
+
+
+def compare_window_and_lpf_estimators(num_pkts: int = 500000, zipf_exponent: float = 1.2,
+                                      window_duration: int = 20000, height: int = 2048, capacity: int = 32):
+    """
+    Compare sliding window and LPF rate estimation of the same memory layout: each sketch against the exact
+    per-flow version of its own estimator, with the sketches' memory use
+    """
+    packets = zipf_packet_batch(num_pkts, zipf_exponent)
+    flow_ids = dense_flow_ids(packets.keys)
+    print("%d zipfian packets from %d flows, window/time constant %d" %
+          (num_pkts, flow_ids.max() + 1, window_duration))
+
+    exact_sums = exact_window_sums(flow_ids, packets.timestamps, packets.sizes, window_duration)
+    windows = HashedSlidingWindowRateEstimator(window_duration=window_duration, capacity=capacity, height=height)
+    window_vals = windows.update_batch(packets)
+    print_error_quantiles("Windows 3x%dx%d (%dKB)" % (height, capacity, windows.nbytes() // 1024),
+                          exact_quantiles(np.abs(window_vals - exact_sums) / exact_sums))
+
+    exact_rates = exact_lpf_rates(flow_ids, packets.timestamps, packets.sizes, window_duration)
+    lms = LpfMinSketch(time_constant=window_duration, height=height)
+    lpf_vals = lms.update_batch(packets)
+    lpf_bytes = sum(register.timestamps.nbytes + register.values.nbytes for register in lms.registers)
+    print_error_quantiles("LpfMinSketch 3x%d (%dKB)" % (height, lpf_bytes // 1024),
+                          exact_quantiles(np.abs(lpf_vals - exact_rates) / exact_rates))
+
+
+def compare_global_decay_register(num_pkts: int = 1000000, zipf_exponent: float = 1.2, time_constant: int = 1000,
+                                  height: int = 2048):
+    """
+    Compare the lazy global-decay LPF register against the per-cell timestamp register it replaces: output
+    differences, update times and memory
+    """
+    packets = zipf_packet_batch(num_pkts, zipf_exponent)
+    hash_func = make_crc16_func()
+    indices = np.asarray([hash_func(*key) % height for key in packets.flow_ids()], dtype=np.int64)
+    print("%d zipfian packets, time constant %d" % (num_pkts, time_constant))
+
+    register = LpfHashedRegister(time_constant=time_constant, height=height, hash_func=hash_func)
+    start = time.time()
+    exact_vals = register.update_many_at(indices, packets.timestamps, packets.sizes)
+    print("LpfHashedRegister: %.2fs batch, %dKB" %
+          (time.time() - start, (register.timestamps.nbytes + register.values.nbytes) // 1024))
+
+    lazy = LpfGlobalDecayRegister(time_constant=time_constant, height=height, hash_func=hash_func)
+    start = time.time()
+    lazy_vals = lazy.update_many_at(indices, packets.timestamps, packets.sizes)
+    print("LpfGlobalDecayRegister: %.2fs batch, %dKB" % (time.time() - start, lazy.scaled_values.nbytes // 1024))
+    print_error_quantiles("LpfGlobalDecayRegister", exact_quantiles(np.abs(lazy_vals - exact_vals) / exact_vals))
+
+    for cls in (LpfHashedRegister, LpfGlobalDecayRegister):
+        sequential = cls(time_constant=time_constant, height=height, hash_func=hash_func)
+        start = time.time()
+        for index, timestamp, size in zip(indices[:100000].tolist(), packets.timestamps[:100000].tolist(),
+                                          packets.sizes[:100000].tolist()):
+            sequential.update_at(index, timestamp, size)
+        print("%s: %.2fus per sequential update" % (cls.__name__, (time.time() - start) * 10))
+
+
+def test_global_decay_register():
+    print("Check 1")
+    # idle gaps of thousands of time constants, far beyond the renormalization interval
+    hash_func = make_crc16_func()
+    timestamps = np.asarray([0, 10, 5000, 5003, 10 ** 7], dtype=np.uint64)
+    sizes = np.asarray([100, 200, 300, 400, 500], dtype=np.uint64)
+    indices = np.zeros(len(timestamps), dtype=np.int64)
+    exact = LpfHashedRegister(time_constant=5, height=16, hash_func=hash_func)
+    exact_vals = exact.update_many_at(indices, timestamps, sizes)
+    sequential = LpfGlobalDecayRegister(time_constant=5, height=16, hash_func=hash_func)
+    sequential_vals = [sequential.update_at(0, timestamp, size)
+                       for timestamp, size in zip(timestamps.tolist(), sizes.tolist())]
+    batch = LpfGlobalDecayRegister(time_constant=5, height=16, hash_func=hash_func)
+    batch_vals = batch.update_many_at(indices, timestamps, sizes)
+    if not np.allclose(sequential_vals, exact_vals) or not np.allclose(batch_vals, exact_vals):
+        print("LpfGlobalDecayRegister messed up after an idle period")
+        exit(1)
+    print("LpfGlobalDecayRegister didn't mess up")
+
+
+def test_elastic_lpf_sketch():
+    packets = zipf_packet_batch(20000, 1.2)
+    for conservative_update in (False, True):
+        print("Check %d" % (1 + conservative_update))
+        batch = ElasticLpfSketch(heavy_buckets=64, light_height=128, conservative_update=conservative_update)
+        sequential = ElasticLpfSketch(heavy_buckets=64, light_height=128, conservative_update=conservative_update)
+        batch_vals = batch.update_many(packets.keys, packets.timestamps, packets.sizes)
+        sequential_vals = [sequential.update(key, timestamp, size) for key, timestamp, size in
+                           zip(packets.flow_ids(), packets.timestamps.tolist(), packets.sizes.tolist())]
+        if not np.array_equal(batch_vals, sequential_vals):
+            print("ElasticLpfSketch `update_many` messed up")
+            exit(1)
+
+        # after an idle period of many time constants, every other flow's rate has decayed away
+        idle_key = (2 ** 32 - 1, 0, 0, 0, 0)
+        batch.update(idle_key, int(packets.timestamps[-1]) + 1000 * int(batch.time_constant), 1)
+        if any(batch.get(key) > 1e-9 for key in set(packets.flow_ids()) if key != idle_key):
+            print("ElasticLpfSketch `get` did not decay")
+            exit(1)
+    print("ElasticLpfSketch didn't mess up")
+
+
+def compare_elastic_lpf_sketch(num_pkts: int = 1000000, zipf_exponents: Sequence[float] = (1.1, 1.2),
+                               time_constant: int = 1000):
+    """
+    Accuracy against memory of LPF min-sketches and heavy/light split sketches on the zipfian workloads,
+    by the error of every packet's rate estimate relative to an exact per-flow LPF
+    """
+    for zipf_exponent in zipf_exponents:
+        packets = zipf_packet_batch(num_pkts, zipf_exponent)
+        exact_vals = exact_lpf_rates(dense_flow_ids(packets.keys), packets.timestamps, packets.sizes,
+                                     time_constant)
+        print("%d zipfian packets with exponent %.1f, time constant %d" % (num_pkts, zipf_exponent, time_constant))
+        for height, conservative_update in itertools.product((4096, 2048, 1024, 512), (False, True)):
+            lms = LpfMinSketch(time_constant=time_constant, height=height, conservative_update=conservative_update)
+            errors = np.abs(lms.update_batch(packets) - exact_vals) / exact_vals
+            print_error_quantiles("LpfMinSketch%s %dKB" % (" (CU)" if conservative_update else "",
+                                                           lms.sram_bytes() // 1024), exact_quantiles(errors))
+        for heavy_buckets, light_height in ((512, 1024), (256, 512), (256, 256)):
+            elastic = ElasticLpfSketch(time_constant=time_constant, heavy_buckets=heavy_buckets,
+                                       light_height=light_height)
+            errors = np.abs(elastic.update_batch(packets) - exact_vals) / exact_vals
+            print_error_quantiles("ElasticLpfSketch %dKB" % (elastic.sram_bytes() // 1024), exact_quantiles(errors))
 
 
 def plot_approx_pairs(pairs: List[Tuple[np.uint64, np.uint64]], title: str, ax: Optional[Axes] = None):
@@ -299,13 +1853,7 @@ def plot_zipf_accuracy(cms=False):
     struct_height = 512
     num_pkts = 1000000
     zipf_exponent = 1.2
-    rng = np.random.default_rng(SEED)
-
-    # Inflate the packet-IDs to spread them out more
-    packets = [Packet(flow_id=(int(pkt_id) * 521, int(pkt_id), int(pkt_id) * 91),
-                      timestamp=i,
-                      size=random.randint(20, 200))
-               for i, pkt_id in enumerate(rng.zipf(a=zipf_exponent, size=num_pkts))]
+    packets = zipf_packet_batch(num_pkts, zipf_exponent)
 
     results1 = get_epoched_cms_approx_pairs(packets,
                                             struct_width,
@@ -340,9 +1888,7 @@ def plot_uniform_accuracy():
     num_flows = 10000
     num_pkts = 1000000
 
-    packets = [Packet(flow_id=(random.randint(0, num_flows) * 91,),
-                      timestamp=i,
-                      size=random.randint(20, 200)) for i in range(num_pkts)]
+    packets = uniform_packet_batch(num_pkts, num_flows)
 
     results1 = get_epoched_cms_approx_pairs(packets,
                                             struct_width,
@@ -371,5 +1917,7 @@ def plot_uniform_accuracy():
 
 
 if __name__ == "__main__":
+    test_global_decay_register()
+    test_elastic_lpf_sketch()
     plot_zipf_accuracy()
     # plot_uniform_accuracy()
@@ -0,0 +1,179 @@
+"""
+Sharded ingestion of packet traces. The trace is split by flow key, every shard is fed to its own sketch in a
+worker process, and the per-shard sketches are merged into one. Since all packets of a flow land in the same shard,
+this works for both the counting sketches of heavy_hitters.py and the LPF sketches of rate_estimators.py.
+"""
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from os import cpu_count
+from typing import Any, Callable, List, Optional, Tuple, TypeVar, Union
+
+import numpy as np
+
+from common import FlowId, Packet, PacketBatch, as_packet_batch
+from hashing import as_key_array, crc16_many, crc16_polynomials
+from heavy_hitters import HeavyHitterSketch, MergeableCounters, CountMinSketch, as_flow_ids
+from rate_estimators import RateEstimator, LpfMinSketch, LpfHashedRegister, LpfExactRegister
+
+Sketch = TypeVar("Sketch", HeavyHitterSketch, RateEstimator)
+
+# Keep shard assignment independent of the sketch rows, which use the first few CRC16 polynomials
+SHARD_POLYNOMIAL = crc16_polynomials(1, offset=32)[0]
+
+
+def shard_keys(keys, num_shards: int) -> np.ndarray:
+    """
+    Assign every key to a shard by hashing it
+    :param keys: batch of keys, see `as_key_array`
+    :param num_shards: number of shards
+    :return: int64 array with the shard index of every key
+    """
+    return crc16_many(keys, SHARD_POLYNOMIAL).astype(np.int64) % num_shards
+
+
+def shard_state(sketch: Sketch) -> Any:
+    """
+    Picklable state of a sketch, which `merge_shard_state` merges into another sketch built by the same factory.
+    The sketch itself may not be picklable, since CRC functions cannot be pickled.
+    """
+    if isinstance(sketch, MergeableCounters):
+        return sketch.counters(), sketch.ground_truth
+    if isinstance(sketch, LpfMinSketch):
+        return [(register.timestamps, register.values) for register in sketch.registers]
+    if isinstance(sketch, LpfHashedRegister):
+        return sketch.timestamps, sketch.values
+    return sketch
+
+
+def merge_shard_state(sketch: Sketch, state: Any) -> None:
+    """
+    Merge the output of `shard_state` into a sketch
+    """
+    if isinstance(sketch, MergeableCounters):
+        sketch.merge_counters(*state)
+    elif isinstance(sketch, LpfMinSketch):
+        for register, (timestamps, values) in zip(sketch.registers, state):
+            register.merge_cells(timestamps, values)
+    elif isinstance(sketch, LpfHashedRegister):
+        sketch.merge_cells(*state)
+    else:
+        sketch.merge(state)
+
+
+def merge_top_k(sketch: Sketch, candidates: List[Tuple[FlowId, float]]) -> None:
+    """
+    Rebuild the top-k tracker of a merged sketch from the top keys of every shard. Trackers cannot be merged
+    like counters, but every flow lands in a single shard, so the merged top keys are usually among the shards'.
+    Counting sketches re-estimate the candidates with the merged counters. LPF sketches keep each candidate's
+    estimate from its shard, as of its latest packet, which misses collisions with the flows of other shards.
+    :param sketch: the merged sketch
+    :param candidates: (key, estimate) pairs from the `top_k` of every shard
+    """
+    if not candidates:
+        return
+    keys = [key for key, _ in candidates]
+    estimates = [estimate for _, estimate in candidates]
+    if isinstance(sketch, MergeableCounters):
+        estimates = sketch.get_many(keys)
+    sketch.top_keys.clear()
+    sketch.top_keys.offer_many(keys, estimates)
+
+
+def ingest(sketch: Sketch, keys: np.ndarray, values: np.ndarray, timestamps: Optional[np.ndarray]) -> None:
+    """
+    Feed a trace to a sketch, in order
+    :param keys: flow key of every packet, as an (n, fields) array
+    """
+    if isinstance(sketch, HeavyHitterSketch):
+        sketch.add_many(keys, values)
+    elif isinstance(sketch, (LpfMinSketch, LpfHashedRegister, LpfExactRegister)):
+        sketch.update_many(keys, timestamps, values)
+    else:
+        for key, timestamp, value in zip(as_flow_ids(keys), timestamps.tolist(), values.tolist()):
+            sketch.update(key, timestamp, value)
+
+
+def _ingest_shard(factory: Callable[[], Sketch], keys: np.ndarray, values: np.ndarray,
+                  timestamps: Optional[np.ndarray]) -> Tuple[Any, List[Tuple[FlowId, float]]]:
+    sketch = factory()
+    ingest(sketch, keys, values, timestamps)
+    top_keys = getattr(sketch, "top_keys", None)
+    return shard_state(sketch), [] if top_keys is None else top_keys.top_k()
+
+
+def sharded_ingest(factory: Callable[[], Sketch], keys, values=1, timestamps=None,
+                   num_shards: Optional[int] = None, max_workers: Optional[int] = None) -> Sketch:
+    """
+    Feed a trace to sketches in parallel, one per shard of the flow keys, and merge them.
+    Counting sketches come out identical to a sketch fed the whole trace, except conservative-update sketches,
+    whose updates depend upon the state left by every earlier packet: they still never underestimate, but are
+    less accurate. LPF sketches come out identical up to floating point rounding, since each shard keeps its
+    packets in trace order, again except with conservative update. Top-k trackers are rebuilt from the shards'
+    top keys, see `merge_top_k`.
+    :param factory: picklable callable that builds an empty sketch, eg. `partial(CountMinSketch, height=4096)`.
+                    Every call must build a sketch with the same hash functions
+    :param keys: flow key of every packet, see `as_key_array`
+    :param values: value of every packet, eg. its size, or one value for all packets
+    :param timestamps: timestamp of every packet. Required for rate estimators, ignored by counting sketches
+    :param num_shards: number of shards. Defaults to the number of CPUs
+    :param max_workers: number of worker processes. Defaults to `num_shards`
+    :return: the merged sketch
+    """
+    keys = as_key_array(keys)
+    values = np.broadcast_to(np.asarray(values), len(keys))
+    if timestamps is not None:
+        timestamps = np.asarray(timestamps)
+    if num_shards is None:
+        num_shards = cpu_count() or 1
+
+    shards = shard_keys(keys, num_shards)
+    # boolean selection keeps every shard's packets in trace order
+    selections = [np.flatnonzero(shards == shard) for shard in range(num_shards)]
+    merged = factory()
+    with ProcessPoolExecutor(max_workers=max_workers or num_shards) as executor:
+        futures = [executor.submit(_ingest_shard, factory, keys[selection], values[selection],
+                                   None if timestamps is None else timestamps[selection])
+                   for selection in selections]
+        candidates = []
+        for future in futures:
+            state, top_k = future.result()
+            merge_shard_state(merged, state)
+            candidates.extend(top_k)
+    if getattr(merged, "top_keys", None) is not None:
+        merge_top_k(merged, candidates)
+    return merged
+
+
+def sharded_ingest_packets(factory: Callable[[], Sketch], packets: Union[List[Packet], PacketBatch],
+                           num_shards: Optional[int] = None, max_workers: Optional[int] = None) -> Sketch:
+    """
+    `sharded_ingest` for a list or batch of packets, using packet sizes as values
+    """
+    batch = as_packet_batch(packets)
+    return sharded_ingest(factory, keys=batch.keys, values=batch.sizes, timestamps=batch.timestamps,
+                          num_shards=num_shards, max_workers=max_workers)
+
+
+def compare_sharded_ingest(num_packets: int = 1000000, zipf_exponent: float = 1.2,
+                           num_shards: Optional[int] = None):
+    rng = np.random.default_rng(0)
+    flow_ids = rng.zipf(zipf_exponent, num_packets) % (1 << 32)
+    keys = np.stack([np.zeros(num_packets, dtype=np.uint64), flow_ids.astype(np.uint64)], axis=1)
+    sizes = rng.integers(64, 1500, num_packets)
+
+    start = time.time()
+    sequential = CountMinSketch(track_ground_truth=False, track_top_k=10)
+    sequential.add_many(keys, sizes)
+    print("Sequential CMS ingestion: %.2fs" % (time.time() - start))
+
+    start = time.time()
+    sharded = sharded_ingest(partial(CountMinSketch, track_ground_truth=False, track_top_k=10), keys, sizes,
+                             num_shards=num_shards)
+    print("Sharded CMS ingestion: %.2fs" % (time.time() - start))
+    print("Identical counters: %s" % np.array_equal(sequential.arrays, sharded.arrays))
+    print("Identical top-k: %s" % (sequential.top_k() == sharded.top_k()))
+
+
+if __name__ == "__main__":
+    compare_sharded_ingest()
@@ -0,0 +1,209 @@
+"""
+LPF sketches in shared memory, so that several producer processes, eg. trace replayers or traffic generators,
+can feed one estimator concurrently.
+
+Concurrency semantics of `SharedLpfMinSketch`:
+- Every register is split into `num_stripes` lock stripes: cell i of a row is guarded by lock i % num_stripes of
+  that row. A cell is only ever read-modified-written with its stripe lock held, so no update to a cell is lost.
+- Updates are not atomic across rows. A concurrent reader may see a sample in some rows and not yet in others,
+  so it may get the estimate from before or after the sample, never a torn cell.
+- Producers interleave, so a cell may receive samples older than its last one. A late sample is decayed to the
+  cell's time and added. The LPF is linear, so the final state of every cell does not depend on the order of its
+  samples: it is the same as if one process had fed it every sample in timestamp order, up to floating point
+  rounding. Estimates returned along the way reflect whatever other producers had written so far.
+- `update` holds one stripe lock at a time. `update_many` holds the stripe locks of one row at a time, taken in
+  ascending order, so producers cannot deadlock.
+- Reads (`get`) take no locks.
+
+Locks cannot be pickled once a process is running, so the sketch is shared by passing `handle()` to a process
+when it is started, eg. as an argument of `multiprocessing.Process` or of a pool initializer. The process then
+calls `SharedLpfMinSketch.attach` on it.
+"""
+import time
+from multiprocessing import Lock, Process
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, List, NamedTuple, Optional
+
+import numpy as np
+
+from common import LPF_DECAY, LPF_SCALE, PacketBatch, zipf_packet_batch
+from rate_estimators import LpfMinSketch, lpf_update_cells, merge_lpf_values
+
+
+class SharedSketchHandle(NamedTuple):
+    """
+    Everything a process needs to attach to a `SharedLpfMinSketch`
+    """
+    block_name: str
+    time_constant: Any
+    scale: int
+    width: int
+    height: int
+    num_stripes: int
+    locks: List[Any]
+
+
+class SharedLpfMinSketch(LpfMinSketch):
+    """
+    LpfMinSketch whose register cells live in a shared memory block, see the module documentation for its
+    concurrency semantics. Uses the default hash functions. Conservative update and top-k tracking depend upon
+    state across rows or processes, so they are not supported.
+    """
+    block: SharedMemory
+    num_stripes: int
+    locks: List[Any]  # one lock per stripe of every row, row by row
+    owner: bool  # whether this process created the block, and should unlink it
+
+    def __init__(self, time_constant=LPF_DECAY, scale: int = LPF_SCALE, width: int = 3, height: int = 2048,
+                 num_stripes: int = 64, handle: Optional[SharedSketchHandle] = None):
+        """
+        :param time_constant: LPF decay time constant
+        :param scale: LPF output scale-down factor
+        :param width: number of registers
+        :param height: number of cells in each register
+        :param num_stripes: number of locks per register
+        :param handle: attach to an existing sketch instead of creating one. See `attach`
+        """
+        super().__init__(time_constant=time_constant, scale=scale, width=width, height=height)
+        self.num_stripes = num_stripes
+        self.owner = handle is None
+        if handle is None:
+            self.block = SharedMemory(create=True, size=2 * width * height * np.dtype(np.float64).itemsize)
+            self.locks = [Lock() for _ in range(width * num_stripes)]
+        else:
+            self.block = SharedMemory(name=handle.block_name)
+            self.locks = handle.locks
+        cells = np.ndarray((2, width, height), dtype=np.float64, buffer=self.block.buf)
+        if self.owner:
+            cells.fill(0)
+        for register, timestamps, values in zip(self.registers, cells[0], cells[1]):
+            register.timestamps = timestamps
+            register.values = values
+
+    @classmethod
+    def attach(cls, handle: SharedSketchHandle) -> 'SharedLpfMinSketch':
+        """
+        Attach to a sketch created by another process
+        """
+        return cls(time_constant=handle.time_constant, scale=handle.scale, width=handle.width, height=handle.height,
+                   num_stripes=handle.num_stripes, handle=handle)
+
+    def handle(self) -> SharedSketchHandle:
+        return SharedSketchHandle(self.block.name, self.registers[0].time_constant,
+                                  int(self.registers[0].scale_down_factor), self.width, self.height,
+                                  self.num_stripes, self.locks)
+
+    def close(self) -> None:
+        """
+        Detach from the shared cells. The process that created the sketch also frees them
+        """
+        for register in self.registers:
+            register.timestamps = register.values = None
+        self.block.close()
+        if self.owner:
+            self.block.unlink()
+
+    def __enter__(self) -> 'SharedLpfMinSketch':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _lock(self, row: int, index: int):
+        return self.locks[row * self.num_stripes + index % self.num_stripes]
+
+    def update(self, key, timestamp, value) -> np.uint64:
+        """
+        Add a sample to the key's cell of every register, one stripe lock at a time
+        :return: the smallest of the key's cells after the update, each as of its newest sample
+        """
+        rates = []
+        for row, (register, index) in enumerate(zip(self.registers, self.indices(key))):
+            with self._lock(row, index):
+                timestamps, values = merge_lpf_values(register.timestamps[index], register.values[index],
+                                                      timestamp, value, register.time_constant)
+                register.timestamps[index] = timestamps
+                register.values[index] = values
+            rates.append(values)
+        return min(rates) / (2 ** self.registers[0].scale_down_factor)
+
+    def update_many(self, keys, timestamps, values, hashes: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Batch version of `update`. Each row's share of the batch is run through empty private cells with
+        `lpf_update_cells`, then merged into the shared cells with the row's stripe locks held. Every output adds
+        the shared cell, as of the start of the merge and decayed to the sample time, to the batch's own traffic.
+        :param timestamps: sample timestamps, non-decreasing within every cell
+        :return: rate estimate after every update, in arrival order
+        """
+        if hashes is None:
+            indices = self.indices_many(keys)
+        else:
+            indices = np.asarray(hashes)[:self.width].astype(np.int64) % self.height
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        row_rates = []
+        for row, (register, row_indices) in enumerate(zip(self.registers, indices)):
+            own_timestamps = np.zeros(self.height)
+            own_values = np.zeros(self.height)
+            outputs = lpf_update_cells(own_timestamps, own_values, row_indices, timestamps, values, register.decay)
+            cells = np.unique(row_indices)
+            stripes = np.unique(cells % self.num_stripes).tolist()
+            for stripe in stripes:
+                self.locks[row * self.num_stripes + stripe].acquire()
+            try:
+                shared_timestamps = register.timestamps[row_indices]
+                # samples older than the shared cell see it as of its newest sample
+                elapsed = np.maximum(timestamps - shared_timestamps, 0)
+                outputs += register.values[row_indices] * register.decay.factors(elapsed)
+                register.timestamps[cells], register.values[cells] = merge_lpf_values(
+                    register.timestamps[cells], register.values[cells], own_timestamps[cells], own_values[cells],
+                    register.time_constant)
+            finally:
+                for stripe in reversed(stripes):
+                    self.locks[row * self.num_stripes + stripe].release()
+            row_rates.append(outputs)
+        return np.min(row_rates, axis=0) / (2 ** self.registers[0].scale_down_factor)
+
+
+def _produce(handle: SharedSketchHandle, packets: PacketBatch, batch_size: int) -> None:
+    sketch = SharedLpfMinSketch.attach(handle)
+    for start in range(0, len(packets), batch_size):
+        sketch.update_batch(packets[start:start + batch_size])
+    sketch.close()
+
+
+def shared_ingest(sketch: SharedLpfMinSketch, packets: PacketBatch, num_producers: int,
+                  batch_size: int = 10000) -> None:
+    """
+    Feed a trace to a shared sketch from several producer processes. Packets are dealt out round-robin, so the
+    producers' samples interleave in every cell, as with concurrent traffic sources
+    """
+    producers = [Process(target=_produce, args=(sketch.handle(), packets[producer::num_producers], batch_size))
+                 for producer in range(num_producers)]
+    for producer in producers:
+        producer.start()
+    for producer in producers:
+        producer.join()
+        if producer.exitcode != 0:
+            raise RuntimeError("A producer process failed with exit code %d" % producer.exitcode)
+
+
+def compare_shared_ingest(num_pkts: int = 1000000, num_producers: int = 4, time_constant: int = 1000):
+    packets = zipf_packet_batch(num_pkts)
+
+    start = time.time()
+    sequential = LpfMinSketch(time_constant=time_constant)
+    sequential.update_batch(packets)
+    print("Sequential LPF sketch ingestion: %.2fs" % (time.time() - start))
+
+    with SharedLpfMinSketch(time_constant=time_constant) as shared:
+        start = time.time()
+        shared_ingest(shared, packets, num_producers)
+        print("Shared LPF sketch ingestion, %d producers: %.2fs" % (num_producers, time.time() - start))
+        # cells hold values as of their newest sample, which is the same in both sketches
+        differences = [np.max(np.abs(register.values - shared_register.values) / np.maximum(register.values, 1))
+                       for register, shared_register in zip(sequential.registers, shared.registers)]
+        print("Largest relative cell difference: %.2e" % max(differences))
+
+
+if __name__ == "__main__":
+    compare_shared_ingest()
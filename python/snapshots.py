@@ -0,0 +1,328 @@
+"""
+Binary snapshots of sketch and LPF register state. A snapshot is one file: a magic string, the length of a JSON
+header, the header, then every array as raw bytes, aligned to 64 bytes. The header records the class, the
+constructor parameters and the dtype, shape and offset of every array, so snapshots are reopened with
+`np.memmap` instead of being read and copied. Reopened read-only, a warmed-up sketch can be shared by any
+number of worker processes through the page cache.
+
+Hash functions are recorded through the hash family spec, see `HashFamily.spec`. Sketches built from arbitrary
+hash functions, or from a hash cache, cannot record them. Their header only records that custom functions were used,
+and the same functions must be passed to `load_snapshot`. `LpfHashedRegister` always takes its hash function
+explicitly, so it is always treated this way.
+Ground-truth oracles and top-k trackers are not part of a snapshot.
+"""
+import json
+import os
+import struct
+import tempfile
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from hashing import (HashCache, Pad, crc16_polynomials, make_crc16_func, make_hash_family, make_tofino_cms_hash_funcs,
+                     as_key_array)
+from heavy_hitters import CountMinSketch, CountSketch, EpochCountMinSketch, ExactHeavyHitters, as_flow_ids
+from rate_estimators import LpfSingleton, LpfExactRegister, LpfHashedRegister, LpfMinSketch
+
+SNAPSHOT_MAGIC = b"AHABSNP1"
+SNAPSHOT_ALIGNMENT = 64
+
+Snapshottable = Union[CountMinSketch, CountSketch, ExactHeavyHitters,
+                      LpfSingleton, LpfExactRegister, LpfHashedRegister, LpfMinSketch]
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+
+
+def _number(value) -> Union[int, float]:
+    """ JSON-serializable version of a (possibly numpy) number """
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _encode_spec(spec: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    if spec is None:
+        return None
+    spec = dict(spec)
+    if "layout" in spec:
+        spec["layout"] = [{"pad": width.width} if isinstance(width, Pad) else width for width in spec["layout"]]
+    return spec
+
+
+def _decode_spec(spec: Dict[str, Any]) -> Dict[str, Any]:
+    spec = dict(spec)
+    if "layout" in spec:
+        spec["layout"] = [Pad(width["pad"]) if isinstance(width, dict) else width for width in spec["layout"]]
+    return spec
+
+
+def _hash_spec(sketch: Union[CountMinSketch, CountSketch]) -> Optional[Dict[str, Any]]:
+    return None if sketch.hash_family is None else _encode_spec(sketch.hash_family.spec())
+
+
+def _required_hash_funcs(class_name: str, params: Dict[str, Any], hash_funcs: Optional[List[Callable[..., int]]],
+                         count: int) -> Optional[List[Callable[..., int]]]:
+    """
+    :return: `hash_funcs` if the snapshot was built from custom hash functions, otherwise None
+    :raise ValueError: if custom hash functions are needed but missing, or there are too few of them
+    """
+    if not params.get("custom_hash_funcs", False):
+        return None
+    if hash_funcs is None:
+        raise ValueError("This %s snapshot was built from custom hash functions, which must be passed to "
+                         "load_snapshot" % class_name)
+    if len(hash_funcs) < count:
+        raise ValueError("This %s snapshot needs %d hash functions, not %d" % (class_name, count, len(hash_funcs)))
+    return hash_funcs
+
+
+def _sketch_state(sketch: Snapshottable) -> Tuple[Dict[str, Any], Dict[str, np.ndarray]]:
+    """
+    :return: the constructor parameters and scalar state of a sketch, and its arrays
+    """
+    if isinstance(sketch, CountMinSketch):
+        params = {"width": sketch.width, "height": sketch.height, "salts": sketch.salts,
+                  "conservative_update": sketch.conservative_update, "hash_family": _hash_spec(sketch),
+                  "custom_hash_funcs": sketch.hash_family is None}
+        if isinstance(sketch, EpochCountMinSketch):
+            sketch.compact()
+        return params, {"arrays": sketch.arrays}
+    if isinstance(sketch, CountSketch):
+        return {"width": sketch.width, "height": sketch.height, "hash_family": _hash_spec(sketch),
+                "custom_hash_funcs": sketch.hash_family is None}, \
+               {"arrays": sketch.arrays}
+    if isinstance(sketch, ExactHeavyHitters):
+        return {}, {"keys": as_key_array(list(sketch.ground_truth.keys())),
+                    "counts": np.fromiter(sketch.ground_truth.values(), dtype=np.int64,
+                                          count=len(sketch.ground_truth))}
+    if isinstance(sketch, LpfSingleton):
+        return {"time_constant": _number(sketch.time_constant), "scale": sketch.scale_down_factor,
+                "decay_quantum_bits": sketch.decay.quantum_bits,
+                "last_timestamp": _number(sketch.last_timestamp), "last_value": _number(sketch.last_value)}, {}
+    if isinstance(sketch, LpfExactRegister):
+        keys, flows = sketch.interner.live_flows()
+        return {"time_constant": _number(sketch.time_constant), "scale": _number(sketch.scale_down_factor),
+                "decay_quantum_bits": sketch.decay.quantum_bits}, \
+               {"keys": as_key_array(keys), "timestamps": sketch.timestamps[flows], "values": sketch.values[flows]}
+    if isinstance(sketch, LpfHashedRegister):
+        return {"time_constant": _number(sketch.time_constant), "height": sketch.height,
+                "scale": _number(sketch.scale_down_factor), "decay_quantum_bits": sketch.decay.quantum_bits,
+                "custom_hash_funcs": True}, \
+               {"timestamps": sketch.timestamps, "values": sketch.values}
+    if isinstance(sketch, LpfMinSketch):
+        registers = sketch.registers
+        return {"time_constant": _number(registers[0].time_constant),
+                "scale": _number(registers[0].scale_down_factor), "width": sketch.width, "height": sketch.height,
+                "conservative_update": sketch.conservative_update,
+                "decay_quantum_bits": registers[0].decay.quantum_bits,
+                "custom_hash_funcs": sketch.polynomials is None}, \
+               {"timestamps": np.stack([register.timestamps for register in registers]),
+                "values": np.stack([register.values for register in registers])}
+    raise TypeError("Cannot snapshot a %s" % type(sketch).__name__)
+
+
+def _restore_sketch(class_name: str, params: Dict[str, Any], arrays: Dict[str, np.ndarray],
+                    hash_funcs: Optional[List[Callable[..., int]]]) -> Snapshottable:
+    """
+    Rebuild a sketch around the (memory-mapped) arrays of a snapshot
+    """
+    if class_name in (CountMinSketch.__name__, EpochCountMinSketch.__name__):
+        cls = EpochCountMinSketch if class_name == EpochCountMinSketch.__name__ else CountMinSketch
+        kwargs = {"height": params["height"], "conservative_update": params["conservative_update"],
+                  "track_ground_truth": False}
+        hash_funcs = _required_hash_funcs(class_name, params, hash_funcs, params["width"])
+        if params["hash_family"] is not None:
+            kwargs["hash_family"] = make_hash_family(**_decode_spec(params["hash_family"]))
+        elif params["salts"] is None:
+            # built from a hash cache, whose functions are called without salts
+            kwargs["hash_cache"] = HashCache(hash_funcs[:params["width"]])
+        else:
+            kwargs.update(hash_funcs=hash_funcs[:params["width"]], salts=params["salts"])
+        sketch = cls(width=params["width"], **kwargs)
+        sketch.arrays = arrays["arrays"]
+        return sketch
+    if class_name == CountSketch.__name__:
+        hash_funcs = _required_hash_funcs(class_name, params, hash_funcs, 2 * params["width"])
+        hash_family = None
+        hash_cache = None
+        if params["hash_family"] is not None:
+            hash_family = make_hash_family(**_decode_spec(params["hash_family"]))
+        elif hash_funcs is not None:
+            hash_cache = HashCache(hash_funcs)
+        sketch = CountSketch(width=params["width"], height=params["height"], hash_family=hash_family,
+                             hash_cache=hash_cache, track_ground_truth=False)
+        sketch.arrays = arrays["arrays"]
+        return sketch
+    if class_name == ExactHeavyHitters.__name__:
+        sketch = ExactHeavyHitters()
+        sketch.ground_truth.update(zip(as_flow_ids(arrays["keys"]), arrays["counts"].tolist()))
+        return sketch
+    if class_name == LpfSingleton.__name__:
+        sketch = LpfSingleton(time_constant=params["time_constant"], scale_down_factor=params["scale"],
+                               decay_quantum_bits=params.get("decay_quantum_bits"))
+        sketch.last_timestamp = params["last_timestamp"]
+        sketch.last_value = params["last_value"]
+        return sketch
+    if class_name == LpfExactRegister.__name__:
+        sketch = LpfExactRegister(time_constant=params["time_constant"], scale=params["scale"],
+                                  decay_quantum_bits=params.get("decay_quantum_bits"))
+        sketch.interner.intern_many(arrays["keys"])
+        sketch._reserve(len(sketch.interner))
+        # flows were interned in snapshot order, so flow i is in row i
+        sketch.timestamps[:len(sketch.interner)] = arrays["timestamps"]
+        sketch.values[:len(sketch.interner)] = arrays["values"]
+        return sketch
+    if class_name == LpfHashedRegister.__name__:
+        # the register's hash function is always given explicitly, so it is always needed, even by snapshots that
+        # predate the custom_hash_funcs flag
+        hash_funcs = _required_hash_funcs(class_name, dict(params, custom_hash_funcs=True), hash_funcs, 1)
+        sketch = LpfHashedRegister(time_constant=params["time_constant"], height=params["height"],
+                                   hash_func=hash_funcs[0], scale=params["scale"],
+                                   decay_quantum_bits=params.get("decay_quantum_bits"))
+        sketch.timestamps = arrays["timestamps"]
+        sketch.values = arrays["values"]
+        return sketch
+    if class_name == LpfMinSketch.__name__:
+        hash_funcs = _required_hash_funcs(class_name, params, hash_funcs, params["width"])
+        sketch = LpfMinSketch(time_constant=params["time_constant"], scale=params["scale"], width=params["width"],
+                              height=params["height"],
+                              hash_funcs=None if hash_funcs is None else hash_funcs[:params["width"]],
+                              conservative_update=params["conservative_update"],
+                              decay_quantum_bits=params.get("decay_quantum_bits"))
+        for register, timestamps, values in zip(sketch.registers, arrays["timestamps"], arrays["values"]):
+            register.timestamps = timestamps
+            register.values = values
+        return sketch
+    raise TypeError("Unknown snapshot class %s" % class_name)
+
+
+def save_snapshot(sketch: Snapshottable, path: str) -> None:
+    """
+    Write the state of a sketch or register to a snapshot file
+    :param sketch: the sketch to save
+    :param path: the snapshot file
+    """
+    params, arrays = _sketch_state(sketch)
+    if isinstance(sketch, EpochCountMinSketch):
+        params["epoch"] = sketch.epoch
+
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = _aligned(offset)
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += array.nbytes
+    header = json.dumps({"class": type(sketch).__name__, "params": params, "arrays": layout}).encode()
+    data_start = _aligned(len(SNAPSHOT_MAGIC) + 8 + len(header))
+
+    with open(path, "wb") as snapshot:
+        snapshot.write(SNAPSHOT_MAGIC)
+        snapshot.write(struct.pack("<Q", len(header)))
+        snapshot.write(header)
+        for name, array in arrays.items():
+            snapshot.seek(data_start + layout[name]["offset"])
+            snapshot.write(np.ascontiguousarray(array).tobytes())
+        snapshot.truncate(data_start + offset)
+
+
+def read_snapshot_header(path: str) -> Tuple[Dict[str, Any], int]:
+    """
+    :return: the JSON header of a snapshot file, and the file offset of its first array
+    """
+    with open(path, "rb") as snapshot:
+        if snapshot.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError("%s is not a sketch snapshot" % path)
+        header_length, = struct.unpack("<Q", snapshot.read(8))
+        header = json.loads(snapshot.read(header_length))
+    return header, _aligned(len(SNAPSHOT_MAGIC) + 8 + header_length)
+
+
+def load_snapshot(path: str, mode: str = "r",
+                  hash_funcs: Optional[List[Callable[..., int]]] = None) -> Snapshottable:
+    """
+    Reopen a snapshot. Arrays are memory-mapped, not copied, except for the per-flow state of exact structures,
+    which is copied into dictionaries or growable arrays.
+    :param path: the snapshot file
+    :param mode: `np.memmap` mode. "r" shares the arrays read-only, so updates to memory-mapped sketches raise
+                 an error, while the copied exact structures still accept them. "c" gives a private copy-on-write
+                 sketch, and "r+" writes updates back to the file
+    :param hash_funcs: hash functions of a sketch that was built from custom functions or a hash cache, in the
+                       order that the sketch was given them
+    :return: the sketch
+    :raise ValueError: if the snapshot needs `hash_funcs` and they are missing
+    """
+    header, data_start = read_snapshot_header(path)
+    arrays = {}
+    for name, array_layout in header["arrays"].items():
+        shape = tuple(array_layout["shape"])
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=array_layout["dtype"])
+            continue
+        arrays[name] = np.memmap(path, dtype=np.dtype(array_layout["dtype"]), mode=mode,
+                                 offset=data_start + array_layout["offset"], shape=shape)
+    sketch = _restore_sketch(header["class"], header["params"], arrays, hash_funcs)
+    if isinstance(sketch, EpochCountMinSketch):
+        # cells were compacted before saving, so every cell belongs to the saved epoch
+        sketch.epoch = header["params"]["epoch"]
+        sketch.epochs.fill(sketch.epoch)
+    return sketch
+
+
+def test_snapshots():
+    rng = np.random.default_rng(0)
+    # 5-tuple keys, which fit the Tofino CMS key layouts
+    keys = np.stack([rng.integers(0, 2 ** width, 1000, dtype=np.uint64) for width in (32, 32, 8, 16, 16)], axis=1)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "sketch.snp")
+
+        print("Check 1")
+        epoch_cms = EpochCountMinSketch(height=256, track_ground_truth=False)
+        epoch_cms.add_many(keys[:500], 1)
+        epoch_cms.clear()
+        epoch_cms.add_many(keys[500:], 2)
+        expected = epoch_cms.get_many(keys)
+        save_snapshot(epoch_cms, path)
+        loaded = load_snapshot(path)
+        if (not np.array_equal(loaded.get_many(keys), expected) or
+                [loaded.get(key) for key in as_flow_ids(keys)] != expected.tolist()):
+            print("Read-only epoch CMS snapshot messed up")
+            exit(1)
+
+        print("Check 2")
+        hash_funcs = make_tofino_cms_hash_funcs()
+        sketches = [CountMinSketch(hash_funcs=[make_crc16_func(polynomial) for polynomial in crc16_polynomials(3, 5)],
+                                   track_ground_truth=False),
+                    CountMinSketch(hash_cache=HashCache(hash_funcs), track_ground_truth=False),
+                    LpfMinSketch(time_constant=1000, hash_funcs=hash_funcs),
+                    LpfHashedRegister(time_constant=1000, height=256, hash_func=hash_funcs[0])]
+        for sketch in sketches:
+            custom_funcs = sketch.hash_funcs_in_use() if isinstance(sketch, CountMinSketch) else hash_funcs
+            if isinstance(sketch, CountMinSketch):
+                sketch.add_many(keys, 1)
+                expected = sketch.get_many(keys)
+            else:
+                expected = sketch.update_many(keys, np.arange(len(keys), dtype=np.uint64), np.full(len(keys), 100))
+            save_snapshot(sketch, path)
+            try:
+                load_snapshot(path)
+                print("%s snapshot loaded without its custom hash functions" % type(sketch).__name__)
+                exit(1)
+            except ValueError:
+                pass
+            loaded = load_snapshot(path, mode="c", hash_funcs=custom_funcs)
+            if isinstance(sketch, CountMinSketch):
+                vals = loaded.get_many(keys)
+            else:
+                # a zero sample at the last timestamp reads out every key's rate
+                timestamps = np.full(len(keys), len(keys) - 1, dtype=np.uint64)
+                vals = loaded.update_many(keys, timestamps, np.zeros(len(keys)))
+                expected = sketch.update_many(keys, timestamps, np.zeros(len(keys)))
+            if not np.array_equal(vals, expected):
+                print("%s snapshot with custom hash functions messed up" % type(sketch).__name__)
+                exit(1)
+            del loaded
+    print("Snapshots didn't mess up")
+
+
+if __name__ == "__main__":
+    test_snapshots()
@@ -0,0 +1,230 @@
+"""
+Parameter sweeps for sketch accuracy experiments. An experiment is a picklable function of a trace and some sketch
+parameters that returns a dictionary of numbers, eg. error quantiles. `run_sweep` runs it for every point of a
+parameter grid in a process pool. The trace is placed in shared memory once, and workers map it instead of
+receiving a copy per run. Results are cached on disk, keyed by the experiment, its parameters, a hash of the
+trace and a hash of the experiment's code, so rerunning a sweep only runs the points that have not been run before.
+The code hash covers the file that defines the experiment and the sketch modules listed in `SWEEP_SOURCES`.
+Results that depend upon code elsewhere must be invalidated with `version`, or by deleting the cache directory.
+"""
+import hashlib
+import inspect
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from os import cpu_count
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from accuracy import QUANTILES, exact_quantiles
+from common import zipf_packet_batch
+from rate_estimators import epoched_cms_values, lpf_min_sketch_values
+
+Trace = Dict[str, np.ndarray]  # named columns of equal length, eg. keys, timestamps and sizes
+Params = Dict[str, Any]
+Results = Dict[str, float]
+Experiment = Callable[..., Results]
+
+SWEEP_CACHE_DIR = ".sweep_cache"
+# sketch modules whose source is part of every cache key, relative to this file
+SWEEP_SOURCES = ["accuracy.py", "common.py", "hashing.py", "heavy_hitters.py", "rate_estimators.py", "sweeps.py"]
+
+
+def grid(**axes: List[Any]) -> List[Params]:
+    """
+    Every combination of the given parameter values, eg. grid(height=[512, 1024], time_constant=[5, 50])
+    :return: one parameter dictionary per combination
+    """
+    names = list(axes.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*axes.values())]
+
+
+def trace_hash(trace: Trace) -> str:
+    """
+    :return: hex digest of the names, dtypes, shapes and contents of the trace columns
+    """
+    digest = hashlib.sha256()
+    for name in sorted(trace):
+        column = np.ascontiguousarray(trace[name])
+        digest.update(("%s:%s:%s;" % (name, column.dtype.str, column.shape)).encode())
+        digest.update(column.data)
+    return digest.hexdigest()
+
+
+def experiment_name(experiment: Experiment) -> str:
+    """
+    :return: the module and qualified name of an experiment. The module is named after the file that defines it,
+             so the name is the same whether that file is imported or run as a script
+    """
+    module = os.path.splitext(os.path.basename(inspect.getsourcefile(experiment)))[0]
+    return "%s.%s" % (module, experiment.__qualname__)
+
+
+def code_hash(experiment: Experiment) -> str:
+    """
+    :return: hex digest of the source of the file that defines the experiment and of every `SWEEP_SOURCES` file
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    paths = {os.path.join(directory, name) for name in SWEEP_SOURCES}
+    paths.add(os.path.abspath(inspect.getsourcefile(experiment)))
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        digest.update(("%s;" % os.path.relpath(path, directory)).encode())
+        with open(path, "rb") as source:
+            digest.update(source.read())
+    return digest.hexdigest()
+
+
+def _cache_path(cache_dir: str, experiment: Experiment, params: Params, trace_digest: str, code_digest: str,
+                version: Optional[str]) -> str:
+    key = json.dumps({"experiment": experiment_name(experiment),
+                      "params": params, "trace": trace_digest, "code": code_digest, "version": version},
+                     sort_keys=True, default=str)
+    return os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+
+def _share_trace(trace: Trace) -> Tuple[List[SharedMemory], Dict[str, Tuple[str, str, Tuple[int, ...]]]]:
+    """
+    Copy every trace column into a shared memory block
+    :return: the blocks, and the name, dtype and shape of every column's block
+    """
+    blocks = []
+    layout = {}
+    for name, column in trace.items():
+        column = np.ascontiguousarray(column)
+        block = SharedMemory(create=True, size=max(column.nbytes, 1))
+        np.ndarray(column.shape, dtype=column.dtype, buffer=block.buf)[...] = column
+        blocks.append(block)
+        layout[name] = (block.name, column.dtype.str, column.shape)
+    return blocks, layout
+
+
+# the trace, as mapped by a worker process
+_worker_blocks: List[SharedMemory] = []
+_worker_trace: Trace = {}
+
+
+def _attach_trace(layout: Dict[str, Tuple[str, str, Tuple[int, ...]]]) -> None:
+    for name, (block_name, dtype, shape) in layout.items():
+        block = SharedMemory(name=block_name)
+        column = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        column.flags.writeable = False
+        _worker_blocks.append(block)
+        _worker_trace[name] = column
+
+
+def _run_point(experiment: Experiment, params: Params) -> Results:
+    return experiment(_worker_trace, **params)
+
+
+def run_sweep(experiment: Experiment, points: List[Params], trace: Trace, max_workers: Optional[int] = None,
+              cache_dir: Optional[str] = SWEEP_CACHE_DIR,
+              version: Optional[str] = None) -> List[Tuple[Params, Results]]:
+    """
+    Run an experiment for every parameter point, in parallel, reusing cached results
+    :param experiment: picklable function called as experiment(trace, **params). Must not modify the trace
+    :param points: parameter points, eg. from `grid`
+    :param trace: named trace columns, passed to every run through shared memory
+    :param max_workers: number of worker processes. Defaults to the number of CPUs
+    :param cache_dir: directory of cached results, or None to disable caching. Cached results are invalidated by
+                      any change to the experiment's file or to the sketch modules, see `code_hash`
+    :param version: optional version of any code outside the experiment's directory that results depend upon.
+                    Changing it invalidates cached results
+    :return: (parameters, results) of every point, in the order of `points`
+    """
+    trace_digest = trace_hash(trace)
+    results: List[Optional[Results]] = [None] * len(points)
+    paths: List[Optional[str]] = [None] * len(points)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        code_digest = code_hash(experiment)
+        for i, params in enumerate(points):
+            paths[i] = _cache_path(cache_dir, experiment, params, trace_digest, code_digest, version)
+            if os.path.exists(paths[i]):
+                with open(paths[i]) as cached:
+                    results[i] = json.load(cached)
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        blocks, layout = _share_trace(trace)
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers or cpu_count() or 1,
+                                     initializer=_attach_trace, initargs=(layout,)) as executor:
+                futures = {i: executor.submit(_run_point, experiment, points[i]) for i in missing}
+                for i, future in futures.items():
+                    results[i] = future.result()
+                    if paths[i] is not None:
+                        with open(paths[i], "w") as cached:
+                            json.dump(results[i], cached)
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+    return list(zip(points, results))
+
+
+def relative_error_summary(exact_vals: np.ndarray, approx_vals: np.ndarray) -> Results:
+    """
+    Quantiles and mean of the relative errors of a sketch's outputs
+    """
+    errors = np.abs(approx_vals - exact_vals) / exact_vals
+    summary = {"%d%%" % int(quantile * 100): float(error)
+               for quantile, error in zip(QUANTILES, exact_quantiles(errors))}
+    summary["mean"] = float(np.mean(errors))
+    return summary
+
+
+def epoched_cms_errors(trace: Trace, width: int, height: int, epoch_duration: int) -> Results:
+    """
+    Sweep experiment: relative errors of an epoched CMS. See `epoched_cms_values`
+    """
+    return relative_error_summary(*epoched_cms_values(trace["keys"], trace["timestamps"], trace["sizes"],
+                                                      width, height, epoch_duration))
+
+
+def lpf_min_sketch_errors(trace: Trace, width: int, height: int, time_constant: int) -> Results:
+    """
+    Sweep experiment: relative errors of an LPF min-sketch. See `lpf_min_sketch_values`
+    """
+    return relative_error_summary(*lpf_min_sketch_values(trace["keys"], trace["timestamps"], trace["sizes"],
+                                                         width, height, time_constant))
+
+
+def zipf_trace(num_pkts: int = 1000000, zipf_exponent: float = 1.2) -> Trace:
+    """
+    The zipfian workload of `plot_zipf_accuracy`, as trace columns
+    """
+    packets = zipf_packet_batch(num_pkts, zipf_exponent)
+    return {"keys": packets.keys, "timestamps": packets.timestamps, "sizes": packets.sizes}
+
+
+def print_sweep(title: str, sweep: List[Tuple[Params, Results]]) -> None:
+    print(title)
+    for params, results in sweep:
+        print("%40s --" % ", ".join("%s=%s" % item for item in params.items()), end=" ")
+        print(" ".join("%s: %.2f%%," % (name, error * 100) for name, error in results.items()))
+
+
+def sweep_zipf_accuracy(num_pkts: int = 1000000, max_workers: Optional[int] = None):
+    """
+    Size the CMS height and the LPF time constant on the zipfian workload
+    """
+    trace = zipf_trace(num_pkts)
+    start = time.time()
+    print_sweep("Epoched CMS", run_sweep(epoched_cms_errors,
+                                         grid(width=[3], height=[256, 512, 1024, 2048, 4096],
+                                              epoch_duration=[5, 50, 500]),
+                                         trace, max_workers))
+    print_sweep("LPF min-sketch", run_sweep(lpf_min_sketch_errors,
+                                            grid(width=[3], height=[256, 512, 1024, 2048, 4096],
+                                                 time_constant=[5, 50, 500]),
+                                            trace, max_workers))
+    print("Sweep took %.2fs" % (time.time() - start))
+
+
+if __name__ == "__main__":
+    sweep_zipf_accuracy()